@@ -1,22 +1,937 @@
+import time
+STARTUP_T0 = time.perf_counter()
+
 import sys
 import os
 import subprocess
 import re
-import requests
 import json
+import struct
 import tempfile
+import ast
+import threading
+import traceback
+import keyword
+import builtins
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout,
     QFileDialog, QLabel, QHBoxLayout, QPushButton, QLineEdit,
-    QAction, QMessageBox, QSplitter, QPlainTextEdit, QComboBox, QSizePolicy, QTextEdit, QCheckBox, QMenuBar
+    QAction, QMessageBox, QSplitter, QPlainTextEdit, QComboBox, QSizePolicy, QTextEdit, QCheckBox, QMenuBar, QToolTip,
+    QDialog, QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView, QProgressBar, QTextBrowser
 )
-from PyQt5.QtCore import Qt, pyqtSignal, QTimer, QThread, QObject, QMimeData, QEvent, QSize, QByteArray
-from PyQt5.QtGui import QFont, QColor, QPixmap, QImage, QIcon, QDragEnterEvent, QDropEvent, QKeySequence, QPainter
-from PyQt5.Qsci import QsciScintilla, QsciLexerPython, QsciAPIs
-from PyQt5.QtSvg import QSvgRenderer
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer, QThread, QObject, QMimeData, QEvent, QSize, QByteArray, QFileSystemWatcher
+from PyQt5.QtGui import QFont, QColor, QPixmap, QImage, QIcon, QDragEnterEvent, QDropEvent, QKeySequence, QPainter, QCursor, QTextCursor, QTextCharFormat, QTextBlockFormat, QSyntaxHighlighter
+from PyQt5 import Qsci
+from PyQt5.Qsci import QsciScintilla, QsciAPIs, QsciStyle
 
 MARKER_FUNC = 1
 MARKER_CLASS = 2
+MARKER_ERROR = 3
+MARKER_WARNING = 4
+MARKER_GIT_ADDED = 5
+MARKER_GIT_MODIFIED = 6
+MARKER_GIT_DELETED = 7
+GIT_MARKERS = (MARKER_GIT_ADDED, MARKER_GIT_MODIFIED, MARKER_GIT_DELETED)
+
+INDICATOR_ERROR = 8
+INDICATOR_WARNING = 9
+INDICATOR_FIND = 10
+# Семантическая подсветка: по индикатору на роль, INDICATOR_SEMANTIC + индекс в SEMANTIC_KINDS
+INDICATOR_SEMANTIC = 11
+
+DIAGNOSTICS_DELAY_MS = 600
+# Семантические токены хранятся и раскрашиваются блоками строк; раскрашивается видимая часть с запасом
+SEMANTIC_BLOCK_LINES = 64
+SEMANTIC_MARGIN_LINES = 100
+STALL_THRESHOLD_MS = 200
+
+# Встроенные AI-дополнения (ghost text): модель с поддержкой FIM (поле suffix в /api/generate)
+COMPLETION_MODEL = os.environ.get("MINICRUSOR_COMPLETION_MODEL", "qwen2.5-coder:1.5b")
+COMPLETION_DELAY_MS = 250
+COMPLETION_MAX_LATENCY_MS = 1500
+COMPLETION_PREFIX_LINES = 80
+COMPLETION_SUFFIX_LINES = 20
+COMPLETION_CACHE_SIZE = 32
+
+def normalize_host(host):
+    # Тот же формат, что и у самой Ollama: "host", "host:port" или полный URL
+    from urllib.parse import urlsplit
+    if "://" not in host:
+        host = "http://" + host
+    parts = urlsplit(host)
+    netloc = parts.netloc if parts.port else f"{parts.hostname}:11434"
+    return f"{parts.scheme}://{netloc}{parts.path}".rstrip("/")
+
+def ollama_host():
+    return normalize_host(os.environ.get("OLLAMA_HOST", "").strip() or "localhost:11434")
+
+# --- Замер фаз запуска (--profile-startup) ---
+class StartupProfile:
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.enabled = False
+        self.last = STARTUP_T0
+        self.phases = []
+        self.pending = set()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last, now - STARTUP_T0))
+        self.last = now
+
+    def expect(self, *phases):
+        # Фазы, которые завершатся асинхронно; отчёт печатается, когда закончится последняя
+        self.pending.update(phases)
+
+    def done(self, phase):
+        if phase not in self.pending:
+            return
+        self.pending.discard(phase)
+        self.mark(phase)
+        if not self.pending:
+            self.report()
+
+    def report(self):
+        if not self.enabled:
+            return
+        lines = ["[Запуск] фаза                        длительность, мс   с начала, мс"]
+        for phase, duration, total in self.phases:
+            lines.append(f"[Запуск] {phase:32} {duration * 1000:10.1f} {total * 1000:14.1f}")
+        sys.stderr.write("\n".join(lines) + "\n")
+
+# --- Цветовая схема One Dark по ролям токенов ---
+ONE_DARK = {
+    "paper": "#282c34",
+    "default": "#abb2bf",
+    "comment": "#5c6370",
+    "number": "#d19a66",
+    "keyword": "#c678dd",
+    "string": "#98c379",
+    "class": "#e5c07b",
+    "function": "#61afef",
+    "operator": "#56b6c2",
+    "identifier": "#abb2bf",
+    "decorator": "#d19a66",
+    "error": "#e06c75",
+    "error_paper": "#3a2426",
+}
+
+# Цвета семантических ролей имён; накладываются поверх цветов лексера
+SEMANTIC_KINDS = ("parameter", "local", "global", "imported", "attribute", "unresolved")
+SEMANTIC_COLORS = {
+    "parameter": "#d19a66",
+    "local": "#c8ccd4",
+    "global": "#e5c07b",
+    "imported": "#56b6c2",
+    "attribute": "#e06c75",
+    "unresolved": "#be5046",
+}
+
+# Для каждого языка: класс лексера, расширения файлов, базовый набор слов для
+# автодополнения и соответствие ролей темы стилям лексера. Стили, которых нет
+# в установленной версии QScintilla, просто пропускаются.
+LANGUAGES = {
+    "python": {
+        "lexer": "QsciLexerPython",
+        "extensions": (".py", ".pyw", ".pyi"),
+        "words": sorted(set(keyword.kwlist) | {n for n in dir(builtins) if not n.startswith("_")}),
+        "styles": {
+            "default": ("Default",),
+            "comment": ("Comment", "CommentBlock"),
+            "number": ("Number",),
+            "keyword": ("Keyword",),
+            "string": ("DoubleQuotedString", "SingleQuotedString", "TripleSingleQuotedString",
+                       "TripleDoubleQuotedString", "DoubleQuotedFString", "SingleQuotedFString",
+                       "TripleSingleQuotedFString", "TripleDoubleQuotedFString"),
+            "class": ("ClassName",),
+            "function": ("FunctionMethodName",),
+            "operator": ("Operator",),
+            "identifier": ("Identifier",),
+            "decorator": ("Decorator",),
+            "error": ("UnclosedString",),
+        },
+    },
+    "javascript": {
+        "lexer": "QsciLexerJavaScript",
+        "extensions": (".js", ".mjs", ".cjs", ".ts"),
+        "words": ["function", "return", "const", "let", "var", "class", "import", "export",
+                  "async", "await", "if", "else", "for", "while", "switch", "case", "break"],
+        "styles": {
+            "default": ("Default",),
+            "comment": ("Comment", "CommentLine", "CommentDoc", "CommentLineDoc"),
+            "number": ("Number",),
+            "keyword": ("Keyword",),
+            "string": ("DoubleQuotedString", "SingleQuotedString", "RawString"),
+            "operator": ("Operator",),
+            "identifier": ("Identifier",),
+            "class": ("GlobalClass",),
+            "error": ("UnclosedString",),
+        },
+    },
+    "cpp": {
+        "lexer": "QsciLexerCPP",
+        "extensions": (".c", ".h", ".cpp", ".hpp", ".cc", ".cxx"),
+        "words": ["include", "define", "struct", "class", "return", "const", "static",
+                  "void", "int", "char", "if", "else", "for", "while", "switch", "case"],
+        "styles": {
+            "default": ("Default",),
+            "comment": ("Comment", "CommentLine", "CommentDoc", "CommentLineDoc"),
+            "number": ("Number",),
+            "keyword": ("Keyword",),
+            "string": ("DoubleQuotedString", "SingleQuotedString", "RawString"),
+            "operator": ("Operator",),
+            "identifier": ("Identifier",),
+            "decorator": ("PreProcessor",),
+            "class": ("GlobalClass",),
+            "error": ("UnclosedString",),
+        },
+    },
+    "html": {
+        "lexer": "QsciLexerHTML",
+        "extensions": (".html", ".htm", ".xml", ".svg"),
+        "words": [],
+        "styles": {
+            "default": ("Default", "Text"),
+            "comment": ("HTMLComment",),
+            "number": ("HTMLNumber",),
+            "keyword": ("Tag",),
+            "string": ("HTMLDoubleQuotedString", "HTMLSingleQuotedString"),
+            "function": ("Attribute",),
+            "operator": ("Entity",),
+            "error": ("UnknownTag", "UnknownAttribute"),
+        },
+    },
+    "css": {
+        "lexer": "QsciLexerCSS",
+        "extensions": (".css", ".qss"),
+        "words": [],
+        "styles": {
+            "default": ("Default",),
+            "comment": ("Comment",),
+            "keyword": ("Tag", "CSS1Property", "CSS2Property", "CSS3Property"),
+            "string": ("DoubleQuotedString", "SingleQuotedString", "Value"),
+            "class": ("ClassSelector", "IDSelector"),
+            "operator": ("Operator",),
+            "error": ("UnknownProperty",),
+        },
+    },
+    "json": {
+        "lexer": "QsciLexerJSON",
+        "extensions": (".json",),
+        "words": ["true", "false", "null"],
+        "styles": {
+            "default": ("Default",),
+            "comment": ("CommentLine", "CommentBlock"),
+            "number": ("Number",),
+            "keyword": ("Keyword", "Property"),
+            "string": ("String",),
+            "operator": ("Operator",),
+            "error": ("UnclosedString", "Error"),
+        },
+    },
+    "markdown": {
+        "lexer": "QsciLexerMarkdown",
+        "extensions": (".md", ".markdown"),
+        "words": [],
+        "styles": {
+            "default": ("Default",),
+            "keyword": ("Header1", "Header2", "Header3", "Header4", "Header5", "Header6"),
+            "string": ("CodeBackticks", "CodeDoubleBackticks", "CodeBlock"),
+            "function": ("Link",),
+            "operator": ("UnorderedListItem", "OrderedListItem", "BlockQuote"),
+            "class": ("StrongEmphasisAsterisks", "StrongEmphasisUnderscores"),
+        },
+    },
+    "bash": {
+        "lexer": "QsciLexerBash",
+        "extensions": (".sh", ".bash"),
+        "words": ["if", "then", "else", "fi", "for", "do", "done", "case", "esac", "function", "export"],
+        "styles": {
+            "default": ("Default",),
+            "comment": ("Comment",),
+            "number": ("Number",),
+            "keyword": ("Keyword",),
+            "string": ("DoubleQuotedString", "SingleQuotedString"),
+            "operator": ("Operator",),
+            "identifier": ("Identifier", "Scalar", "ParameterExpansion"),
+            "error": ("Error",),
+        },
+    },
+    "yaml": {
+        "lexer": "QsciLexerYAML",
+        "extensions": (".yml", ".yaml"),
+        "words": [],
+        "styles": {
+            "default": ("Default",),
+            "comment": ("Comment",),
+            "number": ("Number",),
+            "keyword": ("Keyword", "Identifier"),
+            "operator": ("Operator", "DocumentDelimiter"),
+            "string": ("TextBlockMarker",),
+            "error": ("SyntaxErrorMarker",),
+        },
+    },
+    "sql": {
+        "lexer": "QsciLexerSQL",
+        "extensions": (".sql",),
+        "words": [],
+        "styles": {
+            "default": ("Default",),
+            "comment": ("Comment", "CommentLine", "CommentDoc"),
+            "number": ("Number",),
+            "keyword": ("Keyword",),
+            "string": ("DoubleQuotedString", "SingleQuotedString"),
+            "operator": ("Operator",),
+            "identifier": ("Identifier",),
+        },
+    },
+}
+
+EXTENSION_LANGUAGES = {ext: language for language, spec in LANGUAGES.items() for ext in spec["extensions"]}
+
+# Лексеры, тема и базовые API создаются один раз на язык и разделяются всеми вкладками
+class LanguageRegistry:
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.font = QFont("Consolas", 12)
+        self.lexers = {}
+        self.apis = {}
+
+    @staticmethod
+    def language_for(path):
+        if not path:
+            return "python"
+        ext = os.path.splitext(path)[1].lower()
+        return EXTENSION_LANGUAGES.get(ext)
+
+    def lexer(self, language):
+        if language in self.lexers:
+            return self.lexers[language]
+        spec = LANGUAGES.get(language)
+        lexer_cls = getattr(Qsci, spec["lexer"], None) if spec else None
+        lexer = lexer_cls() if lexer_cls else None
+        if lexer is not None:
+            self._apply_theme(lexer, spec["styles"])
+            api = QsciAPIs(lexer)
+            for word in spec["words"]:
+                api.add(word)
+            api.prepare()
+            self.apis[language] = api
+        self.lexers[language] = lexer
+        return lexer
+
+    def _apply_theme(self, lexer, styles):
+        lexer.setDefaultFont(self.font)
+        lexer.setDefaultPaper(QColor(ONE_DARK["paper"]))
+        lexer.setDefaultColor(QColor(ONE_DARK["default"]))
+        paper_color = QColor(ONE_DARK["paper"])
+        for style in range(128):
+            lexer.setPaper(paper_color, style)
+            lexer.setColor(QColor(ONE_DARK["default"]), style)
+        lexer_cls = type(lexer)
+        for role, names in styles.items():
+            for name in names:
+                style = getattr(lexer_cls, name, None)
+                if style is None:
+                    continue
+                lexer.setColor(QColor(ONE_DARK[role]), style)
+                if name == "UnclosedString":
+                    lexer.setEolFill(True, style)
+                    lexer.setPaper(QColor(ONE_DARK["error_paper"]), style)
+
+
+# --- Диагностика: выполняется только в отдельном процессе ---
+def _char_col(line_text, byte_col):
+    # ast отдаёт смещения в байтах UTF-8, редактору нужны символы
+    return len(line_text.encode("utf-8")[:byte_col].decode("utf-8", errors="ignore"))
+
+def _simple_flakes(tree, lines):
+    bound = set(dir(builtins)) | {"__file__", "__name__", "__doc__", "__builtins__", "__spec__"}
+    imports = {}
+    loaded = set()
+    has_star_import = False
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    has_star_import = True
+                    continue
+                name = alias.asname or alias.name.split(".")[0]
+                bound.add(name)
+                imports.setdefault(name, node)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                bound.add(node.id)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            bound.update(node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+        elif type(node).__name__ in ("MatchAs", "MatchStar") and getattr(node, "name", None):
+            bound.add(node.name)
+        elif type(node).__name__ == "MatchMapping" and getattr(node, "rest", None):
+            bound.add(node.rest)
+
+    # Имена из __all__ считаются использованными
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "__all__" for t in node.targets)
+                and isinstance(node.value, (ast.List, ast.Tuple))):
+            loaded.update(e.value for e in node.value.elts if isinstance(e, ast.Constant) and isinstance(e.value, str))
+
+    diagnostics = []
+    if not has_star_import:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in bound:
+                line = node.lineno - 1
+                text = lines[line] if line < len(lines) else ""
+                col = _char_col(text, node.col_offset)
+                diagnostics.append((line, col, col + len(node.id), "error", f"Неопределённое имя '{node.id}'"))
+    for name, node in imports.items():
+        if name not in loaded:
+            line = node.lineno - 1
+            text = lines[line] if line < len(lines) else ""
+            col = _char_col(text, node.col_offset)
+            diagnostics.append((line, col, len(text), "warning", f"'{name}' импортирован, но не используется"))
+    return diagnostics
+
+def check_source(source):
+    lines = source.splitlines()
+    try:
+        tree = ast.parse(source)
+        compile(tree, "<buffer>", "exec")
+    except SyntaxError as e:
+        line = max((e.lineno or 1) - 1, 0)
+        col = max((e.offset or 1) - 1, 0)
+        return [(line, col, col + 1, "error", f"Синтаксическая ошибка: {e.msg}")]
+    except ValueError as e:
+        return [(0, 0, 1, "error", f"Ошибка разбора: {e}")]
+
+    try:
+        from pyflakes import checker, messages
+    except ImportError:
+        return _simple_flakes(tree, lines)
+
+    diagnostics = []
+    for m in checker.Checker(tree, filename="<buffer>").messages:
+        line = m.lineno - 1
+        text = lines[line] if 0 <= line < len(lines) else ""
+        col = _char_col(text, getattr(m, "col", 0) or 0)
+        severity = "error" if isinstance(m, messages.UndefinedName) else "warning"
+        end = col + len(m.message_args[0]) if m.message_args and isinstance(m.message_args[0], str) else len(text)
+        diagnostics.append((line, col, max(end, col + 1), severity, m.message % m.message_args))
+    return diagnostics
+
+SCOPE_NODES = {
+    ast.FunctionDef: None, ast.AsyncFunctionDef: None, ast.ClassDef: None, ast.Lambda: "lambda",
+    ast.ListComp: "listcomp", ast.SetComp: "setcomp", ast.DictComp: "dictcomp", ast.GeneratorExp: "genexpr",
+}
+
+def _scope_parts(node):
+    # Что вычисляется во внешней области (декораторы, значения по умолчанию, аннотации, базовые классы,
+    # первый итератор генератора), а что — внутри новой
+    if isinstance(node, ast.ClassDef):
+        return node.decorator_list + node.bases + node.keywords, node.body
+    if isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+        first = node.generators[0]
+        inner = [first.target] + first.ifs + node.generators[1:]
+        inner += [node.key, node.value] if isinstance(node, ast.DictComp) else [node.elt]
+        return [first.iter], inner
+    args = node.args
+    params = args.posonlyargs + args.args + args.kwonlyargs + [a for a in (args.vararg, args.kwarg) if a]
+    outer = args.defaults + [d for d in args.kw_defaults if d is not None]
+    if isinstance(node, ast.Lambda):
+        return outer, params + [node.body]
+    outer += node.decorator_list + [a.annotation for a in params if a.annotation] + ([node.returns] if node.returns else [])
+    return outer, params + node.body
+
+def _semantic_role(name, scopes, known_globals, builtin_names):
+    nested = False
+    for table in reversed(scopes):
+        kind = table.get_type()
+        # Тело класса не видно из вложенных функций
+        if kind == "class" and nested:
+            continue
+        try:
+            symbol = table.lookup(name)
+        except KeyError:
+            nested = True
+            continue
+        if symbol.is_parameter():
+            return "parameter"
+        if symbol.is_imported():
+            return "imported"
+        if kind == "module" or symbol.is_global() or symbol.is_declared_global():
+            break
+        if symbol.is_local():
+            return None if symbol.is_namespace() else "local"
+        nested = True
+    try:
+        symbol = scopes[0].lookup(name)
+    except KeyError:
+        symbol = None
+    if symbol is not None and symbol.is_imported():
+        return "imported"
+    if symbol is not None and symbol.is_assigned() or name in known_globals:
+        return None if symbol is not None and symbol.is_namespace() else "global"
+    return None if name in builtin_names else "unresolved"
+
+def semantic_tokens(source, block_lines=SEMANTIC_BLOCK_LINES):
+    """Роли имён по ast и symtable: {блок строк: [(строка, байт в строке, длина в байтах, индекс роли)]}.
+    None — текст не разбирается, прежняя раскраска остаётся."""
+    import symtable
+    try:
+        tree = ast.parse(source)
+        module = symtable.symtable(source, "<buffer>", "exec")
+    except (SyntaxError, ValueError, RecursionError):
+        return None
+
+    builtin_names = set(dir(builtins)) | {"__file__", "__name__", "__doc__", "__builtins__", "__spec__"}
+    # Имена, объявленные global внутри функций, в таблице модуля могут отсутствовать
+    known_globals = {name.strip() for names in re.findall(r"^\s*global\s+([\w \t,]+)", source, re.M)
+                     for name in names.split(",")}
+    star_import = re.search(r"^\s*from\s+\S+\s+import\s+\*", source, re.M) is not None
+
+    children = {}
+    def child_table(table, node):
+        # Дочерние таблицы одной строки с одним именем (несколько lambda) идут в порядке исходника
+        if table not in children:
+            groups = children[table] = {}
+            for child in table.get_children():
+                groups.setdefault((child.get_name(), child.get_lineno()), []).append(child)
+        group = children[table].get((getattr(node, "name", None) or SCOPE_NODES[type(node)], node.lineno))
+        return group.pop(0) if group else None
+
+    blocks = {}
+    def add(line, col, length, role):
+        if role is None or role == "unresolved" and star_import:
+            return
+        blocks.setdefault((line - 1) // block_lines, []).append((line - 1, col, length, SEMANTIC_KINDS.index(role)))
+
+    # Обход в порядке исходника; в стеке — узел, цепочка таблиц областей и имя self текущего метода
+    stack = [(tree, (module,), None)]
+    while stack:
+        node, scopes, self_name = stack.pop()
+        nested = []
+        if type(node) in SCOPE_NODES:
+            table = child_table(scopes[-1], node)
+            outer, inner = _scope_parts(node)
+            if table is None:
+                # Встроенные генераторы (PEP 709) своей таблицы не имеют
+                nested = [(n, scopes, self_name) for n in outer + inner]
+            else:
+                inner_self = self_name
+                if scopes[-1].get_type() == "class" and isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    positional = node.args.posonlyargs + node.args.args
+                    inner_self = positional[0].arg if positional else None
+                nested = [(n, scopes, self_name) for n in outer] + [(n, scopes + (table,), inner_self) for n in inner]
+        else:
+            if isinstance(node, ast.Name):
+                add(node.lineno, node.col_offset, node.end_col_offset - node.col_offset,
+                    _semantic_role(node.id, scopes, known_globals, builtin_names))
+            elif isinstance(node, ast.arg):
+                add(node.lineno, node.col_offset, len(node.arg.encode("utf-8")), "parameter")
+            elif (isinstance(node, ast.Attribute) and self_name and isinstance(node.value, ast.Name)
+                  and node.value.id == self_name):
+                length = len(node.attr.encode("utf-8"))
+                add(node.end_lineno, node.end_col_offset - length, length, "attribute")
+            elif isinstance(node, ast.alias) and hasattr(node, "lineno") and node.name != "*":
+                if node.asname:
+                    length = len(node.asname.encode("utf-8"))
+                    add(node.end_lineno, node.end_col_offset - length, length, "imported")
+                else:
+                    add(node.lineno, node.col_offset, len(node.name.split(".")[0].encode("utf-8")), "imported")
+            nested = [(n, scopes, self_name) for n in ast.iter_child_nodes(node)]
+        stack.extend(reversed(nested))
+    return blocks
+
+class DiagnosticsEngine(QObject):
+    ready = pyqtSignal(object, int, object)
+    # Завершение задачи из служебного потока пула переносится в GUI-поток; pending трогает только он
+    done = pyqtSignal(object, int, object)
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        super().__init__()
+        self.executor = None
+        self.pending = {}
+        self.done.connect(self._on_done)
+
+    def submit(self, key, generation, source, func=check_source):
+        from concurrent.futures import ProcessPoolExecutor
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=1)
+        # Запрос, который ещё не начал выполняться, уже устарел
+        previous = self.pending.pop(key, None)
+        if previous is not None:
+            previous.cancel()
+        future = self.executor.submit(func, source)
+        self.pending[key] = future
+        future.add_done_callback(lambda f: self.done.emit(key, generation, f))
+
+    def _on_done(self, key, generation, future):
+        if future.cancelled():
+            return
+        if self.pending.get(key) is future:
+            self.pending.pop(key, None)
+        try:
+            diagnostics = future.result()
+        except Exception:
+            from concurrent.futures.process import BrokenProcessPool
+            if isinstance(future.exception(), BrokenProcessPool):
+                self.executor = None
+            return
+        self.ready.emit(key, generation, diagnostics)
+
+    def forget(self, key):
+        future = self.pending.pop(key, None)
+        if future is not None:
+            future.cancel()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+# --- Изменения относительно HEAD в git ---
+GIT_TIMEOUT_S = 10
+# Меньше этого числа помеченных строк маркеры перерисовываются целиком, больше — только в изменённом окне
+GIT_FULL_APPLY_LINES = 2000
+
+def git_head_lines(path):
+    """(каталог .git, строки файла в HEAD). Строк нет, если файл не в репозитории или не закоммичен.
+    Два вызова git, не зависящие от длины истории и размера рабочей копии."""
+    directory, name = os.path.split(os.path.abspath(path))
+    env = dict(os.environ, GIT_OPTIONAL_LOCKS="0")
+    try:
+        info = subprocess.run(["git", "-C", directory, "rev-parse", "--absolute-git-dir", "--show-prefix"],
+                              capture_output=True, text=True, timeout=GIT_TIMEOUT_S, env=env)
+        if info.returncode:
+            return None, None
+        git_dir, prefix = (info.stdout.splitlines() + [""])[:2]
+        blob = subprocess.run(["git", "-C", directory, "cat-file", "blob", f"HEAD:{prefix}{name}"],
+                              capture_output=True, timeout=GIT_TIMEOUT_S, env=env)
+    except (OSError, subprocess.TimeoutExpired):
+        return None, None
+    if blob.returncode:
+        return git_dir, None
+    return git_dir, blob.stdout.decode("utf-8", "replace").splitlines()
+
+def _git_stamp(git_dir):
+    # Коммит, checkout и reset меняют хотя бы один из этих файлов
+    stamp = []
+    for name in ("HEAD", os.path.join("logs", "HEAD"), "index"):
+        try:
+            stamp.append(os.stat(os.path.join(git_dir, name)).st_mtime_ns)
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+def _common_prefix(a, b, limit):
+    # Срезы сравниваются блоками на стороне C, по одной строке — только внутри последнего блока
+    n = 0
+    step = 1024
+    while n + step <= limit and a[n:n + step] == b[n:n + step]:
+        n += step
+    while n < limit and a[n] == b[n]:
+        n += 1
+    return n
+
+def _common_suffix(a, b, limit):
+    n = 0
+    step = 1024
+    while n + step <= limit and a[len(a) - n - step:len(a) - n] == b[len(b) - n - step:len(b) - n]:
+        n += step
+    while n < limit and a[len(a) - n - 1] == b[len(b) - n - 1]:
+        n += 1
+    return n
+
+def update_hunks(base, old, hunks, new):
+    """Пересчёт различий base→new, зная различия base→old. Сравнивается заново только окно,
+    где old и new расходятся, расширенное до задетых им старых фрагментов.
+    Фрагмент — (начало, конец) в new и (начало, конец) в base. Возвращает (фрагменты, окно в new)."""
+    from difflib import SequenceMatcher
+    limit = min(len(old), len(new))
+    prefix = _common_prefix(old, new, limit)
+    suffix = _common_suffix(old, new, limit - prefix)
+    start, end = prefix, len(old) - suffix
+    before, after = [], []
+    offset = 0
+    merged = 0
+    for hunk in hunks:
+        c0, c1, b0, b1 = hunk
+        if c1 < start:
+            before.append(hunk)
+            offset += (b1 - b0) - (c1 - c0)
+        elif c0 > end:
+            after.append(hunk)
+        else:
+            start, end = min(start, c0), max(end, c1)
+            merged += (b1 - b0) - (c1 - c0)
+    # Вне фрагментов строки old и base совпадают, поэтому границы окна в base известны точно
+    base_start, base_end = start + offset, end + offset + merged
+    shift = len(new) - len(old)
+    new_end = end + shift
+    middle = []
+    matcher = SequenceMatcher(None, base[base_start:base_end], new[start:new_end], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            middle.append((start + j1, start + j2, base_start + i1, base_start + i2))
+    after = [(c0 + shift, c1 + shift, b0, b1) for c0, c1, b0, b1 in after]
+    return before + middle + after, (start, new_end)
+
+class GitGutterEngine(QObject):
+    # Один служебный поток: задания одного редактора выполняются по порядку, состояние — только в нём
+    ready = pyqtSignal(object, int, object)
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        super().__init__()
+        self.executor = None
+        # путь -> (отметка .git, каталог .git, строки HEAD); HEAD читается один раз на файл
+        self.bases = {}
+        # ключ редактора -> (путь, строки HEAD, последний снимок текста, фрагменты)
+        self.states = {}
+
+    def submit(self, key, generation, path, text):
+        from concurrent.futures import ThreadPoolExecutor
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        self.executor.submit(self._diff, key, generation, path, text)
+
+    def forget(self, key):
+        if self.executor is None:
+            return
+        try:
+            self.executor.submit(self.states.pop, key, None)
+        except RuntimeError:
+            # Пул уже остановлен при выходе интерпретатора — забывать некому
+            pass
+
+    def _base(self, path):
+        cached = self.bases.get(path)
+        if cached is not None:
+            stamp, git_dir, lines = cached
+            if git_dir is None or _git_stamp(git_dir) == stamp:
+                return lines
+        git_dir, lines = git_head_lines(path)
+        self.bases[path] = (_git_stamp(git_dir) if git_dir else None, git_dir, lines)
+        return lines
+
+    def _diff(self, key, generation, path, text):
+        try:
+            base = self._base(path)
+            if base is None:
+                self.states.pop(key, None)
+                self.ready.emit(key, generation, None)
+                return
+            lines = text.splitlines()
+            state = self.states.get(key)
+            reset = state is None or state[0] != path or state[1] is not base
+            if reset:
+                # Новый файл или новый HEAD: отсчёт от самой версии HEAD, различий пока нет
+                state = (path, base, base, [])
+            hunks, window = update_hunks(base, state[2], state[3], lines)
+            self.states[key] = (path, base, lines, hunks)
+            self.ready.emit(key, generation, (hunks, window, reset))
+        except Exception:
+            traceback.print_exc()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+# --- Сторож зависаний GUI-потока ---
+def _frame_depth(frame):
+    depth = 0
+    while frame.f_back is not None:
+        frame = frame.f_back
+        depth += 1
+    return depth
+
+class StallWatchdog(QObject):
+    stall_detected = pyqtSignal(dict)
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        super().__init__()
+        self.threshold = STALL_THRESHOLD_MS / 1000
+        self.heartbeat = time.perf_counter()
+        self.last_event = None
+        self.loop_sites = set()
+        self.records = {}
+        self.running = False
+        self.thread = None
+        self.gui_ident = threading.get_ident()
+        self.event_names = {int(v): k for k, v in vars(QEvent).items() if isinstance(v, QEvent.Type)}
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self._beat)
+        self.stall_detected.connect(self._record)
+
+    def is_running(self):
+        return self.running
+
+    def start(self, threshold_ms=None):
+        if self.running:
+            return
+        if threshold_ms:
+            self.threshold = threshold_ms / 1000
+        self.gui_ident = threading.get_ident()
+        self.heartbeat = time.perf_counter()
+        self.timer.start(max(10, int(self.threshold * 1000 / 4)))
+        QApplication.instance().installEventFilter(self)
+        self.running = True
+        self.thread = threading.Thread(target=self._watch, name="stall-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.timer.stop()
+        QApplication.instance().removeEventFilter(self)
+        self.thread.join()
+        self.thread = None
+
+    def _beat(self):
+        self.heartbeat = time.perf_counter()
+
+    def eventFilter(self, obj, event):
+        # Фильтр вызывает сам цикл событий: ближайший Python-кадр — тот, что крутит цикл (exec_/processEvents)
+        loop = sys._getframe(1)
+        self.loop_sites.add((loop.f_code, loop.f_lineno, _frame_depth(loop)))
+        # Запоминаем последнее доставленное событие: если цикл встанет, виновато оно
+        if obj is not self.timer:
+            self.last_event = (event.type(), type(obj).__name__, obj.objectName())
+        return False
+
+    def _watch(self):
+        poll = self.threshold / 4
+        stall = None
+        while self.running:
+            time.sleep(poll)
+            lag = time.perf_counter() - self.heartbeat
+            if lag > self.threshold:
+                if stall is None:
+                    stall = self._capture()
+                stall["duration_ms"] = lag * 1000
+            elif stall is not None:
+                self.stall_detected.emit(stall)
+                stall = None
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.gui_ident)
+        stack = traceback.format_stack(frame) if frame is not None else []
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+        # Слот — кадр, вызванный из цикла событий Qt самого глубокого уровня: цикл узнаём по месту,
+        # откуда ранее доставлялись события; если такого нет, берём первый кадр после main() и модуля
+        culprit = None
+        for depth, (parent, f) in enumerate(zip(frames, frames[1:])):
+            if (parent.f_code, parent.f_lineno, depth) in self.loop_sites:
+                culprit = f
+        if culprit is None:
+            culprit = next((f for f in frames if f.f_code.co_name not in ("main", "<module>")), None)
+        slot = "?"
+        if culprit is not None:
+            slot = getattr(culprit.f_code, "co_qualname", None) or culprit.f_code.co_name
+            slot = f"{slot} ({os.path.basename(culprit.f_code.co_filename)}:{culprit.f_lineno})"
+        event = "?"
+        if self.last_event:
+            event_type, cls_name, obj_name = self.last_event
+            event_name = self.event_names.get(int(event_type), str(int(event_type)))
+            event = f"{event_name} → {cls_name}" + (f" '{obj_name}'" if obj_name else "")
+        return {"slot": slot, "event": event, "stack": "".join(stack), "duration_ms": 0.0}
+
+    def _record(self, stall):
+        record = self.records.setdefault(stall["slot"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        record["count"] += 1
+        record["total_ms"] += stall["duration_ms"]
+        if stall["duration_ms"] >= record["max_ms"]:
+            record.update(max_ms=stall["duration_ms"], event=stall["event"], stack=stall["stack"])
+        sys.stderr.write(f"[Зависание] {stall['duration_ms']:.0f} мс в {stall['slot']} "
+                         f"(событие: {stall['event']})\n{stall['stack']}")
+
+    def worst(self):
+        return sorted(self.records.items(), key=lambda item: item[1]["max_ms"], reverse=True)
+
+class StallReportDialog(QDialog):
+    def __init__(self, watchdog, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Зависания интерфейса")
+        self.resize(900, 520)
+        self.entries = watchdog.worst()
+
+        self.table = QTableWidget(len(self.entries), 5)
+        self.table.setHorizontalHeaderLabels(["Слот", "Событие", "Раз", "Макс, мс", "Всего, мс"])
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        for row, (slot, record) in enumerate(self.entries):
+            values = [slot, record.get("event", ""), str(record["count"]),
+                      f"{record['max_ms']:.0f}", f"{record['total_ms']:.0f}"]
+            for col, value in enumerate(values):
+                self.table.setItem(row, col, QTableWidgetItem(value))
+        self.table.currentCellChanged.connect(self.show_stack)
+
+        self.stack = QPlainTextEdit()
+        self.stack.setReadOnly(True)
+        self.stack.setFont(QFont("Consolas", 10))
+        if not self.entries:
+            self.stack.setPlainText("Зависаний не зафиксировано." if watchdog.is_running()
+                                    else "Сторож зависаний выключен (Сервис → Сторож зависаний или --watchdog).")
+
+        layout = QVBoxLayout(self)
+        splitter = QSplitter(Qt.Vertical)
+        splitter.addWidget(self.table)
+        splitter.addWidget(self.stack)
+        layout.addWidget(splitter)
+        if self.entries:
+            self.table.setCurrentCell(0, 0)
+
+    def show_stack(self, row, *_):
+        if 0 <= row < len(self.entries):
+            self.stack.setPlainText(self.entries[row][1].get("stack", ""))
 
 class ExpandingTextEdit(QTextEdit):
     def __init__(self, parent=None):
@@ -70,52 +985,214 @@ class ExpandingTextEdit(QTextEdit):
             
         return QSize(super().sizeHint().width(), int(h))
 
+class InlineCompleter(QObject):
+    enabled = False
+    # Отменённые запросы дорабатывают в фоне; ссылки держатся до finished
+    running = set()
+
+    def __init__(self, editor):
+        super().__init__(editor)
+        self.editor = editor
+        self.generation = 0
+        self.worker = None
+        self.request_prefix = None
+        self.cache = []
+        self.ghost = ""
+        self.ghost_prefix = None
+        self.ghost_pos = None
+        self.ghost_line = -1
+        self.edit_pending = False
+
+        self.label = QLabel(editor.viewport())
+        self.label.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.label.setStyleSheet("color: #5c6370; background: transparent; padding: 0; border: none;")
+        self.label.hide()
+        self.ghost_style = QsciStyle(-1, "ghost", QColor("#5c6370"), QColor(ONE_DARK["paper"]), editor.font())
+        editor.setAnnotationDisplay(QsciScintilla.AnnotationStandard)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(COMPLETION_DELAY_MS)
+        self.timer.timeout.connect(self.request)
+        self.edit_timer = QTimer(self)
+        self.edit_timer.setSingleShot(True)
+        self.edit_timer.setInterval(0)
+        self.edit_timer.timeout.connect(self._after_edit)
+
+        editor.textChanged.connect(self._on_text_changed)
+        editor.cursorPositionChanged.connect(self._on_cursor_moved)
+        editor.verticalScrollBar().valueChanged.connect(lambda _: self._place_label())
+        editor.horizontalScrollBar().valueChanged.connect(lambda _: self._place_label())
+
+    def visible(self):
+        return bool(self.ghost)
+
+    def _context(self):
+        line, index = self.editor.getCursorPosition()
+        text = self.editor.text(line)
+        before, after = text[:index], text[index:]
+        first = max(0, line - COMPLETION_PREFIX_LINES)
+        prefix = "".join(self.editor.text(i) for i in range(first, line)) + before
+        last = min(self.editor.lines(), line + 1 + COMPLETION_SUFFIX_LINES)
+        suffix = after + "".join(self.editor.text(i) for i in range(line + 1, last))
+        return prefix, suffix, after
+
+    def _on_text_changed(self):
+        if not self.enabled:
+            return
+        # Позиция курсора обновится после сигнала; разбираем правку на следующем проходе цикла
+        self.edit_pending = True
+        self.edit_timer.start()
+
+    def _on_cursor_moved(self, line, index):
+        if not self.edit_pending and self.ghost and (line, index) != self.ghost_pos:
+            self.dismiss()
+
+    def _after_edit(self):
+        self.edit_pending = False
+        self.cancel()
+        prefix, _, after = self._context()
+        if after.strip() or self.editor.isListActive():
+            self.dismiss()
+            return
+        completion = self._lookup(prefix)
+        if completion:
+            self.show(prefix, completion)
+            return
+        self.dismiss()
+        self.timer.start()
+
+    def _lookup(self, prefix):
+        # Кэш по префиксу: если набранные символы совпадают с началом подсказки, показываем остаток
+        for i, (cached_prefix, completion) in enumerate(self.cache):
+            tail = cached_prefix[-200:]
+            window = prefix[-(len(completion) + len(tail)):]
+            pos = window.rfind(tail)
+            if pos < 0:
+                continue
+            typed = window[pos + len(tail):]
+            if len(typed) < len(completion) and completion.startswith(typed):
+                self.cache.append(self.cache.pop(i))
+                return completion[len(typed):]
+        return None
+
+    def request(self):
+        if not self.enabled or self.editor.isListActive():
+            return
+        prefix, suffix, after = self._context()
+        if after.strip() or not prefix.strip():
+            return
+        self.cancel()
+        self.generation += 1
+        self.request_prefix = prefix
+        worker = CompletionWorker(self.generation, prefix, suffix, COMPLETION_MODEL)
+        worker.result.connect(self._on_result)
+        # Отменённый поток ещё дорабатывает: ссылка держится до finished, иначе QThread удалится на ходу
+        InlineCompleter.running.add(worker)
+        worker.finished.connect(lambda w=worker: InlineCompleter.running.discard(w))
+        worker.finished.connect(worker.deleteLater)
+        self.worker = worker
+        worker.start()
+
+    def cancel(self):
+        self.timer.stop()
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        self.generation += 1
+
+    def _on_result(self, generation, completion, latency_ms):
+        # Опоздавшая или устаревшая подсказка хуже, чем никакой
+        if generation != self.generation or latency_ms > COMPLETION_MAX_LATENCY_MS:
+            return
+        completion = completion.rstrip()
+        if not completion.strip():
+            return
+        self.cache.append((self.request_prefix, completion))
+        del self.cache[:-COMPLETION_CACHE_SIZE]
+        prefix, _, _ = self._context()
+        if prefix == self.request_prefix:
+            self.show(prefix, completion)
+
+    def show(self, prefix, completion):
+        self._clear_display()
+        self.ghost = completion
+        self.ghost_prefix = prefix
+        self.ghost_pos = self.editor.getCursorPosition()
+        first, _, rest = completion.partition("\n")
+        self.label.setFont(self.editor.font())
+        self.label.setText(first)
+        self.label.adjustSize()
+        self._place_label()
+        if rest:
+            self.ghost_line = self.ghost_pos[0]
+            # Остальные строки подсказки — аннотацией под текущей строкой, она раздвигает текст
+            self.editor.annotate(self.ghost_line, rest, self.ghost_style)
+
+    def _place_label(self):
+        if not self.ghost:
+            return
+        pos = self.editor.SendScintilla(QsciScintilla.SCI_GETCURRENTPOS)
+        x = self.editor.SendScintilla(QsciScintilla.SCI_POINTXFROMPOSITION, 0, pos)
+        y = self.editor.SendScintilla(QsciScintilla.SCI_POINTYFROMPOSITION, 0, pos)
+        self.label.move(x, y)
+        self.label.setVisible(bool(self.label.text()) and 0 <= y < self.editor.viewport().height())
+
+    def _clear_display(self):
+        self.label.hide()
+        if self.ghost_line >= 0:
+            self.editor.clearAnnotations(self.ghost_line)
+            self.ghost_line = -1
+
+    def dismiss(self):
+        self.ghost = ""
+        self._clear_display()
+
+    def accept(self):
+        completion = self.ghost
+        self.dismiss()
+        self.cancel()
+        self.editor.insert(completion)
+        line, index = self.editor.getCursorPosition()
+        pos = self.editor.positionFromLineIndex(line, index) + len(completion.encode("utf-8"))
+        self.editor.SendScintilla(QsciScintilla.SCI_GOTOPOS, pos)
+
 class CodeEditor(QsciScintilla):
     modificationChanged = pyqtSignal(bool)
     code_submitted_for_ai = pyqtSignal(str)
+    # Ключи редакторов в фоновых движках не повторяются, в отличие от id() удалённых объектов
+    last_engine_key = 0
 
-    def __init__(self):
+    def __init__(self, language="python"):
         super().__init__()
         font = QFont("Consolas", 12)
         self.setFont(font)
         self.setMarginsFont(font)
 
-        self.lexer = QsciLexerPython()
-        self.lexer.setDefaultFont(font)
-
-        # --- Настройка цветов для синтаксиса Python (стиль One Dark) ---
-        paper_color = QColor("#282c34")
-        
-        # Устанавливаем фон для всех стилей
-        for style in range(128):
-            self.lexer.setPaper(paper_color, style)
-            
-        # Настраиваем цвета для конкретных токенов
-        self.lexer.setColor(QColor("#abb2bf"), QsciLexerPython.Default)
-        self.lexer.setColor(QColor("#5c6370"), QsciLexerPython.Comment)
-        self.lexer.setColor(QColor("#d19a66"), QsciLexerPython.Number)
-        self.lexer.setColor(QColor("#c678dd"), QsciLexerPython.Keyword)
-        self.lexer.setColor(QColor("#98c379"), QsciLexerPython.DoubleQuotedString)
-        self.lexer.setColor(QColor("#98c379"), QsciLexerPython.SingleQuotedString)
-        self.lexer.setColor(QColor("#e5c07b"), QsciLexerPython.ClassName)
-        self.lexer.setColor(QColor("#61afef"), QsciLexerPython.FunctionMethodName)
-        self.lexer.setColor(QColor("#56b6c2"), QsciLexerPython.Operator)
-        self.lexer.setColor(QColor("#abb2bf"), QsciLexerPython.Identifier)
-        self.lexer.setColor(QColor("#98c379"), QsciLexerPython.TripleSingleQuotedString)
-        self.lexer.setColor(QColor("#98c379"), QsciLexerPython.TripleDoubleQuotedString)
-        self.lexer.setColor(QColor("#d19a66"), QsciLexerPython.Decorator)
-        # Ошибки в строках
-        self.lexer.setColor(QColor("#e06c75"), QsciLexerPython.UnclosedString)
-        self.lexer.setEolFill(True, QsciLexerPython.UnclosedString)
-        self.lexer.setPaper(QColor("#3a2426"), QsciLexerPython.UnclosedString)
-        
-        self.setLexer(self.lexer)
-
-        self.api = QsciAPIs(self.lexer)
-        for kw in ["def", "class", "import", "from", "return", "if", "else", "elif",
-                   "for", "while", "try", "except", "with", "as", "pass", "break"]:
-            self.api.add(kw)
-        self.api.prepare()
+        CodeEditor.last_engine_key += 1
+        self.engine_key = CodeEditor.last_engine_key
+        self.diagnostics = {}
+        self.diagnostics_generation = 0
+        self.diagnostics_timer = QTimer(self)
+        self.diagnostics_timer.setSingleShot(True)
+        self.diagnostics_timer.setInterval(DIAGNOSTICS_DELAY_MS)
+        self.diagnostics_timer.timeout.connect(self.request_diagnostics)
+        DiagnosticsEngine.instance().ready.connect(self._on_diagnostics_ready)
+        self.destroyed.connect(lambda _=None, key=self.engine_key: DiagnosticsEngine.instance().forget(key))
+        self.destroyed.connect(lambda _=None, key=(self.engine_key, "semantic"):
+                               DiagnosticsEngine.instance().forget(key))
+        # Семантические токены текущего текста по блокам строк и уже раскрашенные блоки
+        self.semantic_blocks = None
+        self.semantic_painted = set()
+        self.SCN_UPDATEUI.connect(self.paint_semantic)
+        # Путь файла для сравнения с HEAD; несохранённая вкладка сравнивать не с чем
+        self.git_path = None
+        self.git_stale = True
+        GitGutterEngine.instance().ready.connect(self._on_git_ready)
+        self.destroyed.connect(lambda _=None, key=self.engine_key: GitGutterEngine.instance().forget(key))
+
+        self.language = None
+        self.set_language(language)
         self.setAutoCompletionSource(QsciScintilla.AcsAll)
         self.setAutoCompletionThreshold(1)
 
@@ -133,6 +1210,36 @@ class CodeEditor(QsciScintilla):
         self.markerDefine(QsciScintilla.Circle, MARKER_CLASS)
         self.setMarkerBackgroundColor(QColor("#0000AA"), MARKER_CLASS)
 
+        self.setMarginMarkerMask(1, (1 << MARKER_FUNC) | (1 << MARKER_CLASS))
+
+        # Маркеры и подчёркивания диагностики
+        self.setMarginType(2, QsciScintilla.SymbolMargin)
+        self.setMarginWidth(2, 10)
+        self.setMarginSensitivity(2, True)
+        self.setMarginMarkerMask(2, (1 << MARKER_ERROR) | (1 << MARKER_WARNING))
+        self.markerDefine(QsciScintilla.SmallRectangle, MARKER_ERROR)
+        self.setMarkerBackgroundColor(QColor("#e06c75"), MARKER_ERROR)
+        self.markerDefine(QsciScintilla.SmallRectangle, MARKER_WARNING)
+        self.setMarkerBackgroundColor(QColor("#e5c07b"), MARKER_WARNING)
+        self.indicatorDefine(QsciScintilla.SquiggleIndicator, INDICATOR_ERROR)
+        self.setIndicatorForegroundColor(QColor("#e06c75"), INDICATOR_ERROR)
+        self.indicatorDefine(QsciScintilla.SquiggleIndicator, INDICATOR_WARNING)
+        self.setIndicatorForegroundColor(QColor("#e5c07b"), INDICATOR_WARNING)
+
+        # Изменения относительно HEAD: добавленные, изменённые и удалённые строки
+        self.setMarginType(3, QsciScintilla.SymbolMargin)
+        self.setMarginWidth(3, 6)
+        self.setMarginMarkerMask(3, sum(1 << marker for marker in GIT_MARKERS))
+        for marker, symbol, color in ((MARKER_GIT_ADDED, QsciScintilla.FullRectangle, "#98c379"),
+                                      (MARKER_GIT_MODIFIED, QsciScintilla.FullRectangle, "#61afef"),
+                                      (MARKER_GIT_DELETED, QsciScintilla.RightTriangle, "#e06c75")):
+            self.markerDefine(symbol, marker)
+            self.setMarkerBackgroundColor(QColor(color), marker)
+            self.setMarkerForegroundColor(QColor(color), marker)
+        for index, kind in enumerate(SEMANTIC_KINDS):
+            self.indicatorDefine(QsciScintilla.TextColorIndicator, INDICATOR_SEMANTIC + index)
+            self.setIndicatorForegroundColor(QColor(SEMANTIC_COLORS[kind]), INDICATOR_SEMANTIC + index)
+
         self.marginClicked.connect(self.on_margin_clicked)
 
         self.setIndentationsUseTabs(False)
@@ -142,6 +1249,7 @@ class CodeEditor(QsciScintilla):
 
         self.modificationChanged.connect(self.modificationChanged.emit)
         self.textChanged.connect(self.update_markers)
+        self.textChanged.connect(self.schedule_diagnostics)
 
         self.update_markers()
 
@@ -165,6 +1273,41 @@ class CodeEditor(QsciScintilla):
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.show_context_menu)
 
+        self.completer = InlineCompleter(self)
+
+    def setText(self, text):
+        # Замена всего текста стирает все маркеры: следующий результат git рисуется целиком
+        self.git_stale = True
+        super().setText(text)
+
+    def keyPressEvent(self, event):
+        if self.completer.visible():
+            if event.key() == Qt.Key_Tab and not event.modifiers():
+                self.completer.accept()
+                return
+            if event.key() == Qt.Key_Escape:
+                self.completer.dismiss()
+                self.completer.cancel()
+                return
+        super().keyPressEvent(event)
+
+    def set_language(self, language):
+        if language == self.language:
+            return
+        self.language = language
+        lexer = LanguageRegistry.instance().lexer(language) if language else None
+        self.setLexer(lexer)
+        if lexer is None:
+            # Обычный текст: без лексера цвета берутся из самого редактора
+            self.setFont(LanguageRegistry.instance().font)
+            self.setPaper(QColor(ONE_DARK["paper"]))
+            self.setColor(QColor("#e0e0e0"))
+        self.update_markers()
+        self.schedule_diagnostics()
+
+    def set_language_for_path(self, path):
+        self.set_language(LanguageRegistry.instance().language_for(path))
+
     def show_context_menu(self, pos):
         menu = self.createStandardContextMenu()
         if self.hasSelectedText():
@@ -182,6 +1325,8 @@ class CodeEditor(QsciScintilla):
     def update_markers(self):
         self.markerDeleteAll(MARKER_FUNC)
         self.markerDeleteAll(MARKER_CLASS)
+        if self.language != "python":
+            return
         text = self.text()
         for i, line in enumerate(text.splitlines()):
             if re.match(r"\s*def\s", line):
@@ -189,7 +1334,136 @@ class CodeEditor(QsciScintilla):
             elif re.match(r"\s*class\s", line):
                 self.markerAdd(i, MARKER_CLASS)
 
+    def schedule_diagnostics(self):
+        # Любая правка делает текущий результат устаревшим. Уже раскрашенные токены Scintilla сдвигает
+        # вместе с текстом, а новые блоки со старыми номерами строк раскрашивать нельзя
+        self.diagnostics_generation += 1
+        self.semantic_blocks = None
+        self.diagnostics_timer.start()
+
+    def request_diagnostics(self):
+        text = self.text()
+        self.request_git_diff(text)
+        if self.language != "python" or not text.strip():
+            self.apply_diagnostics([])
+            self.clear_semantic()
+            return
+        engine = DiagnosticsEngine.instance()
+        engine.submit(self.engine_key, self.diagnostics_generation, text)
+        engine.submit((self.engine_key, "semantic"), self.diagnostics_generation, text, semantic_tokens)
+
+    def _on_diagnostics_ready(self, key, generation, result):
+        if generation != self.diagnostics_generation:
+            return
+        if key == self.engine_key:
+            self.apply_diagnostics(result)
+        elif key == (self.engine_key, "semantic") and result is not None:
+            # None — текст сейчас не разбирается: прежняя раскраска остаётся до исправления
+            self.clear_semantic()
+            self.semantic_blocks = result
+            self.paint_semantic()
+
+    def set_git_path(self, path):
+        if path == self.git_path:
+            return
+        self.git_path = path
+        self.reset_git_markers()
+        self.schedule_diagnostics()
+
+    def request_git_diff(self, text=None):
+        if self.git_path:
+            GitGutterEngine.instance().submit(self.engine_key, self.diagnostics_generation, self.git_path,
+                                              self.text() if text is None else text)
+
+    def reset_git_markers(self):
+        for marker in GIT_MARKERS:
+            self.markerDeleteAll(marker)
+        # Следующий результат рисуется целиком, а не только в изменённом окне
+        self.git_stale = True
+
+    def _on_git_ready(self, key, generation, result):
+        if key != self.engine_key:
+            return
+        if generation != self.diagnostics_generation:
+            # Окно этого результата уже не соответствует тексту и маркерам
+            self.git_stale = True
+            return
+        if result is None:
+            self.reset_git_markers()
+            return
+        hunks, (start, end), reset = result
+        last = self.lines() - 1
+        full = self.git_stale or reset or sum(max(c1 - c0, 1) for c0, c1, _, _ in hunks) < GIT_FULL_APPLY_LINES
+        if full:
+            for marker in GIT_MARKERS:
+                self.markerDeleteAll(marker)
+            self.git_stale = False
+        else:
+            # Вне окна маркеры Scintilla сдвинул вместе с текстом, они по-прежнему верны
+            mask = sum(1 << marker for marker in GIT_MARKERS)
+            line = self.SendScintilla(QsciScintilla.SCI_MARKERNEXT, start, mask)
+            while 0 <= line <= end:
+                for marker in GIT_MARKERS:
+                    self.markerDelete(line, marker)
+                line = self.SendScintilla(QsciScintilla.SCI_MARKERNEXT, line + 1, mask)
+        for c0, c1, b0, b1 in hunks:
+            if not full and (c1 < start or min(c0, last) > end):
+                continue
+            if c1 == c0:
+                # Удалённые строки отмечаются на строке, которая идёт после них
+                lines = [(min(c0, last), MARKER_GIT_DELETED)]
+            else:
+                lines = [(line, MARKER_GIT_ADDED if b1 == b0 else MARKER_GIT_MODIFIED) for line in range(c0, c1)]
+            for line, marker in lines:
+                if full or start <= line <= end:
+                    self.markerAdd(line, marker)
+
+    def clear_semantic(self):
+        self.semantic_blocks = None
+        self.semantic_painted = set()
+        for index in range(len(SEMANTIC_KINDS)):
+            self.clearIndicatorRange(-1, 0, -1, 0, INDICATOR_SEMANTIC + index)
+
+    def paint_semantic(self, _updated=0):
+        # Раскрашиваются только блоки в видимой части с запасом; раскрашенный блок второй раз не трогается
+        if not self.semantic_blocks:
+            return
+        first = self.SendScintilla(QsciScintilla.SCI_DOCLINEFROMVISIBLE, self.firstVisibleLine())
+        start = max(0, first - SEMANTIC_MARGIN_LINES) // SEMANTIC_BLOCK_LINES
+        end = (first + self.SendScintilla(QsciScintilla.SCI_LINESONSCREEN) + SEMANTIC_MARGIN_LINES) // SEMANTIC_BLOCK_LINES
+        current = None
+        for block in range(start, end + 1):
+            if block in self.semantic_painted:
+                continue
+            self.semantic_painted.add(block)
+            for line, col, length, kind in self.semantic_blocks.get(block, ()):
+                if kind != current:
+                    current = kind
+                    self.SendScintilla(QsciScintilla.SCI_SETINDICATORCURRENT, INDICATOR_SEMANTIC + kind)
+                position = self.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, line)
+                self.SendScintilla(QsciScintilla.SCI_INDICATORFILLRANGE, position + col, length)
+
+    def apply_diagnostics(self, diagnostics):
+        self.markerDeleteAll(MARKER_ERROR)
+        self.markerDeleteAll(MARKER_WARNING)
+        self.clearIndicatorRange(-1, 0, -1, 0, INDICATOR_ERROR)
+        self.clearIndicatorRange(-1, 0, -1, 0, INDICATOR_WARNING)
+        self.diagnostics = {}
+        last_line = self.lines() - 1
+        for line, col, end_col, severity, message in diagnostics:
+            line = min(line, last_line)
+            is_error = severity == "error"
+            self.diagnostics.setdefault(line, []).append(message)
+            self.markerAdd(line, MARKER_ERROR if is_error else MARKER_WARNING)
+            end_col = min(max(end_col, col + 1), len(self.text(line).rstrip("\r\n")))
+            if end_col > col:
+                self.fillIndicatorRange(line, col, line, end_col, INDICATOR_ERROR if is_error else INDICATOR_WARNING)
+
     def on_margin_clicked(self, margin, line, modifiers):
+        if margin == 2:
+            messages = self.diagnostics.get(line)
+            if messages:
+                QToolTip.showText(QCursor.pos(), "\n".join(messages), self)
         if margin == 1:
             markers = self.markersAtLine(line)
             if markers & (1 << (MARKER_FUNC - 1)):
@@ -202,27 +1476,985 @@ class CodeEditor(QsciScintilla):
     def is_modified(self):
         return self.isModified()
 
-    def update_autocomplete(self):
-        words = set(re.findall(r"\b\w{3,}\b", self.text()))
-        for w in words:
-            self.api.add(w)
-        self.api.prepare()
+# --- Локальная история версий ---
+APP_DATA_DIR = os.environ.get("MINICRUSOR_HOME", os.path.join(os.path.expanduser("~"), ".minicrusor"))
+HISTORY_KEYFRAME_INTERVAL = 16
+HISTORY_MAX_AGE_DAYS = 30
+HISTORY_MAX_BYTES = 200 * 1024 * 1024
+
+def line_delta(base, text):
+    # Дельта по строкам: [i1, i2] — взять строки базовой версии, строка — вставить как есть
+    from difflib import SequenceMatcher
+    a = base.splitlines(True)
+    b = text.splitlines(True)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(b[j1:j2]))
+    return ops
+
+def apply_delta(base, ops):
+    a = base.splitlines(True)
+    return "".join("".join(a[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+class LocalHistory(QObject):
+    # Версии хранятся по хэшу содержимого. Объект либо целиком, либо дельта к предыдущей
+    # версии того же файла; каждая HISTORY_KEYFRAME_INTERVAL-я версия — снова целиком,
+    # поэтому для восстановления любой версии нужно применить не больше 15 дельт.
+    # Объекты неизменяемы, ненужные удаляются сборкой мусора после очистки по возрасту и размеру.
+    changed = pyqtSignal(str)
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, root=None):
+        super().__init__()
+        from functools import lru_cache
+        self.root = root or os.path.join(APP_DATA_DIR, "history")
+        self.lock = threading.Lock()
+        self.executor = None
+        self.files = None
+        self.objects = None
+        self.text = lru_cache(maxsize=64)(self._read_text)
+
+    def _load(self):
+        if self.files is not None:
+            return
+        try:
+            with open(os.path.join(self.root, "index.json"), "r", encoding="utf-8") as f:
+                index = json.load(f)
+            self.files, self.objects = index["files"], index["objects"]
+        except FileNotFoundError:
+            self.files, self.objects = {}, {}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[history] индекс повреждён, история начнётся заново: {e}", file=sys.stderr)
+            self.files, self.objects = {}, {}
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest[2:])
+
+    def record(self, key, text, reason):
+        from concurrent.futures import ThreadPoolExecutor
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        self.executor.submit(self._record, key, text, reason, time.time())
+
+    def _record(self, key, text, reason, timestamp):
+        import zlib
+        import hashlib
+        try:
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            with self.lock:
+                self._load()
+                entries = self.files.get(key, [])
+                previous = entries[-1]["hash"] if entries else None
+                exists = digest in self.objects
+            if previous == digest:
+                return
+            if not exists:
+                data = zlib.compress(b"F" + text.encode("utf-8"))
+                depth = 0
+                base = previous if previous and self.objects[previous]["depth"] + 1 < HISTORY_KEYFRAME_INTERVAL else None
+                if base:
+                    delta = json.dumps({"base": base, "ops": line_delta(self.text(base), text)}, ensure_ascii=False)
+                    delta = zlib.compress(b"D" + delta.encode("utf-8"))
+                    if len(delta) < len(data):
+                        data, depth = delta, self.objects[base]["depth"] + 1
+                    else:
+                        base = None
+                path = self._object_path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+            with self.lock:
+                if not exists:
+                    self.objects[digest] = {"base": base, "depth": depth, "bytes": len(data)}
+                self.files.setdefault(key, []).append(
+                    {"hash": digest, "time": timestamp, "reason": reason, "size": len(text)})
+                self._prune(timestamp)
+                self._save_index()
+            self.changed.emit(key)
+        except Exception:
+            traceback.print_exc()
+
+    def _prune(self, now):
+        # Последняя версия каждого файла не удаляется ни по возрасту, ни по размеру
+        expire = now - HISTORY_MAX_AGE_DAYS * 86400
+        for key in self.files:
+            entries = self.files[key]
+            self.files[key] = [e for e in entries[:-1] if e["time"] >= expire] + entries[-1:]
+        while True:
+            live = set()
+            for entries in self.files.values():
+                for entry in entries:
+                    digest = entry["hash"]
+                    while digest and digest not in live:
+                        live.add(digest)
+                        digest = self.objects[digest]["base"]
+            if sum(self.objects[d]["bytes"] for d in live) <= HISTORY_MAX_BYTES:
+                break
+            candidates = [(entries[0]["time"], key) for key, entries in self.files.items() if len(entries) > 1]
+            if not candidates:
+                break
+            self.files[min(candidates)[1]].pop(0)
+        for digest in set(self.objects) - live:
+            del self.objects[digest]
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                pass
+
+    def _save_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, "index.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"files": self.files, "objects": self.objects}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def _read_text(self, digest):
+        import zlib
+        with open(self._object_path(digest), "rb") as f:
+            data = zlib.decompress(f.read())
+        if data[:1] == b"F":
+            return data[1:].decode("utf-8")
+        delta = json.loads(data[1:].decode("utf-8"))
+        return apply_delta(self.text(delta["base"]), delta["ops"])
+
+    def versions(self, key):
+        with self.lock:
+            self._load()
+            return list(reversed(self.files.get(key, [])))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+class LocalHistoryDialog(QDialog):
+    def __init__(self, history, key, current_text, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f"Локальная история: {key}")
+        self.resize(1000, 600)
+        self.history = history
+        self.key = key
+        self.current_text = current_text
+        self.restored_text = None
+
+        self.table = QTableWidget(0, 3)
+        self.table.setHorizontalHeaderLabels(["Время", "Событие", "Размер"])
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.currentCellChanged.connect(lambda *_: self.show_diff())
+        self.diff_view = QPlainTextEdit()
+        self.diff_view.setReadOnly(True)
+        self.diff_view.setFont(QFont("Consolas", 10))
+        self.diff_view.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.compare_previous = QCheckBox("Сравнивать с предыдущей версией, а не с текущим текстом")
+        self.compare_previous.toggled.connect(lambda _: self.show_diff())
+        restore_btn = QPushButton("Восстановить эту версию")
+        restore_btn.clicked.connect(self.restore)
+
+        splitter = QSplitter(Qt.Horizontal)
+        splitter.addWidget(self.table)
+        splitter.addWidget(self.diff_view)
+        splitter.setSizes([300, 700])
+        bottom = QHBoxLayout()
+        bottom.addWidget(self.compare_previous)
+        bottom.addStretch()
+        bottom.addWidget(restore_btn)
+        layout = QVBoxLayout(self)
+        layout.addWidget(splitter)
+        layout.addLayout(bottom)
+
+        self.versions = history.versions(key)
+        self.table.setRowCount(len(self.versions))
+        for row, entry in enumerate(self.versions):
+            values = [time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"])), entry["reason"],
+                      format_bytes(entry["size"])]
+            for col, value in enumerate(values):
+                self.table.setItem(row, col, QTableWidgetItem(value))
+        if self.versions:
+            self.table.selectRow(0)
+
+    def show_diff(self):
+        import difflib
+        row = self.table.currentRow()
+        if row < 0:
+            return
+        text = self.history.text(self.versions[row]["hash"])
+        if self.compare_previous.isChecked():
+            other = self.history.text(self.versions[row + 1]["hash"]) if row + 1 < len(self.versions) else ""
+            diff = difflib.unified_diff(other.splitlines(True), text.splitlines(True), "предыдущая", "выбранная")
+        else:
+            diff = difflib.unified_diff(text.splitlines(True), self.current_text.splitlines(True), "выбранная", "текущая")
+        self.diff_view.setPlainText("".join(diff) or "Нет различий")
+
+    def restore(self):
+        row = self.table.currentRow()
+        if row >= 0:
+            self.restored_text = self.history.text(self.versions[row]["hash"])
+            self.accept()
+
+# --- Журнал автосохранения несохранённых вкладок ---
+AUTOSAVE_INTERVAL_MS = 2000
+AUTOSAVE_HEARTBEAT_S = 15
+AUTOSAVE_DEAD_AFTER_S = 60
+AUTOSAVE_MAX_BYTES = 50 * 1024 * 1024
+
+class AutosaveJournal(QObject):
+    # Каждая сессия пишет в свой каталог recovery/<pid>-<время>, по одному файлу на вкладку.
+    # GUI-поток раз в AUTOSAVE_INTERVAL_MS снимает текст только изменившихся вкладок;
+    # запись идёт в фоновом потоке, и из нескольких снимков одной вкладки пишется последний.
+    # Каталог, чей heartbeat давно не обновлялся, остался от упавшей сессии.
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, root=None):
+        super().__init__()
+        self.root = root or os.path.join(APP_DATA_DIR, "recovery")
+        self.session_dir = os.path.join(self.root, f"{os.getpid()}-{int(time.time())}")
+        self.dirty = {}
+        self.saved = set()
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.last_heartbeat = 0.0
+        self.timer = QTimer(self)
+        self.timer.setInterval(AUTOSAVE_INTERVAL_MS)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    @staticmethod
+    def key(tab):
+        return f"{id(tab):x}"
+
+    def mark_dirty(self, tab):
+        self.dirty[self.key(tab)] = tab
+
+    def forget(self, tab):
+        key = self.key(tab)
+        self.dirty.pop(key, None)
+        if key in self.saved:
+            self._submit(key, None)
+
+    def flush(self):
+        writes = []
+        for key, tab in self.dirty.items():
+            try:
+                if tab.editor.isModified() and tab.editor.length() <= AUTOSAVE_MAX_BYTES:
+                    writes.append((key, {"path": tab.filepath, "title": tab.filename, "language": tab.editor.language,
+                                         "time": time.time(), "text": tab.editor.text()}))
+                    continue
+            except RuntimeError:
+                # Вкладку удалили, не закрывая через close_tab
+                pass
+            if key in self.saved:
+                writes.append((key, None))
+        self.dirty.clear()
+        self.saved.update(key for key, entry in writes if entry is not None)
+        # heartbeat пишется раньше вкладок, чтобы другая сессия не приняла каталог за брошенный
+        if self.saved and time.time() - self.last_heartbeat >= AUTOSAVE_HEARTBEAT_S:
+            self.last_heartbeat = time.time()
+            self._submit("heartbeat", {})
+        for key, entry in writes:
+            self._submit(key, entry)
+
+    def _submit(self, key, entry):
+        if entry is None:
+            self.saved.discard(key)
+        with self.condition:
+            self.pending[key] = entry
+            self.condition.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._writer, name="autosave", daemon=True)
+            self.thread.start()
+
+    def _writer(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                batch, self.pending = self.pending, {}
+            for key, entry in batch.items():
+                if key is None:
+                    continue
+                try:
+                    self._write(key, entry)
+                except OSError as e:
+                    print(f"[autosave] {key}: {e}", file=sys.stderr)
+            if None in batch:
+                return
+
+    def _write(self, key, entry):
+        path = os.path.join(self.session_dir, key + ".json")
+        if entry is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(self.session_dir, exist_ok=True)
+        if key == "heartbeat":
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(str(os.getpid()))
+            return
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def recoverable(self):
+        # Каталоги чужих сессий без свежего heartbeat; в каждом — вкладки, не сохранённые до падения
+        sessions = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return sessions
+        for name in sorted(names):
+            directory = os.path.join(self.root, name)
+            if directory == self.session_dir or not os.path.isdir(directory):
+                continue
+            heartbeat = os.path.join(directory, "heartbeat.json")
+            if os.path.exists(heartbeat) and time.time() - os.path.getmtime(heartbeat) < AUTOSAVE_DEAD_AFTER_S:
+                continue
+            entries = []
+            for file in sorted(os.listdir(directory)):
+                if not file.endswith(".json") or file == "heartbeat.json":
+                    continue
+                try:
+                    with open(os.path.join(directory, file), "r", encoding="utf-8") as f:
+                        entries.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+            sessions.append((directory, entries))
+        return sessions
+
+    def discard(self, directory):
+        import shutil
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def shutdown(self):
+        # Изменённые вкладки остаются в журнале и будут предложены при следующем запуске
+        self.timer.stop()
+        self.last_heartbeat = 0.0
+        self.flush()
+        if self.thread is not None:
+            with self.condition:
+                self.pending[None] = None
+                self.condition.notify()
+            self.thread.join()
+            self.thread = None
+        if not self.saved:
+            self.discard(self.session_dir)
+        else:
+            heartbeat = os.path.join(self.session_dir, "heartbeat.json")
+            if os.path.exists(heartbeat):
+                os.utime(heartbeat, (0, 0))
+
+# --- Изменения открытых файлов на диске ---
+class FileWatcher(QObject):
+    # QFileSystemWatcher только подсказывает, что файл мог измениться; решение принимается
+    # по mtime/размеру, а при их расхождении — по хэшу содержимого, чтобы touch и
+    # собственные сохранения не вызывали перезагрузку
+    changed = pyqtSignal(str, str)
+    deleted = pyqtSignal(str)
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        super().__init__()
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self._on_file_changed)
+        self.known = {}
+        self.queued = set()
+        # Редакторы и git пишут файл в несколько приёмов; проверяем, когда запись утихнет
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(100)
+        self.timer.timeout.connect(self._check_queued)
+
+    @staticmethod
+    def _digest(text):
+        import hashlib
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def track(self, path, text):
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        self.known[path] = (st.st_mtime_ns, st.st_size, self._digest(text))
+        if path not in self.watcher.files():
+            self.watcher.addPath(path)
+
+    def untrack(self, path):
+        path = os.path.abspath(path)
+        self.known.pop(path, None)
+        self.queued.discard(path)
+        if path in self.watcher.files():
+            self.watcher.removePath(path)
+
+    def _on_file_changed(self, path):
+        self.queued.add(path)
+        self.timer.start()
+
+    def _check_queued(self):
+        queued, self.queued = self.queued, set()
+        for path in queued:
+            self.check(path)
+
+    def check_all(self):
+        for path in list(self.known):
+            self.check(path)
+
+    def check(self, path):
+        """Возвращает True, если содержимое файла на диске отличается от известного."""
+        path = os.path.abspath(path)
+        known = self.known.get(path)
+        if known is None:
+            return False
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            del self.known[path]
+            self.deleted.emit(path)
+            return True
+        except OSError:
+            return False
+        # Атомарная замена файла снимает наблюдение — ставим заново
+        if path not in self.watcher.files():
+            self.watcher.addPath(path)
+        if (st.st_mtime_ns, st.st_size) == known[:2]:
+            return False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError):
+            return False
+        digest = self._digest(text)
+        self.known[path] = (st.st_mtime_ns, st.st_size, digest)
+        if digest == known[2]:
+            return False
+        self.changed.emit(path, text)
+        return True
+
+class ExternalChangeDialog(QDialog):
+    def __init__(self, path, mine, theirs, parent=None):
+        import difflib
+        super().__init__(parent)
+        self.setWindowTitle("Файл изменён на диске")
+        self.resize(900, 550)
+        self.reload = False
+        label = QLabel(f"Файл {path} изменён другой программой, а во вкладке есть несохранённые правки.\n"
+                       f"Ниже — разница между текстом во вкладке и файлом на диске.")
+        diff_view = QPlainTextEdit()
+        diff_view.setReadOnly(True)
+        diff_view.setFont(QFont("Consolas", 10))
+        diff_view.setLineWrapMode(QPlainTextEdit.NoWrap)
+        diff = difflib.unified_diff(mine.splitlines(True), theirs.splitlines(True), "во вкладке", "на диске")
+        diff_view.setPlainText("".join(diff))
+        reload_btn = QPushButton("Загрузить с диска")
+        reload_btn.clicked.connect(self._reload)
+        keep_btn = QPushButton("Оставить мои правки")
+        keep_btn.clicked.connect(self.reject)
+        buttons = QHBoxLayout()
+        buttons.addStretch()
+        buttons.addWidget(reload_btn)
+        buttons.addWidget(keep_btn)
+        layout = QVBoxLayout(self)
+        layout.addWidget(label)
+        layout.addWidget(diff_view)
+        layout.addLayout(buttons)
+
+    def _reload(self):
+        self.reload = True
+        self.accept()
+
+# --- Поиск и замена в редакторе ---
+# Поиск идёт в отдельном потоке по снимку текста. Сначала ищутся совпадения в видимой
+# части документа, затем остальные — пачками; позиции передаются в байтах UTF-8,
+# как их понимает Scintilla.
+FIND_CHUNK_SIZE = 2000
+FIND_CHUNK_INTERVAL = 0.05
+FIND_REFRESH_DELAY_MS = 300
+# Подсветка рисуется порциями не дольше этого времени, чтобы интерфейс отвечал во время поиска
+FIND_PAINT_SLICE_S = 0.008
+# Соседние замены ближе этого расстояния объединяются в одну правку Scintilla
+REPLACE_MERGE_GAP = 64 * 1024
+
+def find_pattern(text, regex=False, case=False, word=False):
+    pattern = text if regex else re.escape(text)
+    if word:
+        pattern = rf"\b(?:{pattern})\b"
+    return re.compile(pattern, re.MULTILINE | (0 if case else re.IGNORECASE))
+
+class FindWorker(QThread):
+    # object, а не list: список не конвертируется в QVariantList при передаче между потоками
+    matches = pyqtSignal(int, object)
+    # Итог: число совпадений и совпадения видимой части, которых нет в поиске по всему документу
+    done = pyqtSignal(int, int, object)
+    replaced = pyqtSignal(int, object, int)
+
+    def __init__(self, generation, text, pattern, view=(0, 0, 0), replacement=None):
+        super().__init__()
+        self.generation = generation
+        self.text = text
+        self.pattern = pattern
+        self.view = view
+        self.replacement = replacement
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        if self.replacement is not None:
+            self._replace()
+        else:
+            self._find()
+
+    def _iter_bytes(self, start_char, start_byte, pos=0, stop=None):
+        # Перевод позиций символов в байты: курсор идёт только вперёд, поэтому весь проход O(n).
+        # Поиск всегда идёт до конца текста (endpos обрезал бы $ и жадные шаблоны), stop лишь прерывает его
+        text = self.text
+        char, byte = start_char, start_byte
+        ascii_only = text.isascii()
+        for m in self.pattern.finditer(text, pos):
+            if self.cancelled:
+                return
+            if stop is not None and m.start() > stop:
+                return
+            if m.start() == m.end():
+                continue
+            if ascii_only:
+                yield m, m.start(), m.end()
+                continue
+            byte += len(text[char:m.start()].encode("utf-8"))
+            char = m.start()
+            end = byte + len(m.group().encode("utf-8"))
+            yield m, byte, end
+
+    def _find(self):
+        view_start, char_start, char_end = self.view
+        total = 0
+        batch = []
+        last_emit = time.perf_counter()
+        # Сначала видимая часть, затем весь документ. Поиск с середины может разойтись с поиском от начала
+        # (совпадение, начатое выше экрана, сдвигает следующие), поэтому итог — только полный проход:
+        # его совпадения, уже показанные первым, не повторяются, а лишние показанные возвращаются в done
+        view = set()
+        for index, (start_char, start_byte, stop) in enumerate([(char_start, view_start, char_end), (0, 0, None)]):
+            for m, start, end in self._iter_bytes(start_char, start_byte, start_char, stop):
+                if index == 0:
+                    view.add((start, end))
+                else:
+                    total += 1
+                    if (start, end) in view:
+                        view.discard((start, end))
+                        continue
+                batch.append((start, end))
+                if len(batch) >= FIND_CHUNK_SIZE or time.perf_counter() - last_emit >= FIND_CHUNK_INTERVAL:
+                    self.matches.emit(self.generation, batch)
+                    batch = []
+                    last_emit = time.perf_counter()
+            if index == 0 and batch:
+                self.matches.emit(self.generation, batch)
+                batch = []
+        if self.cancelled:
+            return
+        if batch:
+            self.matches.emit(self.generation, batch)
+        self.done.emit(self.generation, total, sorted(view))
+
+    def _replace(self):
+        raw = self.text.encode("utf-8")
+        segments = []
+        count = 0
+        for m, start, end in self._iter_bytes(0, 0):
+            data = (m.expand(self.replacement) if self.pattern.groups or "\\" in self.replacement
+                    else self.replacement).encode("utf-8")
+            count += 1
+            if segments and start - segments[-1][1] < REPLACE_MERGE_GAP:
+                segment = segments[-1]
+                segment[2].append(raw[segment[1]:start])
+                segment[2].append(data)
+                segment[1] = end
+            else:
+                segments.append([start, end, [data]])
+        if self.cancelled:
+            return
+        self.replaced.emit(self.generation, [(start, end, b"".join(parts)) for start, end, parts in segments], count)
+
+class FindBar(QWidget):
+    running = set()
+
+    def __init__(self, editor, parent=None):
+        super().__init__(parent)
+        self.editor = editor
+        self.generation = 0
+        self.worker = None
+        self.pattern = None
+        self.matches = []
+        self.sorted = True
+        self.searching = False
+        self.current = -1
+        self.note = None
+        self.paint_queue = []
+        self.paint_timer = QTimer(self)
+        self.paint_timer.setInterval(0)
+        self.paint_timer.timeout.connect(self._paint)
+
+        self.find_input = QLineEdit()
+        self.find_input.setPlaceholderText("Найти")
+        self.case_box = QCheckBox("Aa")
+        self.case_box.setToolTip("С учётом регистра")
+        self.word_box = QCheckBox("Слово")
+        self.regex_box = QCheckBox(".*")
+        self.regex_box.setToolTip("Регулярное выражение")
+        self.count_label = QLabel()
+        self.count_label.setMinimumWidth(90)
+        prev_btn = QPushButton("▲")
+        next_btn = QPushButton("▼")
+        close_btn = QPushButton("✕")
+        for btn in (prev_btn, next_btn, close_btn):
+            btn.setFixedWidth(28)
+        self.replace_input = QLineEdit()
+        self.replace_input.setPlaceholderText("Заменить на")
+        replace_btn = QPushButton("Заменить")
+        self.replace_all_btn = QPushButton("Заменить все")
+
+        find_row = QHBoxLayout()
+        for widget in (self.find_input, self.case_box, self.word_box, self.regex_box, self.count_label,
+                       prev_btn, next_btn, close_btn):
+            find_row.addWidget(widget)
+        self.replace_row = QWidget()
+        replace_layout = QHBoxLayout(self.replace_row)
+        replace_layout.setContentsMargins(0, 0, 0, 0)
+        replace_layout.addWidget(self.replace_input)
+        replace_layout.addWidget(replace_btn)
+        replace_layout.addWidget(self.replace_all_btn)
+        replace_layout.addStretch()
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(6, 4, 6, 4)
+        layout.addLayout(find_row)
+        layout.addWidget(self.replace_row)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(FIND_REFRESH_DELAY_MS)
+        self.timer.timeout.connect(self.search)
+        self.find_input.textChanged.connect(lambda: self.timer.start(100))
+        for box in (self.case_box, self.word_box, self.regex_box):
+            box.toggled.connect(lambda: self.timer.start(0))
+        self.find_input.returnPressed.connect(
+            lambda: self.jump(-1 if QApplication.keyboardModifiers() & Qt.ShiftModifier else 1))
+        self.replace_input.returnPressed.connect(self.replace_one)
+        prev_btn.clicked.connect(lambda: self.jump(-1))
+        next_btn.clicked.connect(lambda: self.jump(1))
+        close_btn.clicked.connect(self.close_bar)
+        replace_btn.clicked.connect(self.replace_one)
+        self.replace_all_btn.clicked.connect(self.replace_all)
+        # Правка документа делает найденные позиции устаревшими — поиск перезапускается после паузы
+        editor.textChanged.connect(self._on_text_changed)
+
+        editor.indicatorDefine(QsciScintilla.StraightBoxIndicator, INDICATOR_FIND)
+        editor.setIndicatorForegroundColor(QColor(229, 192, 123, 110), INDICATOR_FIND)
+        editor.SendScintilla(QsciScintilla.SCI_INDICSETUNDER, INDICATOR_FIND, True)
+        self.hide()
+
+    def open(self, replace=False):
+        self.replace_row.setVisible(replace)
+        self.show()
+        if self.editor.hasSelectedText() and "\n" not in self.editor.selectedText():
+            self.find_input.setText(self.editor.selectedText())
+        self.find_input.setFocus()
+        self.find_input.selectAll()
+        self.timer.start(0)
+
+    def close_bar(self):
+        self._cancel()
+        self.pattern = None
+        self._clear_indicators()
+        self.hide()
+        self.editor.setFocus()
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.close_bar()
+            return
+        super().keyPressEvent(event)
+
+    def _on_text_changed(self):
+        if self.isVisible() and self.pattern is not None:
+            self.generation += 1
+            self._cancel()
+            self.timer.start()
+
+    def _cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+
+    def _clear_indicators(self):
+        self.paint_queue = []
+        self.paint_timer.stop()
+        self.editor.SendScintilla(QsciScintilla.SCI_SETINDICATORCURRENT, INDICATOR_FIND)
+        self.editor.SendScintilla(QsciScintilla.SCI_INDICATORCLEARRANGE, 0, self.editor.length())
+
+    def _compile(self):
+        text = self.find_input.text()
+        self.find_input.setStyleSheet("")
+        if not text:
+            return None
+        try:
+            return find_pattern(text, self.regex_box.isChecked(), self.case_box.isChecked(), self.word_box.isChecked())
+        except re.error as e:
+            self.find_input.setStyleSheet("color: #e06c75;")
+            self.count_label.setText(f"ошибка: {e.msg}")
+            return None
+
+    def _start(self, worker):
+        self._cancel()
+        self.worker = worker
+        worker.matches.connect(self._on_matches)
+        worker.done.connect(self._on_done)
+        worker.replaced.connect(self._on_replaced)
+        # Отменённый поток ещё дорабатывает: ссылка держится до finished, иначе QThread удалится на ходу
+        FindBar.running.add(worker)
+        worker.finished.connect(lambda w=worker: FindBar.running.discard(w))
+        worker.finished.connect(worker.deleteLater)
+        worker.start()
+
+    def _viewport(self):
+        editor = self.editor
+        first = editor.firstVisibleLine()
+        last = min(editor.lines() - 1, first + editor.SendScintilla(QsciScintilla.SCI_LINESONSCREEN))
+        start = editor.positionFromLineIndex(first, 0)
+        end = editor.SendScintilla(QsciScintilla.SCI_GETLINEENDPOSITION, last)
+        # Позиции Scintilla — байты UTF-8; символьные смещения для поиска по str считает сам Scintilla
+        char_start = editor.SendScintilla(QsciScintilla.SCI_COUNTCHARACTERS, 0, start)
+        return (start, char_start, char_start + editor.SendScintilla(QsciScintilla.SCI_COUNTCHARACTERS, start, end))
+
+    def search(self):
+        self.timer.stop()
+        self.generation += 1
+        self._cancel()
+        self.replace_all_btn.setEnabled(True)
+        self._clear_indicators()
+        self.matches = []
+        self.sorted = True
+        self.current = -1
+        self.note = None
+        self.pattern = self._compile()
+        if self.pattern is None:
+            self.searching = False
+            if not self.find_input.text():
+                self.count_label.setText("")
+            return
+        self.searching = True
+        self.count_label.setText("поиск...")
+        self._start(FindWorker(self.generation, self.editor.text(), self.pattern, self._viewport()))
+
+    def _on_matches(self, generation, batch):
+        if generation != self.generation:
+            return
+        if self.matches and batch and batch[0] < self.matches[-1]:
+            self.sorted = False
+        first = not self.matches
+        self.matches.extend(batch)
+        self.paint_queue.append(batch)
+        # Первая пачка (видимая часть) рисуется сразу, остальные — когда поток поиска закончит:
+        # вызовы Scintilla отпускают GIL и, пока поток считает, каждый ждал бы его заново
+        if first:
+            self.paint_timer.start()
+        self.count_label.setText(f"{len(self.matches)}…")
+
+    def _paint(self):
+        # Пачки рисуются в порядке прихода: видимая часть документа — первой
+        editor = self.editor
+        editor.SendScintilla(QsciScintilla.SCI_SETINDICATORCURRENT, INDICATOR_FIND)
+        deadline = time.perf_counter() + FIND_PAINT_SLICE_S
+        while self.paint_queue:
+            batch = self.paint_queue[0]
+            while batch:
+                start, end = batch.pop()
+                editor.SendScintilla(QsciScintilla.SCI_INDICATORFILLRANGE, start, end - start)
+                # Пока поток поиска держит GIL, каждый вызов может ждать его; время проверяется на каждом
+                if time.perf_counter() >= deadline:
+                    return
+            self.paint_queue.pop(0)
+        self.paint_timer.stop()
+
+    def _on_done(self, generation, total, stale):
+        if generation != self.generation:
+            return
+        self.searching = False
+        self.worker = None
+        self._sort()
+        if stale:
+            self._retract(stale)
+        self.paint_timer.start()
+        self._update_count()
+
+    def _retract(self, stale):
+        import bisect
+        drop = set(stale)
+        self.matches = [match for match in self.matches if match not in drop]
+        self.paint_queue = [[match for match in batch if match not in drop] for batch in self.paint_queue]
+        self.current = -1
+        # Стираем лишние отметки и заново рисуем верные совпадения, задетые стиранием
+        editor = self.editor
+        editor.SendScintilla(QsciScintilla.SCI_SETINDICATORCURRENT, INDICATOR_FIND)
+        repaint = []
+        for start, end in stale:
+            editor.SendScintilla(QsciScintilla.SCI_INDICATORCLEARRANGE, start, end - start)
+            index = max(0, bisect.bisect_left(self.matches, (start, -1)) - 1)
+            while index < len(self.matches) and self.matches[index][0] < end:
+                if self.matches[index][1] > start:
+                    repaint.append(self.matches[index])
+                index += 1
+        if repaint:
+            self.paint_queue.append(repaint)
+
+    def _sort(self):
+        if not self.sorted:
+            self.matches.sort()
+            self.sorted = True
+
+    def _update_count(self):
+        note = f"{self.note}; " if self.note else ""
+        if not self.matches:
+            self.count_label.setText(note + ("нет совпадений" if not self.searching else "поиск..."))
+            return
+        suffix = "…" if self.searching else ""
+        position = f"{self.current + 1}/" if self.current >= 0 else ""
+        self.count_label.setText(f"{note}{position}{len(self.matches)}{suffix}")
+
+    def jump(self, step):
+        import bisect
+        if not self.matches:
+            return
+        self._sort()
+        editor = self.editor
+        # От курсора: следующее совпадение после выделения или предыдущее перед ним
+        caret = editor.SendScintilla(QsciScintilla.SCI_GETSELECTIONSTART if step < 0 else QsciScintilla.SCI_GETSELECTIONEND)
+        if step > 0:
+            index = bisect.bisect_left(self.matches, (caret, -1)) % len(self.matches)
+        else:
+            index = (bisect.bisect_left(self.matches, (caret, -1)) - 1) % len(self.matches)
+        self.current = index
+        start, end = self.matches[index]
+        editor.SendScintilla(QsciScintilla.SCI_SETSEL, start, end)
+        editor.SendScintilla(QsciScintilla.SCI_SCROLLCARET)
+        self._update_count()
+
+    def _selection_matches(self):
+        editor = self.editor
+        start = editor.SendScintilla(QsciScintilla.SCI_GETSELECTIONSTART)
+        end = editor.SendScintilla(QsciScintilla.SCI_GETSELECTIONEND)
+        return start != end and self.pattern is not None and self.pattern.fullmatch(editor.selectedText()) is not None
+
+    def replace_one(self):
+        if self.pattern is None:
+            return
+        editor = self.editor
+        if self._selection_matches():
+            selected = editor.selectedText()
+            replacement = self.replace_input.text()
+            if self.regex_box.isChecked():
+                replacement = self.pattern.fullmatch(selected).expand(replacement)
+            editor.replaceSelectedText(replacement)
+        else:
+            self.jump(1)
+
+    def replace_all(self):
+        self.pattern = self._compile()
+        if self.pattern is None:
+            return
+        self.generation += 1
+        self._cancel()
+        # Старая подсветка всё равно устареет; её дорисовка отнимала бы GIL у потока замены
+        self._clear_indicators()
+        self.replace_all_btn.setEnabled(False)
+        self.count_label.setText("замена...")
+        replacement = self.replace_input.text()
+        if not self.regex_box.isChecked():
+            # Обычный текст: обратные слэши в замене не должны читаться как ссылки на группы
+            replacement = replacement.replace("\\", "\\\\")
+        self._start(FindWorker(self.generation, self.editor.text(), self.pattern, replacement=replacement))
+
+    def _on_replaced(self, generation, segments, count):
+        self.replace_all_btn.setEnabled(True)
+        if generation != self.generation:
+            # Документ изменился, пока считалась замена: позиции устарели
+            self.count_label.setText("текст изменился, повторите")
+            return
+        self.worker = None
+        editor = self.editor
+        # Одна операция отмены на всю замену; правки идут с конца, чтобы позиции не сдвигались
+        editor.beginUndoAction()
+        for start, end, data in reversed(segments):
+            editor.SendScintilla(QsciScintilla.SCI_SETTARGETSTART, start)
+            editor.SendScintilla(QsciScintilla.SCI_SETTARGETEND, end)
+            editor.SendScintilla(QsciScintilla.SCI_REPLACETARGET, len(data), data)
+        editor.endUndoAction()
+        self.search()
+        self.note = f"заменено: {count}"
+        self._update_count()
 
 class EditorTab(QWidget):
     code_for_ai = pyqtSignal(str)
-    def __init__(self, filepath=None):
+    def __init__(self, filepath=None, language="python"):
         super().__init__()
         self.filepath = filepath
         self.filename = os.path.basename(filepath) if filepath else "Без имени"
         self.is_saved = True
-
-        self.editor = CodeEditor()
+        # Ключ локальной истории; для несохранённой вкладки — временный, до первого сохранения
+        self.history_key = filepath or f"untitled:{id(self):x}"
+        self.last_active = time.monotonic()
+        # Выгруженная вкладка: текст сжат zlib, документ редактора пуст
+        self.unloaded = None
+
+        self.editor = CodeEditor(None if filepath else language)
+        self.find_bar = FindBar(self.editor, self)
         layout = QVBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(0)
+        layout.addWidget(self.find_bar)
         layout.addWidget(self.editor)
         self.setLayout(layout)
+        for shortcut, replace in (("Ctrl+F", False), ("Ctrl+H", True)):
+            action = QAction(self)
+            action.setShortcut(shortcut)
+            action.setShortcutContext(Qt.WidgetWithChildrenShortcut)
+            action.triggered.connect(lambda _=False, r=replace: self.find_bar.open(r))
+            self.addAction(action)
+        for shortcut, step in (("F3", 1), ("Shift+F3", -1)):
+            action = QAction(self)
+            action.setShortcut(shortcut)
+            action.setShortcutContext(Qt.WidgetWithChildrenShortcut)
+            action.triggered.connect(lambda _=False, s=step: self.find_bar.jump(s))
+            self.addAction(action)
 
         self.editor.modificationChanged.connect(self.on_modified)
+        self.editor.textChanged.connect(lambda: AutosaveJournal.instance().mark_dirty(self))
         self.editor.code_submitted_for_ai.connect(self.code_for_ai)
 
         if filepath:
@@ -231,12 +2463,16 @@ class EditorTab(QWidget):
     def load_file(self, path):
         try:
             with open(path, "r", encoding="utf-8") as f:
-                self.editor.setText(f.read())
+                text = f.read()
+            self.editor.set_language_for_path(path)
+            self.editor.set_git_path(path)
+            self.editor.setText(text)
+            FileWatcher.instance().track(path, text)
             self.filepath = path
             self.filename = os.path.basename(path)
+            self.history_key = path
             self.is_saved = True
             self.editor.setModified(False)
-            self.editor.update_autocomplete()
         except Exception as e:
             QMessageBox.warning(self, "Ошибка", f"Не удалось открыть файл:\n{e}")
 
@@ -244,23 +2480,238 @@ class EditorTab(QWidget):
         path = path or self.filepath
         if not path:
             return False
+        self.ensure_loaded()
+        # Файл успели изменить снаружи: сначала разрешается конфликт, потом сохранение
+        if path == self.filepath and FileWatcher.instance().check(path):
+            return False
         try:
+            text = self.editor.text()
             with open(path, "w", encoding="utf-8") as f:
-                f.write(self.editor.text())
+                f.write(text)
+            FileWatcher.instance().track(path, text)
+            self.history_key = path
+            LocalHistory.instance().record(path, text, "сохранение")
+            if path != self.filepath:
+                self.editor.set_language_for_path(path)
+                self.editor.set_git_path(path)
             self.filepath = path
             self.filename = os.path.basename(path)
             self.is_saved = True
             self.editor.setModified(False)
-            self.editor.update_autocomplete()
             return True
         except Exception as e:
             QMessageBox.warning(self, "Ошибка", f"Не удалось сохранить файл:\n{e}")
             return False
 
+    def apply_external_text(self, text):
+        # Заменяются только различающиеся диапазоны строк: курсор и прокрутка остаются на месте
+        from difflib import SequenceMatcher
+        if self.unloaded is not None:
+            import zlib
+            self.unloaded = (zlib.compress(text.encode("utf-8")),) + self.unloaded[1:]
+            return
+        editor = self.editor
+        old = editor.text().splitlines(True)
+        new = text.splitlines(True)
+        first_visible = editor.firstVisibleLine()
+        shift = 0
+        editor.beginUndoAction()
+        for tag, i1, i2, j1, j2 in reversed(SequenceMatcher(None, old, new).get_opcodes()):
+            if tag == "equal":
+                continue
+            start = editor.positionFromLineIndex(i1, 0) if i1 < len(old) else editor.length()
+            end = editor.positionFromLineIndex(i2, 0) if i2 < len(old) else editor.length()
+            data = "".join(new[j1:j2]).encode("utf-8")
+            editor.SendScintilla(QsciScintilla.SCI_SETTARGETSTART, start)
+            editor.SendScintilla(QsciScintilla.SCI_SETTARGETEND, end)
+            editor.SendScintilla(QsciScintilla.SCI_REPLACETARGET, len(data), data)
+            if i2 <= first_visible:
+                shift += (j2 - j1) - (i2 - i1)
+        editor.endUndoAction()
+        editor.setFirstVisibleLine(max(0, first_visible + shift))
+        editor.setModified(False)
+
+    def unload(self):
+        """Освобождает документ редактора у неизменённой вкладки; текст остаётся в памяти сжатым."""
+        import zlib
+        if self.unloaded is not None or self.editor.isModified():
+            return 0
+        editor = self.editor
+        size = editor_memory(editor)
+        position = editor.getCursorPosition() + (editor.firstVisibleLine(),)
+        self.unloaded = (zlib.compress(editor.text().encode("utf-8")), position)
+        # Без сигналов: очистка не должна попасть в журнал автосохранения и в заголовок вкладки
+        editor.blockSignals(True)
+        editor.setText("")
+        editor.SendScintilla(QsciScintilla.SCI_EMPTYUNDOBUFFER)
+        editor.setModified(False)
+        editor.blockSignals(False)
+        editor.clear_semantic()
+        editor.reset_git_markers()
+        return size - len(self.unloaded[0])
+
+    def ensure_loaded(self):
+        import zlib
+        if self.unloaded is None:
+            return
+        data, (line, index, first_visible) = self.unloaded
+        self.unloaded = None
+        editor = self.editor
+        editor.blockSignals(True)
+        editor.setText(zlib.decompress(data).decode("utf-8"))
+        editor.SendScintilla(QsciScintilla.SCI_EMPTYUNDOBUFFER)
+        editor.setModified(False)
+        editor.blockSignals(False)
+        editor.setCursorPosition(line, index)
+        editor.setFirstVisibleLine(first_visible)
+        editor.schedule_diagnostics()
+
     def on_modified(self, modified):
         self.is_saved = not modified
+        AutosaveJournal.instance().mark_dirty(self)
         self.parent().parent().update_tab_title(self)
 
+# Уровни строк консоли. Traceback окрашивается целиком: от заголовка до строки с исключением.
+SEVERITY_NONE, SEVERITY_WARNING, SEVERITY_ERROR, SEVERITY_TRACE = range(4)
+CONSOLE_ERROR_RE = re.compile(r"\s*(\[Ошибка|\[Error|[\w.]*(Error|Exception)\b|Fatal|FATAL|ERROR|CRITICAL)")
+CONSOLE_WARNING_RE = re.compile(r"\s*(\[Зависание|[\w.]*Warning\b|WARNING|WARN\b)")
+CONSOLE_SEVERITY_COLORS = {SEVERITY_WARNING: "#d19a66", SEVERITY_ERROR: "#e06c75", SEVERITY_TRACE: "#be5046"}
+# Консоль хранит и показывает только последние строки вывода, старые отбрасываются
+CONSOLE_MAX_LINES = 100000
+
+class ConsoleStore:
+    """Последние max_lines строк вывода и уровень каждой строки.
+    Номера строк сквозные: first — номер самой старой из оставшихся, len() — сколько строк пришло всего."""
+
+    def __init__(self, max_lines=CONSOLE_MAX_LINES):
+        from collections import deque
+        self.lines = deque(maxlen=max_lines)
+        self.severity = deque(maxlen=max_lines)
+        self.first = 0
+        # Склеенный текст и начала строк в нём считаются лениво и сбрасываются при добавлении
+        self.text = None
+        self.offsets = None
+        self.in_traceback = False
+
+    def __len__(self):
+        return self.first + len(self.lines)
+
+    def append(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.first += 1
+        self.lines.append(line)
+        self.severity.append(self._classify(line))
+        self.text = None
+        return len(self) - 1
+
+    def level(self, index):
+        index -= self.first
+        return self.severity[index] if 0 <= index < len(self.severity) else None
+
+    def _classify(self, line):
+        # Уровень зависит только от строки и от того, открыт ли traceback — O(1) на строку
+        if line.startswith("Traceback (most recent call last)"):
+            self.in_traceback = True
+            return SEVERITY_TRACE
+        if self.in_traceback:
+            if not line or line[0].isspace():
+                return SEVERITY_TRACE
+            self.in_traceback = False
+            return SEVERITY_ERROR
+        if CONSOLE_ERROR_RE.match(line):
+            return SEVERITY_ERROR
+        if CONSOLE_WARNING_RE.match(line):
+            return SEVERITY_WARNING
+        return SEVERITY_NONE
+
+    def full_text(self):
+        if self.text is None:
+            from array import array
+            from itertools import accumulate
+            self.text = "".join(line + "\n" for line in self.lines)
+            self.offsets = array("Q", accumulate((len(line) + 1 for line in self.lines), initial=0))
+        return self.text
+
+    def line(self, index):
+        return self.lines[index - self.first]
+
+    def search(self, pattern):
+        """Все совпадения как (строка, начало, конец); позиции — внутри строки."""
+        import bisect
+        text = self.full_text()
+        matches = []
+        for m in pattern.finditer(text):
+            if m.start() == m.end():
+                continue
+            index = bisect.bisect_right(self.offsets, m.start()) - 1
+            start = self.offsets[index]
+            end = min(m.end(), self.offsets[index + 1] - 1)
+            matches.append((self.first + index, m.start() - start, max(end, m.start() + 1) - start))
+        return matches
+
+class ConsoleHighlighter(QSyntaxHighlighter):
+    def __init__(self, console):
+        super().__init__(console.document())
+        self.console = console
+        self.formats = {}
+        for severity, color in CONSOLE_SEVERITY_COLORS.items():
+            fmt = QTextCharFormat()
+            fmt.setForeground(QColor(color))
+            self.formats[severity] = fmt
+
+    def highlightBlock(self, text):
+        # Уровень уже посчитан при добавлении строки: здесь только поиск в массиве
+        index = self.console.store_index(self.currentBlock().blockNumber())
+        if index is None:
+            return
+        fmt = self.formats.get(self.console.store.level(index))
+        if fmt is not None:
+            self.setFormat(0, len(text), fmt)
+
+class ConsoleSearchBar(QWidget):
+    def __init__(self, console):
+        super().__init__(console)
+        self.console = console
+        self.setAutoFillBackground(True)
+        self.setStyleSheet("ConsoleSearchBar { background: #2c313a; border: 1px solid #3e4451; }")
+        self.input = QLineEdit()
+        self.input.setPlaceholderText("Регулярное выражение, (?i) — без учёта регистра")
+        self.input.setMinimumWidth(260)
+        self.count_label = QLabel()
+        prev_btn = QPushButton("▲")
+        next_btn = QPushButton("▼")
+        for btn in (prev_btn, next_btn):
+            btn.setFixedWidth(28)
+        self.filter_box = QCheckBox("Только совпадения")
+        close_btn = QPushButton("✕")
+        close_btn.setFixedWidth(28)
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(6, 4, 6, 4)
+        layout.addWidget(self.input)
+        layout.addWidget(self.count_label)
+        layout.addWidget(prev_btn)
+        layout.addWidget(next_btn)
+        layout.addWidget(self.filter_box)
+        layout.addWidget(close_btn)
+
+        # Поиск по большому выводу запускается после паузы в наборе
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(200)
+        self.timer.timeout.connect(lambda: console.set_search(self.input.text(), self.filter_box.isChecked()))
+        self.input.textChanged.connect(self.timer.start)
+        self.input.returnPressed.connect(lambda: console.jump(-1 if QApplication.keyboardModifiers() & Qt.ShiftModifier else 1))
+        self.filter_box.toggled.connect(lambda: self.timer.start(0))
+        prev_btn.clicked.connect(lambda: console.jump(-1))
+        next_btn.clicked.connect(lambda: console.jump(1))
+        close_btn.clicked.connect(console.close_search)
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.console.close_search()
+            return
+        super().keyPressEvent(event)
+
 class ConsoleWidget(QPlainTextEdit):
     def __init__(self):
         super().__init__()
@@ -270,96 +2721,1305 @@ class ConsoleWidget(QPlainTextEdit):
         self.setFont(font)
         self.setContentsMargins(12, 0, 12, 8)
         self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.store = ConsoleStore()
+        # Экран отбрасывает старые строки вместе с хранилищем: без фильтра последний блок — последняя строка
+        self.setMaximumBlockCount(CONSOLE_MAX_LINES)
+        # document() дорог в горячем пути подсветки, а документ у консоли один на всё время жизни
+        self.doc = self.document()
+        # Номера строк хранилища, показанные при фильтрации; None — показано всё
+        self.view_lines = None
+        self.pattern = None
+        self.matches = []
+        self.current_match = -1
+        self.highlighter = ConsoleHighlighter(self)
+        self.search_bar = ConsoleSearchBar(self)
+        self.search_bar.hide()
+        search_action = QAction(self)
+        search_action.setShortcut("Ctrl+F")
+        search_action.setShortcutContext(Qt.WidgetWithChildrenShortcut)
+        search_action.triggered.connect(self.open_search)
+        self.addAction(search_action)
+
+    def store_index(self, block_number):
+        if self.view_lines is None:
+            # Считаем от конца: подсветка нового блока может прийти раньше, чем экран отбросит верхние
+            return len(self.store) - self.doc.blockCount() + block_number
+        return self.view_lines[block_number] if block_number < len(self.view_lines) else None
 
     def append_text(self, text):
-        self.appendPlainText(text)
+        lines = text.split("\n")
+        shown = []
+        for line in lines:
+            index = self.store.append(line)
+            if self.pattern is None:
+                continue
+            found = [(index, m.start(), m.end()) for m in self.pattern.finditer(line) if m.end() > m.start()]
+            self.matches.extend(found)
+            if self.view_lines is not None and found:
+                self.view_lines.append(index)
+                shown.append(line)
+        if self.view_lines is None:
+            self.appendPlainText(text)
+        elif shown:
+            self.appendPlainText("\n".join(shown))
+            # Экран с фильтром тоже ограничен: забываем строки, чьи блоки уже отброшены сверху
+            excess = len(self.view_lines) - self.doc.blockCount()
+            if excess > 0:
+                del self.view_lines[:excess]
+        if self.pattern is not None:
+            self._forget_dropped_matches()
+            self._update_count()
+        if not self.search_bar.isVisible():
+            self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
+
+    def _forget_dropped_matches(self):
+        import bisect
+        dropped = bisect.bisect_left(self.matches, (self.store.first,))
+        if dropped:
+            del self.matches[:dropped]
+            self.current_match = self.current_match - dropped if self.current_match >= dropped else -1
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._place_search_bar()
+
+    def _place_search_bar(self):
+        bar = self.search_bar
+        bar.adjustSize()
+        width = min(bar.sizeHint().width(), self.viewport().width())
+        bar.setGeometry(self.viewport().width() - width, 0, width, bar.sizeHint().height())
+
+    def open_search(self):
+        self.search_bar.show()
+        self._place_search_bar()
+        self.search_bar.raise_()
+        self.search_bar.input.setFocus()
+        self.search_bar.input.selectAll()
+
+    def close_search(self):
+        self.search_bar.hide()
+        self.set_search("", False)
+        self.setFocus()
+
+    def set_search(self, text, filtered):
+        try:
+            self.pattern = re.compile(text, re.MULTILINE) if text else None
+        except re.error as e:
+            self.pattern = None
+            self.search_bar.count_label.setText(f"ошибка: {e.msg}")
+            self.search_bar.count_label.setStyleSheet("color: #e06c75;")
+            return
+        self.search_bar.count_label.setStyleSheet("")
+        self.matches = self.store.search(self.pattern) if self.pattern else []
+        self.current_match = -1
+        view_lines = sorted({line for line, _, _ in self.matches}) if self.pattern and filtered else None
+        if view_lines != self.view_lines:
+            self._rebuild_view(view_lines)
+        self._update_count()
+        self.setExtraSelections([])
+        if self.matches:
+            self.jump(1)
+
+    def _rebuild_view(self, view_lines):
+        self.view_lines = view_lines
+        if view_lines is None:
+            text = self.store.full_text()[:-1]
+        else:
+            text = "\n".join(self.store.line(i) for i in view_lines)
+        self.setPlainText(text)
         self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
 
+    def _update_count(self):
+        if self.pattern is None:
+            self.search_bar.count_label.setText("")
+            return
+        position = f"{self.current_match + 1}/" if self.current_match >= 0 else ""
+        self.search_bar.count_label.setText(f"{position}{len(self.matches)}")
+
+    def _block_for(self, store_line):
+        if self.view_lines is None:
+            return store_line - len(self.store) + self.doc.blockCount()
+        import bisect
+        return bisect.bisect_left(self.view_lines, store_line)
+
+    def jump(self, step):
+        if not self.matches:
+            return
+        if self.current_match == -1:
+            # Первый переход — к ближайшему совпадению после курсора
+            import bisect
+            block = self.textCursor().blockNumber()
+            line = self.store_index(block)
+            if line is None:
+                line = len(self.store)
+            self.current_match = bisect.bisect_left(self.matches, (line, 0, 0)) % len(self.matches)
+            if step < 0:
+                self.current_match = (self.current_match - 1) % len(self.matches)
+        else:
+            self.current_match = (self.current_match + step) % len(self.matches)
+        line, start, end = self.matches[self.current_match]
+        block = self.document().findBlockByNumber(self._block_for(line))
+        cursor = QTextCursor(block)
+        cursor.setPosition(block.position() + start)
+        cursor.setPosition(block.position() + min(end, block.length() - 1), QTextCursor.KeepAnchor)
+        self.setTextCursor(cursor)
+        self.centerCursor()
+        selection = QTextEdit.ExtraSelection()
+        selection.cursor = cursor
+        selection.format.setBackground(QColor("#3e4451"))
+        self.setExtraSelections([selection])
+        self._update_count()
+
+def format_bytes(value):
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if abs(value) < 1024 or unit == "ГБ":
+            return f"{value:.0f} {unit}" if unit == "Б" else f"{value:.1f} {unit}"
+        value /= 1024
+
 class ModelDownloader(QThread):
-    progress = pyqtSignal(str)
-    finished = pyqtSignal(str)
+    progress = pyqtSignal(dict)
+    status = pyqtSignal(str)
+    finished = pyqtSignal(bool, str)
+
+    PROGRESS_INTERVAL = 0.25
+    MAX_RETRIES = 5
+    READ_TIMEOUT = 120
+
     def __init__(self, model_name):
         super().__init__()
         self.model_name = model_name
+        self.cancelled = False
+        self.layers = {}
+        self.speed = 0.0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        import requests
+        pool = EndpointPool.instance()
+        data = {"name": self.model_name, "stream": True}
+        attempt = 0
+        while True:
+            # Сервер выбирается на каждой попытке: после сбоя загрузка переходит на другой
+            endpoint = pool.candidates(self.model_name)[0]
+            try:
+                # Таймаут только на подключение и паузу между строками, а не на всю загрузку
+                with requests.post(f"{endpoint.url}/api/pull", json=data, stream=True,
+                                   timeout=(10, self.READ_TIMEOUT)) as resp:
+                    resp.raise_for_status()
+                    if self._consume(resp):
+                        return
+                if self.cancelled:
+                    self.finished.emit(False, f"[Ollama] Загрузка модели '{self.model_name}' отменена.")
+                    return
+                # Сервер сам закрыл поток без ошибки — он доступен, поэтому сбой ему не засчитывается
+                error = "поток оборвался до завершения загрузки"
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if not isinstance(e, requests.exceptions.ChunkedEncodingError):
+                    pool.mark_failed(endpoint, e)
+                error = e
+            except Exception as e:
+                self.finished.emit(False, f"[Ошибка Ollama] Не удалось загрузить модель '{self.model_name}': {e}")
+                return
+            attempt += 1
+            if self.cancelled or attempt > self.MAX_RETRIES:
+                self.finished.emit(False, f"[Ошибка Ollama] Не удалось загрузить модель '{self.model_name}': {error}")
+                return
+            # Ollama продолжит докачку уже скачанных слоёв при повторном запросе
+            delay = min(2 ** attempt, 30)
+            self.status.emit(f"Соединение потеряно, повтор {attempt}/{self.MAX_RETRIES} через {delay} с...")
+            for _ in range(delay * 10):
+                if self.cancelled:
+                    break
+                time.sleep(0.1)
+
+    def _consume(self, resp):
+        last_status = None
+        last_emit = 0.0
+        last_sample = (time.perf_counter(), self._completed())
+        for line in resp.iter_lines():
+            if self.cancelled:
+                return False
+            if not line:
+                continue
+            try:
+                info = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if info.get("error"):
+                raise RuntimeError(info["error"])
+            status = info.get("status", "")
+            digest = info.get("digest")
+            if digest and info.get("total"):
+                self.layers[digest] = (info.get("completed", 0), info["total"])
+            if status == "success":
+                self._emit_progress(status)
+                self.finished.emit(True, f"[Ollama] Модель '{self.model_name}' успешно загружена.")
+                return True
+            if not digest and status != last_status:
+                self.status.emit(status)
+                last_status = status
+            now = time.perf_counter()
+            if now - last_emit >= self.PROGRESS_INTERVAL:
+                sample_time, sample_done = last_sample
+                if now > sample_time:
+                    rate = (self._completed() - sample_done) / (now - sample_time)
+                    self.speed = rate if not self.speed else 0.7 * self.speed + 0.3 * rate
+                last_sample = (now, self._completed())
+                self._emit_progress(status)
+                last_emit = now
+        return False
+
+    def _completed(self):
+        return sum(done for done, _ in self.layers.values())
+
+    def _emit_progress(self, status):
+        total = sum(t for _, t in self.layers.values())
+        self.progress.emit({
+            "status": status,
+            "completed": self._completed(),
+            "total": total,
+            "layers": len(self.layers),
+            "speed": self.speed,
+        })
+
+class PullManager(QObject):
+    queued = pyqtSignal(str)
+    started = pyqtSignal(str)
+    progress = pyqtSignal(str, dict)
+    status = pyqtSignal(str, str)
+    finished = pyqtSignal(str, bool, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.queue = []
+        self.current = None
+
+    def enqueue(self, model_name):
+        if model_name in self.queue or (self.current and self.current.model_name == model_name):
+            return
+        self.queue.append(model_name)
+        self.queued.emit(model_name)
+        self._next()
+
+    def cancel(self, model_name):
+        if model_name in self.queue:
+            self.queue.remove(model_name)
+            self.finished.emit(model_name, False, f"[Ollama] Загрузка модели '{model_name}' отменена.")
+        elif self.current and self.current.model_name == model_name:
+            self.current.cancel()
+
+    def is_busy(self):
+        return self.current is not None or bool(self.queue)
+
+    def _next(self):
+        if self.current is not None or not self.queue:
+            return
+        name = self.queue.pop(0)
+        worker = ModelDownloader(name)
+        worker.progress.connect(lambda info, n=name: self.progress.emit(n, info))
+        worker.status.connect(lambda text, n=name: self.status.emit(n, text))
+        worker.finished.connect(lambda ok, msg, w=worker: self._on_finished(w, ok, msg))
+        self.current = worker
+        self.started.emit(name)
+        worker.start()
+
+    def _on_finished(self, worker, ok, msg):
+        worker.wait()
+        self.current = None
+        self.finished.emit(worker.model_name, ok, msg)
+        self._next()
+
+class PullPanel(QWidget):
+    def __init__(self, manager, parent=None):
+        super().__init__(parent)
+        self.manager = manager
+        self.rows = {}
+        self.rows_layout = QVBoxLayout(self)
+        self.rows_layout.setContentsMargins(0, 4, 0, 4)
+        self.total_label = QLabel()
+        self.total_bar = QProgressBar()
+        self.total_bar.setTextVisible(True)
+        self.rows_layout.addWidget(self.total_label)
+        self.rows_layout.addWidget(self.total_bar)
+        self.stats = {}
+        manager.queued.connect(self.add_row)
+        manager.started.connect(lambda name: self._set_text(name, "начало загрузки..."))
+        manager.progress.connect(self.update_row)
+        manager.status.connect(self._set_text)
+        manager.finished.connect(self.remove_row)
+        self.hide()
+
+    def add_row(self, name):
+        row = QWidget()
+        row_layout = QHBoxLayout(row)
+        row_layout.setContentsMargins(0, 0, 0, 0)
+        label = QLabel(f"{name}: в очереди")
+        bar = QProgressBar()
+        bar.setMaximumHeight(14)
+        bar.setTextVisible(False)
+        cancel_btn = QPushButton("✖")
+        cancel_btn.setToolTip("Отменить загрузку")
+        cancel_btn.setFixedWidth(36)
+        cancel_btn.clicked.connect(lambda: self.manager.cancel(name))
+        row_layout.addWidget(label, 2)
+        row_layout.addWidget(bar, 3)
+        row_layout.addWidget(cancel_btn)
+        self.rows_layout.addWidget(row)
+        self.rows[name] = (row, label, bar)
+        self.stats[name] = (0, 0)
+        self._update_total()
+        self.show()
+
+    def _set_text(self, name, text):
+        if name in self.rows:
+            self.rows[name][1].setText(f"{name}: {text}")
+
+    def update_row(self, name, info):
+        if name not in self.rows:
+            return
+        _, label, bar = self.rows[name]
+        completed, total = info["completed"], info["total"]
+        if total:
+            bar.setMaximum(1000)
+            bar.setValue(int(completed * 1000 / total))
+            text = f"{name}: {format_bytes(completed)} / {format_bytes(total)}"
+            if info["speed"] > 0:
+                eta = (total - completed) / info["speed"]
+                text += f", {format_bytes(info['speed'])}/с, осталось {int(eta // 60)}:{int(eta % 60):02d}"
+            label.setText(text)
+        self.stats[name] = (completed, total)
+        self._update_total()
+
+    def remove_row(self, name, ok, msg):
+        row = self.rows.pop(name, None)
+        self.stats.pop(name, None)
+        if row:
+            row[0].deleteLater()
+        self._update_total()
+        if not self.rows:
+            self.hide()
+
+    def _update_total(self):
+        completed = sum(c for c, _ in self.stats.values())
+        total = sum(t for _, t in self.stats.values())
+        self.total_label.setText(f"Загрузки моделей: {len(self.rows)}" +
+                                 (f" — {format_bytes(completed)} из {format_bytes(total)}" if total else ""))
+        self.total_bar.setMaximum(1000)
+        self.total_bar.setValue(int(completed * 1000 / total) if total else 0)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def ollama_metrics(model, info, ttft, total):
+    # Длительности Ollama приходят в наносекундах
+    ms = lambda key: info.get(key, 0) / 1e6
+    prompt_ms = ms("prompt_eval_duration")
+    eval_ms = ms("eval_duration")
+    return {
+        "model": model,
+        "ttft_ms": ttft * 1000 if ttft is not None else None,
+        "total_ms": total * 1000,
+        "load_ms": ms("load_duration"),
+        "prompt_eval_count": info.get("prompt_eval_count", 0),
+        "prompt_eval_ms": prompt_ms,
+        "prompt_tps": info.get("prompt_eval_count", 0) / (prompt_ms / 1000) if prompt_ms else 0.0,
+        "eval_count": info.get("eval_count", 0),
+        "eval_ms": eval_ms,
+        "eval_tps": info.get("eval_count", 0) / (eval_ms / 1000) if eval_ms else 0.0,
+    }
+
+def format_metrics(m):
+    parts = []
+    if m["ttft_ms"] is not None:
+        parts.append(f"1-й токен {m['ttft_ms'] / 1000:.2f} с")
+    parts.append(f"всего {m['total_ms'] / 1000:.2f} с")
+    if m["load_ms"] >= 1:
+        parts.append(f"загрузка модели {m['load_ms'] / 1000:.2f} с")
+    parts.append(f"промпт {m['prompt_eval_count']} ток. за {m['prompt_eval_ms'] / 1000:.2f} с")
+    parts.append(f"ответ {m['eval_count']} ток., {m['eval_tps']:.1f} ток/с")
+    return " · ".join(parts)
+
+class LlmStats(QObject):
+    updated = pyqtSignal(str)
+    WINDOW = 100
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.samples = {}
+
+    def add(self, metrics):
+        from collections import deque
+        self.samples.setdefault(metrics["model"], deque(maxlen=self.WINDOW)).append(metrics)
+        self.updated.emit(metrics["model"])
+
+    def summary(self, model):
+        samples = list(self.samples.get(model, ()))
+        result = {"count": len(samples)}
+        for key in ("ttft_ms", "total_ms", "load_ms", "prompt_eval_count", "prompt_eval_ms", "eval_tps"):
+            values = [m[key] for m in samples if m[key] is not None]
+            result[key] = (percentile(values, 50), percentile(values, 95))
+        return result
+
+class LlmStatsDialog(QDialog):
+    COLUMNS = [
+        ("ttft_ms", "1-й токен, мс"),
+        ("total_ms", "Всего, мс"),
+        ("load_ms", "Загрузка, мс"),
+        ("prompt_eval_count", "Промпт, ток."),
+        ("prompt_eval_ms", "Промпт, мс"),
+        ("eval_tps", "Ток/с"),
+    ]
+
+    def __init__(self, stats, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f"Статистика моделей (последние {LlmStats.WINDOW} запросов, p50 / p95)")
+        self.resize(900, 300)
+        self.stats = stats
+        self.table = QTableWidget(0, len(self.COLUMNS) + 2)
+        self.table.setHorizontalHeaderLabels(["Модель", "Запросов"] + [title for _, title in self.COLUMNS])
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.table)
+        stats.updated.connect(self.refresh)
+        self.refresh()
+
+    def refresh(self, *_):
+        models = sorted(self.stats.samples)
+        self.table.setRowCount(len(models))
+        for row, model in enumerate(models):
+            summary = self.stats.summary(model)
+            values = [model, str(summary["count"])]
+            for key, _ in self.COLUMNS:
+                p50, p95 = summary[key]
+                values.append(f"{p50:.0f} / {p95:.0f}" if key != "eval_tps" else f"{p50:.1f} / {p95:.1f}")
+            for col, value in enumerate(values):
+                self.table.setItem(row, col, QTableWidgetItem(value))
+
+class ModelListWorker(QThread):
+    result = pyqtSignal(list)
+
     def run(self):
+        # Модели со всех доступных серверов пула; если ни один не ответил — локальный `ollama list`
+        pool = EndpointPool.instance()
+        pool.probe_all()
+        names = pool.available_models()
+        if names:
+            self.result.emit([tuple(name.split(":", 1)) for name in sorted(names)])
+            return
+        command = ["cmd", "/c", "ollama list"] if os.name == "nt" else ["ollama", "list"]
+        models = []
+        try:
+            result = subprocess.run(command, capture_output=True, text=True, timeout=5)
+            for line in result.stdout.splitlines()[1:]:
+                if not line.strip():
+                    continue
+                name = line.split()[0]
+                if ":" in name:
+                    model_name, version = name.split(":", 1)
+                else:
+                    model_name, version = name, None
+                models.append((model_name, version))
+        except Exception:
+            models = []
+        self.result.emit(models)
+
+# --- Пул серверов Ollama ---
+# Список серверов: OLLAMA_HOSTS="host1:11434,host2:11434" или {"endpoints": [...]} в ~/.minicrusor_endpoints.json.
+# Без настройки пул состоит из одного OLLAMA_HOST.
+ENDPOINTS_FILE = os.path.expanduser("~/.minicrusor_endpoints.json")
+ENDPOINT_PROBE_INTERVAL_S = 10
+ENDPOINT_PROBE_TIMEOUT_S = 2
+
+def model_key(name):
+    return name if ":" in name else f"{name}:latest"
+
+def load_endpoints():
+    hosts = [h.strip() for h in os.environ.get("OLLAMA_HOSTS", "").split(",") if h.strip()]
+    if not hosts:
+        try:
+            with open(ENDPOINTS_FILE, "r", encoding="utf-8") as f:
+                hosts = [str(h) for h in json.load(f).get("endpoints", [])]
+        except (OSError, ValueError, AttributeError):
+            hosts = []
+    return list(dict.fromkeys(normalize_host(h) for h in hosts)) or [ollama_host()]
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        # None — ещё не проверялся: такой сервер считается доступным
+        self.healthy = None
+        self.models = set()
+        self.resident = set()
+        self.inflight = 0
+        self.served = 0
+        self.latency_ms = None
+        self.error = ""
+        self.checked = 0.0
+
+class EndpointPool:
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, urls=None):
+        self.endpoints = [Endpoint(url) for url in (urls or load_endpoints())]
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name="ollama-probe", daemon=True)
+            self.thread.start()
+
+    def shutdown(self):
+        self.stopped = True
+        self.wake.set()
+
+    def _loop(self):
+        while not self.stopped:
+            self.probe_all()
+            self.wake.wait(ENDPOINT_PROBE_INTERVAL_S)
+            self.wake.clear()
+
+    def probe_all(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(self.endpoints)) as executor:
+            list(executor.map(self.probe, self.endpoints))
+
+    def probe(self, endpoint):
         import requests
-        url = "http://localhost:11434/api/pull"
-        data = {"name": self.model_name}
-        last_msg = None
-        file_size_reported = False
+        start = time.perf_counter()
         try:
-            with requests.post(url, json=data, stream=True, timeout=300) as resp:
+            tags = requests.get(f"{endpoint.url}/api/tags", timeout=ENDPOINT_PROBE_TIMEOUT_S)
+            tags.raise_for_status()
+            latency = (time.perf_counter() - start) * 1000
+            ps = requests.get(f"{endpoint.url}/api/ps", timeout=ENDPOINT_PROBE_TIMEOUT_S)
+            ps.raise_for_status()
+            models = {m["name"] for m in tags.json().get("models", [])}
+            resident = {m["name"] for m in ps.json().get("models", [])}
+        except Exception as e:
+            with self.lock:
+                endpoint.healthy = False
+                endpoint.error = str(e)
+                endpoint.checked = time.time()
+            return
+        with self.lock:
+            endpoint.healthy = True
+            endpoint.error = ""
+            endpoint.models = models
+            endpoint.resident = resident
+            endpoint.latency_ms = latency
+            endpoint.checked = time.time()
+
+    def candidates(self, model):
+        """Серверы в порядке предпочтения: модель уже в памяти, модель скачана, меньше запросов, быстрее отклик."""
+        self.start()
+        key = model_key(model or "")
+        with self.lock:
+            usable = [e for e in self.endpoints if e.healthy is not False] or list(self.endpoints)
+
+            def rank(e):
+                return (key not in e.resident, bool(e.models) and key not in e.models, e.inflight,
+                        e.latency_ms if e.latency_ms is not None else float("inf"))
+            return sorted(usable, key=rank)
+
+    def mark_failed(self, endpoint, error):
+        with self.lock:
+            endpoint.healthy = False
+            endpoint.error = str(error)
+        # Внеочередная проверка: вернувшийся сервер снова попадёт в пул
+        self.wake.set()
+
+    def call(self, model, send):
+        """send(url) выполняет запрос. Если сервер недоступен, запрос уходит следующему.
+        Обрыв после начала ответа send должен поднимать как обычную ошибку, а не ConnectionError."""
+        import requests
+        errors = []
+        for endpoint in self.candidates(model):
+            with self.lock:
+                endpoint.inflight += 1
+            try:
+                result = send(endpoint.url)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.mark_failed(endpoint, e)
+                errors.append(f"{endpoint.url}: {e}")
+                continue
+            finally:
+                with self.lock:
+                    endpoint.inflight -= 1
+            with self.lock:
+                endpoint.served += 1
+                # Ollama держит модель в памяти после ответа; следующая проверка уточнит
+                if model:
+                    endpoint.resident.add(model_key(model))
+            return result
+        raise ConnectionError("нет доступных серверов Ollama (" + "; ".join(errors) + ")")
+
+    def available_models(self):
+        with self.lock:
+            return set().union(*(e.models for e in self.endpoints if e.healthy))
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(vars(e), models=sorted(e.models), resident=sorted(e.resident)) for e in self.endpoints]
+
+class EndpointsDialog(QDialog):
+    COLUMNS = ["Сервер", "Состояние", "Отклик, мс", "Запросов сейчас", "Обслужено", "В памяти", "Ошибка"]
+
+    def __init__(self, pool, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Серверы Ollama")
+        self.resize(900, 250)
+        self.pool = pool
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        probe_btn = QPushButton("Проверить сейчас")
+        probe_btn.clicked.connect(pool.wake.set)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.table)
+        layout.addWidget(probe_btn)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000)
+        pool.start()
+        self.refresh()
+
+    def refresh(self):
+        endpoints = self.pool.snapshot()
+        self.table.setRowCount(len(endpoints))
+        for row, e in enumerate(endpoints):
+            state = {True: "🟢 доступен", False: "🔴 недоступен", None: "⚪ проверяется"}[e["healthy"]]
+            latency = f"{e['latency_ms']:.0f}" if e["latency_ms"] is not None else "—"
+            values = [e["url"], state, latency, str(e["inflight"]), str(e["served"]), ", ".join(e["resident"]), e["error"]]
+            for col, value in enumerate(values):
+                self.table.setItem(row, col, QTableWidgetItem(value))
+
+def ollama_generate(prompt, model, on_token=None, timeout=120, options=None):
+    # Общий клиент /api/generate для GUI и пакетного режима: возвращает текст ответа и метрики
+    data = {"model": model, "prompt": prompt}
+    return _ollama_stream("/api/generate", data, lambda info: info.get("response", ""), on_token, timeout, options)
+
+def ollama_chat(messages, model, on_token=None, timeout=120, options=None):
+    # /api/chat: история диалога передаётся списком сообщений {"role", "content"}
+    data = {"model": model, "messages": messages}
+    return _ollama_stream("/api/chat", data, lambda info: (info.get("message") or {}).get("content", ""),
+                          on_token, timeout, options)
+
+def _ollama_stream(path, data, token_of, on_token, timeout, options=None):
+    import requests
+    model = data["model"]
+    data = dict(data, stream=True,
+                # Явный размер контекста, под который считается бюджет; иначе Ollama молча обрежет промпт
+                options={"num_ctx": model_num_ctx(model), **(options or {})})
+    start = time.perf_counter()
+
+    def send(host):
+        ttft = None
+        chunks = []
+        info = {}
+        try:
+            with requests.post(f"{host}{path}", json=data, stream=True, timeout=timeout) as resp:
                 resp.raise_for_status()
                 for line in resp.iter_lines():
                     if not line:
                         continue
-                    try:
-                        info = json.loads(line)
-                        status = info.get("status", "")
-                        if status != last_msg:
-                            if "pulling manifest" in status:
-                                self.progress.emit(f"Получение манифеста...")
-                            elif "verifying" in status:
-                                self.progress.emit(f"Проверка...")
-                            elif "downloading" in status and not file_size_reported:
-                                total = info.get("total", 0)
-                                if total > 0:
-                                    self.progress.emit(f"Размер файла: {total/1e9:.2f} GB")
-                                    file_size_reported = True
-                            last_msg = status
-                        
-                        progress = info.get("progress", "")
-                        percent_str = ""
-                        if progress and "/" in progress:
-                            try:
-                                left, right = progress.split("/")
-                                left_val, left_unit = left.strip().split()
-                                right_val, right_unit = right.strip().split()
-                                def to_bytes(val, unit):
-                                    val = float(val)
-                                    if unit.lower().startswith("k"): return val * 1024
-                                    if unit.lower().startswith("m"): return val * 1024**2
-                                    if unit.lower().startswith("g"): return val * 1024**3
-                                    return val
-                                left_b = to_bytes(left_val, left_unit)
-                                right_b = to_bytes(right_val, right_unit)
-                                if right_b > 0:
-                                    percent = (left_b / right_b) * 100
-                                    percent_str = f"{int(percent)}%"
-                                self.progress.emit(f"Загрузка: {progress} ({percent_str})")
-                            except ValueError:
-                                self.progress.emit(f"Загрузка: {progress}")
-
-                    except json.JSONDecodeError:
-                        self.progress.emit(f"Не удалось обработать: {line}")
-
-            self.finished.emit(f"[Ollama] Модель '{self.model_name}' успешно загружена.")
+                    info = json.loads(line)
+                    if info.get("error"):
+                        raise RuntimeError(info["error"])
+                    token = token_of(info)
+                    if token:
+                        if ttft is None:
+                            ttft = time.perf_counter() - start
+                        if on_token:
+                            on_token(token)
+                    chunks.append(token)
+                    if info.get("done"):
+                        break
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # Часть ответа уже показана: повтор на другом сервере её продублирует
+            if ttft is not None:
+                raise RuntimeError(f"соединение с {host} оборвалось: {e}") from e
+            raise
+        return "".join(chunks), ollama_metrics(model, info, ttft, time.perf_counter() - start)
+
+    return EndpointPool.instance().call(model, send)
+
+def build_prompt(user_text, code=None, language="python"):
+    if not code:
+        return user_text
+    return (f"Пожалуйста, ответь на мой вопрос, учитывая следующий код из моего редактора:\n\n"
+            f"```{language or ''}\n{code}\n```\n\n"
+            f"Мой вопрос: {user_text}")
+
+# --- Контекст кода для запроса с учётом бюджета токенов ---
+# Размер контекста (num_ctx), который запрашивается у Ollama для модели
+MODEL_NUM_CTX = {
+    "llama2": 4096,
+    "llama3": 8192,
+    "codellama": 16384,
+    "phi3": 4096,
+    "mistral": 8192,
+    "gemma": 8192,
+}
+DEFAULT_NUM_CTX = 4096
+ANSWER_RESERVE_TOKENS = 1024
+
+def model_num_ctx(model):
+    return MODEL_NUM_CTX.get((model or "").split(":")[0], DEFAULT_NUM_CTX)
+
+def estimate_tokens(text):
+    # Грубая оценка: для кода токен в среднем занимает около 3.5 символов
+    return int(len(text) / 3.5) + 1
+
+def context_budget(model, question, reserved=0):
+    # reserved — токены, уже занятые историей диалога
+    overhead = estimate_tokens(build_prompt(question, " "))
+    return max(256, model_num_ctx(model) - ANSWER_RESERVE_TOKENS - overhead - reserved)
+
+def _skeleton_plan(tree, lines, detail):
+    # Возвращает строки, которые остаются как есть, и замены для сокращённых docstring
+    keep = set()
+    replace = {}
+
+    def docstring_node(node):
+        body = getattr(node, "body", None)
+        if body and isinstance(body[0], ast.Expr) and isinstance(getattr(body[0], "value", None), ast.Constant) \
+                and isinstance(body[0].value.value, str):
+            return body[0]
+        return None
+
+    def add_docstring(node, level):
+        doc = docstring_node(node)
+        if doc is None or detail >= 2 + level:
+            return
+        if detail == 0 or doc.lineno == doc.end_lineno:
+            keep.update(range(doc.lineno - 1, doc.end_lineno))
+        else:
+            first = doc.value.value.strip().splitlines()[0] if doc.value.value.strip() else ""
+            indent = lines[doc.lineno - 1][:len(lines[doc.lineno - 1]) - len(lines[doc.lineno - 1].lstrip())]
+            replace[doc.lineno - 1] = f'{indent}"""{first}"""'
+
+    def visit(nodes, level):
+        for node in nodes:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                if level > 0 and detail >= 3:
+                    continue
+                start = min([d.lineno for d in node.decorator_list] + [node.lineno])
+                first_body = node.body[0]
+                header_end = max(first_body.lineno - 1, node.lineno)
+                if first_body.lineno == node.lineno:
+                    header_end = node.lineno
+                keep.update(range(start - 1, header_end))
+                add_docstring(node, level)
+                if isinstance(node, ast.ClassDef):
+                    visit(node.body, level + 1)
+            elif level == 0 and isinstance(node, (ast.Import, ast.ImportFrom)):
+                keep.update(range(node.lineno - 1, node.end_lineno))
+            elif level == 0 and detail <= 1 and isinstance(node, (ast.Assign, ast.AnnAssign)) \
+                    and node.end_lineno - node.lineno < 3:
+                keep.update(range(node.lineno - 1, node.end_lineno))
+            elif level == 1 and detail == 0 and isinstance(node, (ast.Assign, ast.AnnAssign)) \
+                    and node.end_lineno == node.lineno:
+                keep.update(range(node.lineno - 1, node.end_lineno))
+
+    add_docstring(tree, -1)
+    visit(tree.body, 0)
+    return keep, replace
+
+def _render_plan(lines, keep, replace):
+    out = []
+    i = 0
+    while i < len(lines):
+        if i in replace:
+            out.append(replace[i])
+            i += 1
+            while i < len(lines) and i not in keep and i not in replace and not lines[i].strip() == "":
+                i += 1
+            continue
+        if i in keep:
+            out.append(lines[i])
+            i += 1
+            continue
+        start = i
+        while i < len(lines) and i not in keep and i not in replace:
+            i += 1
+        omitted = [l for l in lines[start:i] if l.strip()]
+        if omitted:
+            indent = omitted[0][:len(omitted[0]) - len(omitted[0].lstrip())]
+            out.append(f"{indent}...  # строки {start + 1}–{i} опущены")
+    return "\n".join(out)
+
+def _focus_range(lines, focus, budget):
+    # Строки вокруг курсора/выделения, расширяемые поровну вверх и вниз, пока хватает бюджета
+    if focus is None:
+        return None
+    start, end = max(0, focus[0]), min(len(lines) - 1, max(focus[0], focus[1]))
+    used = sum(estimate_tokens(l + "\n") for l in lines[start:end + 1])
+    while used > budget and end > start:
+        used -= estimate_tokens(lines[end] + "\n")
+        end -= 1
+    grew = True
+    while grew:
+        grew = False
+        for step in (-1, 1):
+            idx = start - 1 if step < 0 else end + 1
+            if 0 <= idx < len(lines):
+                cost = estimate_tokens(lines[idx] + "\n")
+                if used + cost <= budget:
+                    used += cost
+                    if step < 0:
+                        start = idx
+                    else:
+                        end = idx
+                    grew = True
+    return start, end
+
+def build_code_context(source, budget, focus=None, language="python"):
+    # Весь файл, если помещается; иначе фрагмент у курсора дословно, остальное — сигнатуры и docstring
+    full_tokens = estimate_tokens(source)
+    info = {"original_tokens": full_tokens, "sent_tokens": full_tokens, "budget": budget,
+            "verbatim": None, "mode": "full"}
+    if full_tokens <= budget:
+        return source, info
+
+    lines = source.splitlines()
+    tree = None
+    if language == "python":
+        try:
+            tree = ast.parse(source)
+        except (SyntaxError, ValueError):
+            tree = None
+
+    def render(focus_range, detail):
+        if tree is None:
+            return _render_plan(lines, set(range(focus_range[0], focus_range[1] + 1)), {})
+        keep, replace = _skeleton_plan(tree, lines, detail)
+        keep.update(range(focus_range[0], focus_range[1] + 1))
+        for line in range(focus_range[0], focus_range[1] + 1):
+            replace.pop(line, None)
+        return _render_plan(lines, keep, replace)
+
+    focus_share = 0.6 if tree is not None else 1.0
+    if focus is None:
+        focus = (0, 0)
+    focus_range = _focus_range(lines, focus, int(budget * focus_share))
+    while True:
+        text = None
+        for detail in range(4 if tree is not None else 1):
+            candidate = render(focus_range, detail)
+            used = estimate_tokens(candidate)
+            if used <= budget:
+                text = candidate
+                info["mode"] = "skeleton" if tree is not None else "window"
+                # Остаток бюджета отдаём под дословный фрагмент
+                focus_cost = sum(estimate_tokens(l + "\n") for l in lines[focus_range[0]:focus_range[1] + 1])
+                wider = _focus_range(lines, focus_range, focus_cost + budget - used)
+                if wider != focus_range:
+                    candidate = render(wider, detail)
+                    if estimate_tokens(candidate) <= budget:
+                        text, focus_range = candidate, wider
+                break
+        if text is not None or focus_range[1] <= focus_range[0]:
+            break
+        # Даже самый краткий скелет не помещается — сужаем фрагмент у курсора
+        shrink = max(1, (focus_range[1] - focus_range[0]) // 4)
+        center = min(max(focus[0], focus_range[0]), focus_range[1])
+        narrower = (max(focus_range[0], center - shrink), min(focus_range[1], center + shrink))
+        # Узкий диапазон может не сжаться — тогда сразу оставляем одну строку курсора
+        focus_range = narrower if narrower != focus_range else (center, center)
+    if text is None:
+        text = source[:int(budget * 3.5)]
+        info["mode"] = "truncated"
+    info["sent_tokens"] = estimate_tokens(text)
+    info["verbatim"] = (focus_range[0] + 1, focus_range[1] + 1)
+    return text, info
+
+def format_context_info(info):
+    if info["mode"] == "full":
+        return f"Контекст: файл целиком, ~{info['original_tokens']} ток."
+    saved = 100 - info["sent_tokens"] * 100 // max(1, info["original_tokens"])
+    first, last = info["verbatim"]
+    details = {
+        "skeleton": f"строки {first}–{last} полностью, остальное — сигнатуры и docstring",
+        "window": f"только строки {first}–{last}",
+        "truncated": "файл обрезан по бюджету",
+    }[info["mode"]]
+    return (f"Контекст: ~{info['sent_tokens']} из ~{info['original_tokens']} ток. "
+            f"(бюджет {info['budget']}, экономия {saved}%): {details}")
+
+# --- Диалоги: история для /api/chat с пересказом старых ходов ---
+# Доля окна модели (без резерва на ответ), которую может занять история; остальное — код и вопрос
+CHAT_HISTORY_SHARE = 0.4
+# После пересказа дословно остаётся не больше этой доли бюджета истории, чтобы не пересказывать каждый ход
+CHAT_KEEP_SHARE = 0.5
+CHAT_SUMMARY_TOKENS = 400
+CHAT_TITLE_CHARS = 40
+SUMMARY_PROMPT = (
+    "Кратко перескажи разговор пользователя с ассистентом-программистом. Сохрани вопросы пользователя, "
+    "принятые решения, имена файлов, функций и переменных, нерешённые задачи. Не добавляй ничего от себя. "
+    "Пиши сжато, без вступления.\n\n"
+)
+
+def history_budget(model):
+    return int((model_num_ctx(model) - ANSWER_RESERVE_TOKENS) * CHAT_HISTORY_SHARE)
+
+def message_tokens(message):
+    # Плюс несколько служебных токенов на роль и разметку сообщения
+    return estimate_tokens(message["content"]) + 4
+
+def fit_history(history, budget):
+    """Сообщения для /api/chat: пересказ ранних ходов и последние ходы дословно, сколько войдёт в budget.
+    history — {"summary": пересказ, "messages": ещё не пересказанные сообщения}."""
+    prefix = []
+    used = 0
+    if history.get("summary"):
+        prefix.append({"role": "system",
+                       "content": f"Краткое содержание предыдущей части разговора:\n{history['summary']}"})
+        used = message_tokens(prefix[0])
+    messages = history.get("messages", [])
+    start = len(messages)
+    # Ходы берутся целиком (вопрос и ответ), начиная с последнего
+    while start >= 2:
+        cost = message_tokens(messages[start - 2]) + message_tokens(messages[start - 1])
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 2
+    return prefix + messages[start:]
+
+def fold_point(messages, budget):
+    """Сколько первых сообщений пора пересказать: 0, пока история целиком входит в бюджет.
+    Последний ход (вопрос и ответ) не пересказывается никогда, даже если один превышает бюджет."""
+    if sum(map(message_tokens, messages)) <= budget:
+        return 0
+    keep = len(messages)
+    used = 0
+    while keep >= 2:
+        cost = message_tokens(messages[keep - 2]) + message_tokens(messages[keep - 1])
+        if used + cost > budget * CHAT_KEEP_SHARE:
+            break
+        used += cost
+        keep -= 2
+    return max(0, min(keep, len(messages) - 2))
+
+def summarize_turns(summary, messages, model):
+    names = {"user": "Пользователь", "assistant": "Ассистент"}
+    parts = [SUMMARY_PROMPT]
+    if summary:
+        parts.append(f"Пересказ более ранней части:\n{summary}\n\n")
+    parts.append("Продолжение разговора:\n")
+    parts += [f"{names.get(m['role'], m['role'])}: {m['content']}\n" for m in messages]
+    text, _metrics = ollama_generate("".join(parts), model, options={"num_predict": CHAT_SUMMARY_TOKENS})
+    return text.strip()
+
+class ChatThreads:
+    # Каждый диалог — отдельный JSON: все сообщения, пересказ и сколько первых сообщений он покрывает.
+    # Пересказ сохраняется вместе с диалогом, поэтому при повторном открытии он не считается заново.
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, root=None):
+        self.root = root or os.path.join(APP_DATA_DIR, "chats")
+        self.threads = None
+        self.executor = None
+
+    def _load(self):
+        if self.threads is not None:
+            return
+        self.threads = {}
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.root, name), "r", encoding="utf-8") as f:
+                    thread = json.load(f)
+                self.threads[thread["id"]] = thread
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[chats] не удалось прочитать {name}: {e}", file=sys.stderr)
+
+    def recent(self):
+        self._load()
+        return sorted(self.threads.values(), key=lambda t: t["updated"], reverse=True)
+
+    def get(self, thread_id):
+        self._load()
+        return self.threads.get(thread_id)
+
+    def create(self):
+        # Пустой диалог на диск не пишется: файл появится с первым ответом
+        self._load()
+        now = time.time()
+        thread = {"id": f"{int(now * 1000):x}", "title": "", "created": now, "updated": now,
+                  "messages": [], "summary": "", "summarized": 0}
+        self.threads[thread["id"]] = thread
+        return thread
+
+    def history(self, thread):
+        return {"summary": thread["summary"], "messages": list(thread["messages"][thread["summarized"]:])}
+
+    def add_turn(self, thread, question, answer, replace_last=False):
+        if replace_last and thread["messages"]:
+            thread["messages"][-1] = {"role": "assistant", "content": answer}
+        else:
+            thread["messages"] += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+        if not thread["title"]:
+            thread["title"] = " ".join(question.split())[:CHAT_TITLE_CHARS]
+        thread["updated"] = time.time()
+        self.save(thread)
+
+    def set_summary(self, thread, summary, summarized):
+        thread["summary"] = summary
+        thread["summarized"] = summarized
+        self.save(thread)
+
+    def save(self, thread):
+        from concurrent.futures import ThreadPoolExecutor
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        # Сериализация — здесь, пока диалог не изменился; запись на диск — в фоне
+        data = json.dumps(thread, ensure_ascii=False)
+        self.executor.submit(self._write, os.path.join(self.root, f"{thread['id']}.json"), data)
+
+    def _write(self, path, data):
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            traceback.print_exc()
+
+class SummaryWorker(QThread):
+    result = pyqtSignal(str, str, int, int)
+
+    def __init__(self, thread_id, summary, messages, base, model):
+        super().__init__()
+        self.thread_id = thread_id
+        self.summary = summary
+        self.messages = messages
+        self.base = base
+        self.model = model
+
+    def run(self):
+        try:
+            summary = summarize_turns(self.summary, self.messages, self.model)
         except Exception as e:
-            self.finished.emit(f"[Ошибка Ollama] Не удалось загрузить модель: {e}")
+            # Не вышло — попробуем после следующего хода, а пока история просто обрезается по бюджету
+            print(f"[chats] пересказ не удался: {e}", file=sys.stderr)
+            return
+        if summary:
+            self.result.emit(self.thread_id, summary, self.base, self.base + len(self.messages))
+
+# --- Маршрутизация запросов: быстрая модель для простых, большая для сложных ---
+# Правила проверяются по порядку, срабатывает первое подходящее. Условия: kind (тип запроса)
+# и max_tokens (оценка размера промпта вместе с кодом). route: "fast" или "strong" (выбранная модель).
+ROUTING_FILE = os.path.join(os.path.expanduser("~"), ".minicrusor_routing.json")
+DEFAULT_ROUTING = {
+    "fast_model": "phi3",
+    "rules": [
+        {"name": "пояснение выделения", "kind": "explain", "max_tokens": 3000, "route": "fast"},
+        {"name": "короткий вопрос", "kind": "question", "max_tokens": 600, "route": "fast"},
+        {"name": "по умолчанию", "route": "strong"},
+    ],
+}
+REQUEST_KINDS = {
+    "edit": ("исправ", "перепиш", "рефактор", "оптимиз", "напиши", "реализ", "добав",
+             "fix", "refactor", "rewrite", "implement", "write"),
+    "explain": ("объясни", "поясни", "проанализ", "что делает", "что такое", "explain", "what does"),
+}
+ROUTE_NAMES = {"fast": "быстрая модель", "strong": "большая модель", "manual": "выбрана вручную",
+               "escalated": "переспрошено"}
+
+def load_routing(path=ROUTING_FILE):
+    config = {"fast_model": DEFAULT_ROUTING["fast_model"], "rules": list(DEFAULT_ROUTING["rules"])}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("ожидался JSON-объект с настройками")
+        config.update(data)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"[routing] не удалось прочитать {path}: {e}", file=sys.stderr)
+    return config
+
+def classify_request(text, selection=False):
+    lowered = text.lower()
+    for kind, words in REQUEST_KINDS.items():
+        if any(word in lowered for word in words):
+            return kind
+    return "explain" if selection else "question"
+
+def route_request(config, text, context, strong_model, available=None):
+    fast_model = config["fast_model"]
+    kind = classify_request(text, bool(context and context.get("selection")))
+    tokens = estimate_tokens(text)
+    if context and context.get("selection"):
+        line_from, line_to = context["focus"]
+        tokens += estimate_tokens("".join(context["source"].splitlines(True)[line_from:line_to + 1]))
+    elif context:
+        # Код всё равно будет ужат до бюджета модели, поэтому больше бюджета он не весит
+        tokens += min(estimate_tokens(context["source"]), context_budget(fast_model, text))
+    decision = {"route": "strong", "model": strong_model, "rule": None, "kind": kind, "tokens": tokens}
+    for rule in config["rules"]:
+        if rule.get("kind") not in (None, kind) or tokens > rule.get("max_tokens", tokens):
+            continue
+        decision["rule"] = rule.get("name")
+        if rule.get("route") == "fast" and fast_model != strong_model:
+            if available is None or fast_model.split(":")[0] in available:
+                decision.update(route="fast", model=fast_model)
+        break
+    return decision
+
+def format_route(decision):
+    text = f"{decision['model']} · {ROUTE_NAMES[decision['route']]}"
+    if decision.get("rule"):
+        text += f" · правило «{decision['rule']}»"
+    return text + f" · {decision['kind']}, ~{decision['tokens']} ток."
+
+class CompletionWorker(QThread):
+    result = pyqtSignal(int, str, float)
+
+    def __init__(self, generation, prefix, suffix, model):
+        super().__init__()
+        self.generation = generation
+        self.prefix = prefix
+        self.suffix = suffix
+        self.model = model
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        import requests
+        start = time.perf_counter()
+        data = {
+            "model": self.model,
+            "prompt": self.prefix,
+            "suffix": self.suffix,
+            "stream": True,
+            "keep_alive": "30m",
+            "options": {"num_predict": 64, "temperature": 0.1, "stop": ["\n\n\n"]},
+        }
+        chunks = []
+
+        def send(host):
+            chunks.clear()
+            with requests.post(f"{host}/api/generate", json=data, stream=True, timeout=(2, 10)) as resp:
+                resp.raise_for_status()
+                for line in resp.iter_lines():
+                    # Закрытие соединения останавливает генерацию на стороне Ollama
+                    if self.cancelled:
+                        return
+                    if not line:
+                        continue
+                    info = json.loads(line)
+                    chunks.append(info.get("response", ""))
+                    if info.get("done"):
+                        break
+
+        try:
+            EndpointPool.instance().call(self.model, send)
+        except Exception:
+            return
+        if not self.cancelled:
+            self.result.emit(self.generation, "".join(chunks), (time.perf_counter() - start) * 1000)
+
+CHUNK_INTERVAL = 0.05
+
+def generate_answer(prompt, model, context, emit, cancelled=None, history=None):
+    """Полный цикл запроса к модели. События передаются через emit(имя, данные):
+    context_info, history_info, chunk (токены пачками), metrics и result.
+    С history запрос идёт в /api/chat вместе с историей диалога, иначе — в /api/generate."""
+    messages = None
+    reserved = 0
+    if history is not None:
+        messages = fit_history(history, history_budget(model))
+        reserved = sum(map(message_tokens, messages))
+        turns = sum(1 for m in messages if m["role"] == "user")
+        emit("history_info", {"turns": turns, "summary": bool(history.get("summary")), "tokens": reserved,
+                              "dropped": sum(1 for m in history["messages"] if m["role"] == "user") - turns})
+    if context:
+        # Для больших файлов это разбор ast — поэтому вызывается не из GUI-потока
+        code, info = build_code_context(context["source"], context_budget(model, prompt, reserved),
+                                        context.get("focus"), context.get("language"))
+        emit("context_info", info)
+        prompt = build_prompt(prompt, code, context.get("language"))
+    pending = []
+    last_flush = [time.perf_counter()]
+
+    def on_token(token):
+        if cancelled and cancelled():
+            raise RuntimeError("запрос отменён")
+        # Токены отдаются пачками: событие на каждый токен забивает очередь
+        pending.append(token)
+        if time.perf_counter() - last_flush[0] >= CHUNK_INTERVAL:
+            emit("chunk", "".join(pending))
+            pending.clear()
+            last_flush[0] = time.perf_counter()
+
+    if messages is not None:
+        text, metrics = ollama_chat(messages + [{"role": "user", "content": prompt}], model, on_token)
+    else:
+        text, metrics = ollama_generate(prompt, model, on_token)
+    if pending:
+        emit("chunk", "".join(pending))
+    emit("metrics", metrics)
+    emit("result", text or "Нет ответа в JSON")
 
 class OllamaWorker(QThread):
+    chunk = pyqtSignal(str)
     result = pyqtSignal(str)
+    metrics = pyqtSignal(dict)
+    context_info = pyqtSignal(dict)
+    history_info = pyqtSignal(dict)
     error = pyqtSignal(str)
     finished = pyqtSignal()
 
-    def __init__(self, prompt, model):
+    def __init__(self, prompt, model, context=None, history=None):
         super().__init__()
         self.prompt = prompt
         self.model = model
+        self.context = context
+        self.history = history
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
 
     def run(self):
-        import requests
-        url = "http://localhost:11434/api/generate"
-        data = {
-            "model": self.model,
-            "prompt": self.prompt,
-            "stream": False
-        }
         try:
-            resp = requests.post(url, json=data, timeout=120)
-            resp.raise_for_status()
-            response_data = resp.json()
-            self.result.emit(response_data.get("response", "Нет ответа в JSON"))
+            generate_answer(self.prompt, self.model, self.context, lambda event, data: getattr(self, event).emit(data),
+                            lambda: self.cancelled, self.history)
         except Exception as e:
             self.error.emit(f"Ошибка Ollama: {e}")
         finally:
@@ -397,14 +4057,1042 @@ class ProcessRunner(QObject):
         return_code = self.proc.wait()
         self.finished.emit(return_code)
 
+# --- Фоновый процесс (backend) ---
+# Запросы к Ollama и запуск скриптов выполняются в отдельном процессе (MiniCrusor.py --backend),
+# чтобы их Python-код не делил GIL с отрисовкой. Связь — TCP на 127.0.0.1, кадр = 4 байта длины
+# (big-endian) + JSON. Запрос: {"id", "op", ...}; ответы: {"id", "event", "data"}, последним — "done".
+BACKEND_READY = "MINICRUSOR-BACKEND"
+BACKEND_FRAME = struct.Struct(">I")
+BACKEND_MAX_RESTARTS = 5
+BACKEND_RESTART_WINDOW_S = 60
+
+def encode_frame(message):
+    data = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    return BACKEND_FRAME.pack(len(data)) + data
+
+def decode_frames(buffer):
+    # Разбирает все полные кадры из bytearray и удаляет их из буфера
+    messages = []
+    pos = 0
+    while len(buffer) - pos >= BACKEND_FRAME.size:
+        (size,) = BACKEND_FRAME.unpack_from(buffer, pos)
+        if len(buffer) - pos - BACKEND_FRAME.size < size:
+            break
+        start = pos + BACKEND_FRAME.size
+        messages.append(json.loads(bytes(buffer[start:start + size]).decode("utf-8")))
+        pos = start + size
+    del buffer[:pos]
+    return messages
+
+class BackendServer:
+    def __init__(self, token):
+        from concurrent.futures import ThreadPoolExecutor
+        self.token = token
+        self.conn = None
+        self.write_lock = threading.Lock()
+        self.cancelled = set()
+        self.processes = {}
+        self.executor = ThreadPoolExecutor(max_workers=8)
+        self.handlers = {"generate": self._generate, "run": self._run}
+
+    def send(self, rid, event, data=None):
+        frame = encode_frame({"id": rid, "event": event, "data": data})
+        with self.write_lock:
+            try:
+                self.conn.sendall(frame)
+            except OSError:
+                pass
+
+    def serve(self):
+        import socket
+        listener = socket.create_server(("127.0.0.1", 0))
+        listener.settimeout(60)
+        print(f"{BACKEND_READY} {listener.getsockname()[1]}", flush=True)
+        try:
+            self.conn, _ = listener.accept()
+        finally:
+            listener.close()
+        self.conn.settimeout(None)
+        buffer = bytearray()
+        authorized = False
+        while True:
+            data = self.conn.recv(65536)
+            if not data:
+                break
+            buffer += data
+            for message in decode_frames(buffer):
+                if not authorized:
+                    # Первый кадр — токен из окружения: чужие локальные процессы не подключатся
+                    if message.get("token") != self.token:
+                        return 1
+                    authorized = True
+                    continue
+                self.dispatch(message)
+        # GUI закрылся или упал — запущенные скрипты не должны его пережить
+        for proc in list(self.processes.values()):
+            proc.kill()
+        return 0
+
+    def dispatch(self, message):
+        rid = message.get("id")
+        op = message.get("op")
+        if op == "cancel":
+            self.cancelled.add(message["target"])
+            proc = self.processes.get(message["target"])
+            if proc is not None:
+                proc.kill()
+        elif op in self.handlers:
+            self.executor.submit(self.handlers[op], rid, message)
+        else:
+            self.send(rid, "error", f"Неизвестная операция: {op}")
+            self.send(rid, "done")
+
+    def _generate(self, rid, message):
+        try:
+            generate_answer(message["prompt"], message["model"], message.get("context"),
+                            lambda event, data: self.send(rid, event, data), lambda: rid in self.cancelled,
+                            message.get("history"))
+        except Exception as e:
+            self.send(rid, "error", f"Ошибка Ollama: {e}")
+        finally:
+            self.cancelled.discard(rid)
+            self.send(rid, "done")
+
+    def _run(self, rid, message):
+        try:
+            proc = subprocess.Popen([sys.executable, message["path"]], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, text=True, encoding="utf-8", errors="ignore", bufsize=1)
+        except Exception as e:
+            self.send(rid, "output", f"[Ошибка запуска]: {e}")
+            self.send(rid, "finished", -1)
+            self.send(rid, "done")
+            return
+        self.processes[rid] = proc
+        lines = []
+        last_flush = time.perf_counter()
+        for line in iter(proc.stdout.readline, ""):
+            # Строки вывода уходят пачками, как и токены модели
+            lines.append(line.rstrip())
+            if time.perf_counter() - last_flush >= CHUNK_INTERVAL:
+                self.send(rid, "output", "\n".join(lines))
+                lines = []
+                last_flush = time.perf_counter()
+        if lines:
+            self.send(rid, "output", "\n".join(lines))
+        proc.stdout.close()
+        self.send(rid, "finished", proc.wait())
+        self.processes.pop(rid, None)
+        self.send(rid, "done")
+
+def run_backend():
+    token = os.environ.get("MINICRUSOR_BACKEND_TOKEN", "")
+    return BackendServer(token).serve()
+
+class BackendClient(QObject):
+    ready_changed = pyqtSignal(bool)
+    _instance = None
+    enabled = True
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        super().__init__()
+        self.process = None
+        self.socket = None
+        self.buffer = bytearray()
+        self.ready = False
+        self.stopping = False
+        self.next_id = 1
+        self.calls = {}
+        self.restarts = []
+        self.token = ""
+
+    def is_ready(self):
+        return self.enabled and self.ready
+
+    def start(self):
+        from PyQt5.QtCore import QProcess, QProcessEnvironment
+        import secrets
+        if not self.enabled or self.process is not None:
+            return
+        self.stopping = False
+        self.token = secrets.token_hex(16)
+        env = QProcessEnvironment.systemEnvironment()
+        env.insert("MINICRUSOR_BACKEND_TOKEN", self.token)
+        self.process = QProcess(self)
+        self.process.setProcessEnvironment(env)
+        self.process.setProcessChannelMode(QProcess.ForwardedErrorChannel)
+        self.process.readyReadStandardOutput.connect(self._on_stdout)
+        self.process.finished.connect(self._on_process_finished)
+        self.process.start(sys.executable, [os.path.abspath(__file__), "--backend"])
+
+    def _on_stdout(self):
+        from PyQt5.QtNetwork import QTcpSocket
+        while self.process is not None and self.process.canReadLine():
+            line = bytes(self.process.readLine()).decode("utf-8", "replace").strip()
+            if not line.startswith(BACKEND_READY) or self.socket is not None:
+                continue
+            self.socket = QTcpSocket(self)
+            self.socket.connected.connect(self._on_connected)
+            self.socket.readyRead.connect(self._on_ready_read)
+            self.socket.disconnected.connect(self._on_lost)
+            self.socket.connectToHost("127.0.0.1", int(line.split()[1]))
+
+    def _on_connected(self):
+        self.socket.write(encode_frame({"token": self.token}))
+        self.ready = True
+        self.ready_changed.emit(True)
+
+    def call(self, op, handler, **payload):
+        rid = self.next_id
+        self.next_id += 1
+        self.calls[rid] = handler
+        self.socket.write(encode_frame(dict(payload, id=rid, op=op)))
+        return rid
+
+    def cancel(self, rid):
+        if self.ready and rid in self.calls:
+            self.socket.write(encode_frame({"id": 0, "op": "cancel", "target": rid}))
+
+    def _on_ready_read(self):
+        self.buffer += bytes(self.socket.readAll())
+        for message in decode_frames(self.buffer):
+            handler = self.calls.get(message["id"])
+            if message["event"] == "done":
+                self.calls.pop(message["id"], None)
+            if handler is not None:
+                handler(message["event"], message["data"])
+
+    def _on_process_finished(self, *_):
+        self._on_lost()
+
+    def _on_lost(self):
+        # Процесс упал или соединение оборвалось: ожидающим вызовам — ошибка, процесс — заново
+        if self.process is None and self.socket is None:
+            return
+        was_ready = self.ready
+        self.ready = False
+        socket, self.socket = self.socket, None
+        process, self.process = self.process, None
+        self.buffer = bytearray()
+        if socket is not None:
+            socket.disconnected.disconnect(self._on_lost)
+            socket.abort()
+            socket.deleteLater()
+        if process is not None:
+            process.finished.disconnect(self._on_process_finished)
+            if process.state() != process.NotRunning:
+                process.kill()
+                process.waitForFinished(1000)
+            process.deleteLater()
+        calls, self.calls = self.calls, {}
+        for handler in calls.values():
+            handler("error", "Фоновый процесс завершился, запрос прерван")
+            handler("done", None)
+        if was_ready:
+            self.ready_changed.emit(False)
+        if self.stopping:
+            return
+        now = time.time()
+        self.restarts = [t for t in self.restarts if now - t < BACKEND_RESTART_WINDOW_S] + [now]
+        if len(self.restarts) <= BACKEND_MAX_RESTARTS:
+            print("[backend] фоновый процесс завершился, перезапуск", file=sys.stderr)
+            QTimer.singleShot(500 * len(self.restarts), self.start)
+        else:
+            print("[backend] слишком много перезапусков, работа продолжается в процессе GUI", file=sys.stderr)
+
+    def shutdown(self):
+        self.stopping = True
+        if self.socket is not None:
+            # Закрытие соединения — сигнал фоновому процессу завершиться
+            self.socket.disconnectFromHost()
+        if self.process is not None and not self.process.waitForFinished(2000):
+            self.process.kill()
+        self._on_lost()
+
+class RemoteOllamaWorker(QObject):
+    # Тот же интерфейс, что у OllamaWorker, но запрос выполняет фоновый процесс
+    chunk = pyqtSignal(str)
+    result = pyqtSignal(str)
+    metrics = pyqtSignal(dict)
+    context_info = pyqtSignal(dict)
+    history_info = pyqtSignal(dict)
+    error = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, prompt, model, context=None, history=None):
+        super().__init__()
+        self.prompt = prompt
+        self.model = model
+        self.context = context
+        self.history = history
+        self.running = False
+        self.rid = None
+
+    def start(self):
+        self.running = True
+        self.rid = BackendClient.instance().call("generate", self._on_event, prompt=self.prompt, model=self.model,
+                                                 context=self.context, history=self.history)
+
+    def cancel(self):
+        if self.running:
+            BackendClient.instance().cancel(self.rid)
+
+    def isRunning(self):
+        return self.running
+
+    def _on_event(self, event, data):
+        if event == "done":
+            self.running = False
+            self.finished.emit()
+        else:
+            getattr(self, event).emit(data)
+
+class RemoteProcessRunner(QObject):
+    output_received = pyqtSignal(str)
+    finished = pyqtSignal(int)
+
+    def __init__(self, path_to_script):
+        super().__init__()
+        self.path_to_script = path_to_script
+        self.exit_code = -1
+
+    def run(self):
+        BackendClient.instance().call("run", self._on_event, path=self.path_to_script)
+
+    def _on_event(self, event, data):
+        if event == "output":
+            self.output_received.emit(data)
+        elif event == "error":
+            self.output_received.emit(f"[Ошибка]: {data}")
+        elif event == "finished":
+            self.exit_code = data
+        elif event == "done":
+            self.finished.emit(self.exit_code)
+
+def make_ollama_worker(prompt, model, context=None, history=None):
+    if BackendClient.instance().is_ready():
+        return RemoteOllamaWorker(prompt, model, context, history)
+    return OllamaWorker(prompt, model, context, history)
+
+# --- Запуск тестов ---
+TEST_FILE_PATTERNS = ["test_*.py", "*_test.py"]
+TEST_EVENT_MARK = "@@MINICRUSOR-TEST@@ "
+
+# Плагин pytest и раннер unittest пишут по строке JSON на каждый тест. Вывод идёт в копию
+# исходного stdout, сделанную до того, как pytest перехватит дескриптор 1.
+PYTEST_PLUGIN = '''
+import json, os
+_fd = os.dup(1)
+
+def pytest_runtest_logreport(report):
+    if report.when != "call" and report.passed:
+        return
+    crash = getattr(report.longrepr, "reprcrash", None)
+    message = ""
+    if report.skipped and isinstance(report.longrepr, tuple):
+        message = report.longrepr[2]
+    elif not report.passed:
+        message = str(report.longrepr)
+    event = {"nodeid": report.nodeid, "outcome": report.outcome, "when": report.when,
+             "duration": report.duration, "message": message,
+             "path": str(crash.path) if crash else None, "line": crash.lineno if crash else None}
+    os.write(_fd, (%r + json.dumps(event) + "\\n").encode("utf-8"))
+''' % TEST_EVENT_MARK
+
+UNITTEST_RUNNER = '''
+import json, os, sys, time, traceback, unittest, importlib.util
+_fd = os.dup(1)
+path, rel = sys.argv[1], sys.argv[2]
+sys.path.insert(0, os.path.dirname(path))
+name = os.path.splitext(os.path.basename(path))[0]
+spec = importlib.util.spec_from_file_location(name, path)
+module = importlib.util.module_from_spec(spec)
+sys.modules[name] = module
+spec.loader.exec_module(module)
+
+def emit(test, outcome, err=None):
+    parts = test.id().split(".")
+    event = {"nodeid": "::".join([rel] + parts[-2:]), "outcome": outcome, "when": "call",
+             "duration": time.perf_counter() - getattr(test, "_mc_start", time.perf_counter()),
+             "message": "", "path": None, "line": None}
+    if err is not None:
+        event["message"] = "".join(traceback.format_exception(*err))
+        frames = [f for f in traceback.extract_tb(err[2]) if os.path.abspath(f.filename) == os.path.abspath(path)]
+        if frames:
+            event["path"], event["line"] = frames[-1].filename, frames[-1].lineno
+    os.write(_fd, (%r + json.dumps(event) + "\\n").encode("utf-8"))
+
+class Result(unittest.TestResult):
+    def startTest(self, test):
+        test._mc_start = time.perf_counter()
+        super().startTest(test)
+    def addSuccess(self, test):
+        emit(test, "passed")
+    def addFailure(self, test, err):
+        super().addFailure(test, err)
+        emit(test, "failed", err)
+    def addError(self, test, err):
+        super().addError(test, err)
+        emit(test, "failed", err)
+    def addSkip(self, test, reason):
+        emit(test, "skipped")
+    def addExpectedFailure(self, test, err):
+        emit(test, "passed")
+    def addUnexpectedSuccess(self, test):
+        super().addUnexpectedSuccess(test)
+        emit(test, "failed")
+
+result = Result()
+unittest.TestLoader().loadTestsFromModule(module).run(result)
+sys.exit(0 if result.wasSuccessful() else 1)
+''' % TEST_EVENT_MARK
+
+def discover_tests(root):
+    # Тесты ищутся разбором ast, без импорта модулей: поиск не выполняет чужой код
+    modules = []
+    for path in iter_batch_files([root], TEST_FILE_PATTERNS):
+        rel = os.path.relpath(path, root).replace(os.sep, "/")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                tree = ast.parse(f.read(), path)
+        except (OSError, SyntaxError, UnicodeDecodeError, ValueError):
+            continue
+        tests = []
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name.startswith("test"):
+                tests.append((f"{rel}::{node.name}", node.name, node.lineno))
+            elif isinstance(node, ast.ClassDef):
+                bases = [ast.unparse(base) for base in node.bases]
+                if not (node.name.startswith("Test") or any(base.endswith("TestCase") for base in bases)):
+                    continue
+                for item in node.body:
+                    if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)) and item.name.startswith("test"):
+                        tests.append((f"{rel}::{node.name}::{item.name}", f"{node.name}.{item.name}", item.lineno))
+        if tests:
+            modules.append({"path": path, "rel": rel, "tests": tests})
+    return modules
+
+def _resolve_module(name, bases):
+    for base in bases:
+        candidate = os.path.join(base, *name.split("."))
+        if os.path.isfile(candidate + ".py"):
+            return candidate + ".py"
+        if os.path.isfile(os.path.join(candidate, "__init__.py")):
+            return os.path.join(candidate, "__init__.py")
+    return None
+
+def project_imports(path, root):
+    """Файлы проекта (внутри root), которые модуль импортирует напрямую."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            tree = ast.parse(f.read(), path)
+    except (OSError, SyntaxError, UnicodeDecodeError, ValueError):
+        return set()
+    bases = [os.path.dirname(path), root]
+    found = set()
+    for node in ast.walk(tree):
+        names = []
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                package = os.path.dirname(path)
+                for _ in range(node.level - 1):
+                    package = os.path.dirname(package)
+                prefix = node.module or ""
+                for alias in node.names:
+                    for name in filter(None, [prefix, f"{prefix}.{alias.name}".strip(".")]):
+                        resolved = _resolve_module(name, [package])
+                        if resolved:
+                            found.add(resolved)
+                continue
+            names = [node.module] + [f"{node.module}.{alias.name}" for alias in node.names]
+        for name in names:
+            resolved = _resolve_module(name, bases)
+            if resolved and os.path.abspath(resolved).startswith(os.path.abspath(root) + os.sep):
+                found.add(os.path.abspath(resolved))
+    return found
+
+class TestRunner(QObject):
+    discovered = pyqtSignal(list)
+    test_result = pyqtSignal(dict)
+    module_finished = pyqtSignal(str, int, bool)
+    all_finished = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=min(os.cpu_count() or 2, 8))
+        self.cache_path = os.path.join(APP_DATA_DIR, "test_cache.json")
+        self.cache = None
+        self.file_hashes = {}
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.stopped = False
+        self.support_dir = None
+
+    def discover(self, root):
+        future = self.executor.submit(discover_tests, root)
+        future.add_done_callback(lambda f: self.discovered.emit(f.result() if not f.exception() else []))
+
+    def _file_hash(self, path):
+        import hashlib
+        st = os.stat(path)
+        cached = self.file_hashes.get(path)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        self.file_hashes[path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def cache_key(self, path, root, runner):
+        import hashlib
+        # Модуль теста и всё, что он транзитивно импортирует из проекта
+        seen = {os.path.abspath(path)}
+        queue = [os.path.abspath(path)]
+        while queue:
+            for dep in project_imports(queue.pop(), root):
+                if dep not in seen:
+                    seen.add(dep)
+                    queue.append(dep)
+        h = hashlib.sha1(f"{runner}\0{sys.version}".encode("utf-8"))
+        for dep in sorted(seen):
+            h.update(f"\0{os.path.relpath(dep, root)}\0{self._file_hash(dep)}".encode("utf-8"))
+        return h.hexdigest()
+
+    def _load_cache(self):
+        if self.cache is None:
+            try:
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    self.cache = json.load(f)
+            except (OSError, ValueError):
+                self.cache = {}
+
+    def _save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        with open(self.cache_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.cache, f, ensure_ascii=False)
+        os.replace(self.cache_path + ".tmp", self.cache_path)
+
+    def _support_files(self):
+        if self.support_dir is None:
+            self.support_dir = tempfile.mkdtemp(prefix="minicrusor-tests-")
+            with open(os.path.join(self.support_dir, "minicrusor_pytest_plugin.py"), "w", encoding="utf-8") as f:
+                f.write(PYTEST_PLUGIN)
+            with open(os.path.join(self.support_dir, "minicrusor_unittest_runner.py"), "w", encoding="utf-8") as f:
+                f.write(UNITTEST_RUNNER)
+        return self.support_dir
+
+    def run(self, root, modules, use_cache=True):
+        import importlib.util
+        runner = "pytest" if importlib.util.find_spec("pytest") else "unittest"
+        self._load_cache()
+        self.stopped = False
+        self.pending = len(modules)
+        if not modules:
+            self.all_finished.emit()
+        for module in modules:
+            self.executor.submit(self._run_module, root, module, runner, use_cache)
+
+    def stop(self):
+        self.stopped = True
+        with self.lock:
+            for proc in list(self.processes):
+                proc.kill()
+
+    def shutdown(self):
+        import shutil
+        self.stop()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.support_dir:
+            shutil.rmtree(self.support_dir, ignore_errors=True)
+
+    def _run_module(self, root, module, runner, use_cache):
+        path = module["path"]
+        try:
+            key = self.cache_key(path, root, runner)
+            entry = self.cache.get(path)
+            if use_cache and entry and entry["key"] == key:
+                for event in entry["events"]:
+                    self.test_result.emit(dict(event, cached=True))
+                self.module_finished.emit(path, entry["returncode"], True)
+                return
+            events, returncode = self._execute(root, module, runner)
+            if not self.stopped:
+                with self.lock:
+                    self.cache[path] = {"key": key, "events": events, "returncode": returncode}
+                    self._save_cache()
+            self.module_finished.emit(path, returncode, False)
+        except Exception as e:
+            self.test_result.emit({"nodeid": module["rel"], "outcome": "failed", "when": "collect",
+                                   "message": f"Не удалось запустить: {e}", "path": path, "line": None})
+            self.module_finished.emit(path, -1, False)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                done = self.pending == 0
+            if done:
+                self.all_finished.emit()
+
+    def _execute(self, root, module, runner):
+        if self.stopped:
+            return [], -1
+        support = self._support_files()
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [support, root, env.get("PYTHONPATH")]))
+        env["PYTHONDONTWRITEBYTECODE"] = "1"
+        if runner == "pytest":
+            cmd = [sys.executable, "-m", "pytest", "-q", "-p", "minicrusor_pytest_plugin", "-p", "no:cacheprovider",
+                   "--rootdir", root, module["path"]]
+        else:
+            cmd = [sys.executable, os.path.join(support, "minicrusor_unittest_runner.py"), module["path"], module["rel"]]
+        proc = subprocess.Popen(cmd, cwd=root, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, encoding="utf-8", errors="replace")
+        with self.lock:
+            self.processes.add(proc)
+        events = []
+        output = []
+        for line in iter(proc.stdout.readline, ""):
+            # pytest печатает точки прогресса без перевода строки, маркер может быть не в начале
+            mark = line.find(TEST_EVENT_MARK)
+            if mark != -1:
+                output.append(line[:mark])
+                event = json.loads(line[mark + len(TEST_EVENT_MARK):])
+                if event["path"] and not os.path.isabs(event["path"]):
+                    event["path"] = os.path.join(root, event["path"])
+                events.append(event)
+                self.test_result.emit(event)
+            else:
+                output.append(line)
+        proc.stdout.close()
+        returncode = proc.wait()
+        with self.lock:
+            self.processes.discard(proc)
+        if not events and returncode not in (0, 5):
+            # Модуль не собрался (ошибка импорта и т.п.) — показываем вывод как ошибку модуля
+            event = {"nodeid": module["rel"], "outcome": "failed", "when": "collect",
+                     "message": "".join(output[-200:]), "path": module["path"], "line": None}
+            events.append(event)
+            self.test_result.emit(event)
+        return events, returncode
+
+class TestPanel(QDialog):
+    OUTCOME_MARKS = {"passed": ("✓", "#98c379"), "failed": ("✗", "#e06c75"), "skipped": ("↷", "#d19a66"),
+                     "running": ("…", "#61afef"), "pending": ("·", "#6b717d")}
+
+    def __init__(self, main_window, root):
+        super().__init__(main_window)
+        from PyQt5.QtWidgets import QTreeWidget
+        self.setWindowTitle("Тесты")
+        self.resize(700, 600)
+        self.main_window = main_window
+        self.root = root
+        self.modules = []
+        self.items = {}
+        self.module_items = {}
+        self.counts = {}
+        self.started = 0.0
+        self.runner = TestRunner(self)
+        self.runner.discovered.connect(self._on_discovered)
+        self.runner.test_result.connect(self._on_result)
+        self.runner.module_finished.connect(self._on_module_finished)
+        self.runner.all_finished.connect(self._on_all_finished)
+        QApplication.instance().aboutToQuit.connect(self.runner.shutdown)
+
+        self.root_label = QLabel()
+        choose_btn = QPushButton("Папка...")
+        choose_btn.clicked.connect(self.choose_root)
+        discover_btn = QPushButton("Найти тесты")
+        discover_btn.clicked.connect(self.discover)
+        self.run_btn = QPushButton("Запустить")
+        self.run_btn.setToolTip("Неизменившиеся модули берутся из кэша")
+        self.run_btn.clicked.connect(lambda: self.run_tests(True))
+        self.run_all_btn = QPushButton("Запустить всё заново")
+        self.run_all_btn.clicked.connect(lambda: self.run_tests(False))
+        self.stop_btn = QPushButton("Остановить")
+        self.stop_btn.clicked.connect(self.runner.stop)
+        self.stop_btn.setEnabled(False)
+        top = QHBoxLayout()
+        top.addWidget(self.root_label, 1)
+        top.addWidget(choose_btn)
+        top.addWidget(discover_btn)
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.run_btn)
+        buttons.addWidget(self.run_all_btn)
+        buttons.addWidget(self.stop_btn)
+        buttons.addStretch()
+
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["Тест", "Время"])
+        self.tree.header().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.tree.header().setSectionResizeMode(1, QHeaderView.ResizeToContents)
+        self.tree.currentItemChanged.connect(self._on_current)
+        self.tree.itemDoubleClicked.connect(self._on_double_click)
+        self.details = QPlainTextEdit()
+        self.details.setReadOnly(True)
+        self.details.setFont(QFont("Consolas", 9))
+        self.details.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.status = QLabel()
+        splitter = QSplitter(Qt.Vertical)
+        splitter.addWidget(self.tree)
+        splitter.addWidget(self.details)
+        splitter.setSizes([400, 200])
+
+        layout = QVBoxLayout(self)
+        layout.addLayout(top)
+        layout.addLayout(buttons)
+        layout.addWidget(splitter)
+        layout.addWidget(self.status)
+        self.set_root(root)
+
+    def set_root(self, root):
+        self.root = os.path.abspath(root)
+        self.root_label.setText(self.root)
+        self.discover()
+
+    def choose_root(self):
+        root = QFileDialog.getExistingDirectory(self, "Папка с тестами", self.root)
+        if root:
+            self.set_root(root)
+
+    def discover(self):
+        self.status.setText("Поиск тестов...")
+        self.runner.discover(self.root)
+
+    def _mark(self, item, outcome, cached=False):
+        mark, color = self.OUTCOME_MARKS[outcome]
+        item.setData(0, Qt.UserRole + 1, outcome)
+        item.setText(0, f"{mark} {item.data(0, Qt.UserRole + 2)}" + (" (кэш)" if cached else ""))
+        item.setForeground(0, QColor(color))
+
+    def _on_discovered(self, modules):
+        from PyQt5.QtWidgets import QTreeWidgetItem
+        self.modules = modules
+        self.tree.clear()
+        self.items = {}
+        self.module_items = {}
+        for module in modules:
+            module_item = QTreeWidgetItem([module["rel"]])
+            module_item.setData(0, Qt.UserRole, {"path": module["path"], "line": 1})
+            module_item.setData(0, Qt.UserRole + 2, module["rel"])
+            self.tree.addTopLevelItem(module_item)
+            self.module_items[module["path"]] = module_item
+            for nodeid, name, line in module["tests"]:
+                item = QTreeWidgetItem([name])
+                item.setData(0, Qt.UserRole, {"path": module["path"], "line": line})
+                item.setData(0, Qt.UserRole + 2, name)
+                self._mark(item, "pending")
+                module_item.addChild(item)
+                self.items[nodeid] = item
+        total = sum(len(m["tests"]) for m in modules)
+        self.status.setText(f"Найдено тестов: {total} в {len(modules)} модулях")
+
+    def run_tests(self, use_cache):
+        if not self.modules:
+            return
+        self.counts = {"passed": 0, "failed": 0, "skipped": 0, "cached": 0}
+        for item in self.items.values():
+            self._mark(item, "running")
+        self.run_btn.setEnabled(False)
+        self.run_all_btn.setEnabled(False)
+        self.stop_btn.setEnabled(True)
+        self.started = time.perf_counter()
+        self.runner.run(self.root, self.modules, use_cache)
+
+    def _item_for(self, event):
+        from PyQt5.QtWidgets import QTreeWidgetItem
+        nodeid = event["nodeid"]
+        item = self.items.get(nodeid) or self.items.get(nodeid.split("[")[0] if "[" in nodeid else None)
+        if item is not None and "[" in nodeid and nodeid not in self.items:
+            # Параметризованный тест — отдельный дочерний элемент для каждого набора параметров
+            parent = item
+            item = QTreeWidgetItem([nodeid.split("::")[-1]])
+            item.setData(0, Qt.UserRole, parent.data(0, Qt.UserRole))
+            item.setData(0, Qt.UserRole + 2, nodeid.split("::")[-1])
+            parent.addChild(item)
+            self.items[nodeid] = item
+        if item is None:
+            module_item = self.module_items.get(os.path.join(self.root, nodeid.split("::")[0].replace("/", os.sep)))
+            if module_item is None:
+                return None
+            if "::" not in nodeid:
+                return module_item
+            item = QTreeWidgetItem([nodeid.split("::", 1)[1]])
+            item.setData(0, Qt.UserRole, module_item.data(0, Qt.UserRole))
+            item.setData(0, Qt.UserRole + 2, nodeid.split("::", 1)[1].replace("::", "."))
+            module_item.addChild(item)
+            self.items[nodeid] = item
+        return item
+
+    def _on_result(self, event):
+        item = self._item_for(event)
+        if item is None:
+            return
+        # Ошибка в teardown после успешного call всё равно делает тест упавшим
+        if item.data(0, Qt.UserRole + 1) == "failed" and event["outcome"] != "failed":
+            return
+        location = dict(item.data(0, Qt.UserRole))
+        if event.get("path") and event.get("line"):
+            location = {"path": event["path"], "line": event["line"]}
+        location["message"] = event.get("message", "")
+        item.setData(0, Qt.UserRole, location)
+        self._mark(item, event["outcome"], event.get("cached", False))
+        if event.get("duration") is not None:
+            item.setText(1, f"{event['duration'] * 1000:.0f} мс")
+        if event["outcome"] in self.counts:
+            self.counts[event["outcome"]] += 1
+        if event.get("cached"):
+            self.counts["cached"] += 1
+        parent = item.parent()
+        if "[" in event["nodeid"] and parent is not None:
+            # Итог параметризованного теста: упавший набор важнее пройденного, пройденный — пропущенного
+            rank = {"failed": 3, "passed": 2, "skipped": 1}
+            current = parent.data(0, Qt.UserRole + 1)
+            if rank.get(event["outcome"], 0) > rank.get(current, 0):
+                self._mark(parent, event["outcome"], event.get("cached", False))
+        if event["outcome"] == "failed" and parent is not None:
+            parent.setExpanded(True)
+
+    def _on_module_finished(self, path, returncode, cached):
+        module_item = self.module_items.get(path)
+        if module_item is None:
+            return
+        failed = any(module_item.child(i).data(0, Qt.UserRole + 1) == "failed" for i in range(module_item.childCount()))
+        for i in range(module_item.childCount()):
+            child = module_item.child(i)
+            if child.data(0, Qt.UserRole + 1) == "running":
+                self._mark(child, "pending")
+        if module_item.data(0, Qt.UserRole + 1) != "failed":
+            self._mark(module_item, "failed" if failed or returncode not in (0, 5) else "passed", cached)
+
+    def _on_all_finished(self):
+        self.run_btn.setEnabled(True)
+        self.run_all_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
+        c = self.counts
+        self.status.setText(f"Пройдено: {c.get('passed', 0)}, упало: {c.get('failed', 0)}, "
+                            f"пропущено: {c.get('skipped', 0)}, из кэша: {c.get('cached', 0)} · "
+                            f"{time.perf_counter() - self.started:.1f} с")
+
+    def _on_current(self, item, _previous):
+        if item is not None:
+            location = item.data(0, Qt.UserRole) or {}
+            self.details.setPlainText(location.get("message", ""))
+
+    def _on_double_click(self, item, _column):
+        location = item.data(0, Qt.UserRole)
+        if location and location.get("path"):
+            self.main_window.open_location(location["path"], location.get("line") or 1)
+
+# --- Отображение ответов нейросети ---
+CODE_LANGUAGE_ALIASES = {
+    "py": "python", "python3": "python", "js": "javascript", "ts": "javascript", "typescript": "javascript",
+    "jsx": "javascript", "c": "cpp", "c++": "cpp", "h": "cpp", "sh": "bash", "shell": "bash",
+    "zsh": "bash", "yml": "yaml", "md": "markdown", "htm": "html",
+}
+LINE_COMMENTS = {"python": "#", "bash": "#", "yaml": "#", "javascript": "//", "cpp": "//", "sql": "--"}
+CODE_TOKEN_RE = re.compile(r"""(?P<string>"(?:\\.|[^"\\])*"?|'(?:\\.|[^'\\])*'?|`[^`]*`?)"""
+                           r"|(?P<number>\b(?:0[xX][0-9a-fA-F]+|\d[\d_]*\.?\d*(?:[eE][-+]?\d+)?)\b)"
+                           r"|(?P<word>[A-Za-z_$][\w$]*)")
+
+def code_language(tag):
+    tag = (tag or "").lower()
+    tag = CODE_LANGUAGE_ALIASES.get(tag, tag)
+    return tag if tag in LANGUAGES else None
+
+def highlight_line(line, language):
+    # Подсветка одной строки без состояния между строками: для фрагментов в чате этого хватает,
+    # а каждую строку ответа можно раскрасить сразу, как только она пришла
+    comment = LINE_COMMENTS.get(language)
+    words = set(keyword.kwlist) if language == "python" else set(LANGUAGES.get(language, {}).get("words", ()))
+    spans = []
+    pos = 0
+    while pos < len(line):
+        if comment and line.startswith(comment, pos):
+            spans.append((line[pos:], "comment"))
+            break
+        m = CODE_TOKEN_RE.search(line, pos)
+        if not m:
+            spans.append((line[pos:], "default"))
+            break
+        if comment:
+            cut = line.find(comment, pos, m.start())
+            if cut >= 0:
+                spans.append((line[pos:cut], "default"))
+                pos = cut
+                continue
+        if m.start() > pos:
+            spans.append((line[pos:m.start()], "default"))
+        role = m.lastgroup
+        text = m.group()
+        if role == "word":
+            if text in words:
+                role = "keyword"
+            elif line[m.end():].lstrip().startswith("("):
+                role = "function"
+            elif text[:1].isupper():
+                role = "class"
+            else:
+                role = "default"
+        spans.append((text, role))
+        pos = m.end()
+    return spans
+
+def markdown_inline(text):
+    from html import escape
+    parts = re.split(r"(`[^`]+`)", text)
+    out = []
+    for part in parts:
+        if len(part) > 1 and part.startswith("`") and part.endswith("`"):
+            out.append(f'<span style="background:#2c313a;color:{ONE_DARK["class"]};font-family:Consolas">'
+                       f'{escape(part[1:-1])}</span>')
+            continue
+        part = escape(part)
+        part = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", part)
+        part = re.sub(r"(?<![\w*])\*(?!\s)(.+?)(?<!\s)\*(?![\w*])", r"<i>\1</i>", part)
+        out.append(part)
+    return "".join(out)
+
+class MarkdownStream:
+    # Инкрементальный рендер Markdown в QTextEdit: каждая полная строка разбирается и
+    # подсвечивается ровно один раз, заново выводится только незаконченная последняя строка
+    FENCE_RE = re.compile(r"^\s*(```|~~~)\s*([\w+#.-]*)\s*$")
+    HEADING_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+    LIST_RE = re.compile(r"^(\s*)(?:[-*+]|(\d+)[.)])\s+(.*)$")
+
+    def __init__(self, view, code_blocks):
+        self.view = view
+        self.code_blocks = code_blocks
+        self.cursor = QTextCursor(view.document())
+        self.cursor.movePosition(QTextCursor.End)
+        self.pending = ""
+        self.tail = None
+        self.fence = None
+        self.code_language = None
+        self.code_lines = []
+        self.blank = False
+        self.text_format = QTextCharFormat()
+        self.code_block_format = QTextBlockFormat()
+        self.code_block_format.setBackground(QColor("#21252b"))
+        self.code_block_format.setLeftMargin(8)
+        self.code_formats = {}
+        for role in ("default", "comment", "string", "number", "keyword", "function", "class"):
+            fmt = QTextCharFormat()
+            fmt.setForeground(QColor(ONE_DARK[role]))
+            fmt.setFontFamily("Consolas")
+            self.code_formats[role] = fmt
+
+    def feed(self, text):
+        self._drop_tail()
+        lines = (self.pending + text).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self._line(line)
+        if self.pending:
+            self.tail = self.cursor.position()
+            if self.fence:
+                self._code_line(self.pending)
+            else:
+                self.cursor.insertBlock(QTextBlockFormat(), self.text_format)
+                self.cursor.insertText(self.pending, self.text_format)
+
+    def finish(self):
+        self._drop_tail()
+        if self.pending:
+            self._line(self.pending)
+            self.pending = ""
+        if self.fence:
+            self._close_code()
+
+    def _drop_tail(self):
+        if self.tail is None:
+            return
+        self.cursor.setPosition(self.tail)
+        self.cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        self.cursor.removeSelectedText()
+        self.tail = None
+
+    def _line(self, line):
+        fence = self.FENCE_RE.match(line)
+        if self.fence:
+            if fence and fence.group(1) == self.fence and not fence.group(2):
+                self._close_code()
+            else:
+                self.code_lines.append(line)
+                self._code_line(line)
+            return
+        if fence:
+            self.fence = fence.group(1)
+            self.code_language = code_language(fence.group(2))
+            self.code_lines = []
+            return
+        if not line.strip():
+            # Пустые строки схлопываются в один отступ между абзацами
+            if not self.blank:
+                self.cursor.insertBlock(QTextBlockFormat(), self.text_format)
+            self.blank = True
+            return
+        self.blank = False
+        heading = self.HEADING_RE.match(line)
+        item = self.LIST_RE.match(line)
+        if heading:
+            html = f"<b>{markdown_inline(heading.group(2))}</b>"
+        elif item:
+            indent = "&nbsp;" * (len(item.group(1).expandtabs(4)) + 2)
+            bullet = f"{item.group(2)}." if item.group(2) else "•"
+            html = f"{indent}{bullet} {markdown_inline(item.group(3))}"
+        else:
+            html = markdown_inline(line)
+        self.cursor.insertBlock(QTextBlockFormat(), self.text_format)
+        self.cursor.insertHtml(html)
+
+    def _code_line(self, line):
+        self.cursor.insertBlock(self.code_block_format, self.code_formats["default"])
+        for text, role in highlight_line(line, self.code_language):
+            self.cursor.insertText(text, self.code_formats[role])
+
+    def _close_code(self):
+        index = len(self.code_blocks)
+        self.code_blocks.append({"code": "\n".join(self.code_lines), "language": self.code_language})
+        self.fence = None
+        self.code_lines = []
+        self.cursor.insertBlock(QTextBlockFormat(), self.text_format)
+        self.cursor.insertHtml(f'<span style="font-size:9pt"><a href="code:apply:{index}">Применить</a> · '
+                               f'<a href="code:copy:{index}">Копировать</a> · '
+                               f'<a href="code:tab:{index}">Открыть во вкладке</a></span>')
+        self.blank = False
+
 class ChatWidget(QWidget):
     def __init__(self, console=None, parent_window=None, parent=None):
         super().__init__(parent)
         self.console = console
         self.parent_window = parent_window
-        self.downloader = None
+        self.pull_manager = PullManager(self)
+        self.pull_manager.status.connect(self._on_download_status)
+        self.pull_manager.finished.connect(self._on_download_finished)
+        self.model_lister = None
         self.ollama_worker = None
-        self.suggested_code = ""
+        self.last_metrics = None
+        self.last_context_info = None
+        self.llm_stats = LlmStats(self)
+        self.code_blocks = []
+        self.stream = None
+        self.placeholder = None
+        self.routing = load_routing()
+        self.last_request = None
+        self.last_route = None
+        self.chat_threads = ChatThreads.instance()
+        self.thread = None
+        self.request_thread = None
+        self.last_history_info = None
+        self.summary_worker = None
         layout = QVBoxLayout()
         layout.setContentsMargins(12, 0, 12, 0)
 
@@ -423,15 +5111,30 @@ class ChatWidget(QWidget):
         top_layout.addWidget(self.download_btn)
         top_layout.addWidget(self.update_btn)
         top_layout.addStretch()
+        self.thread_box = QComboBox()
+        self.thread_box.setMinimumContentsLength(16)
+        self.thread_box.setSizeAdjustPolicy(QComboBox.AdjustToMinimumContentsLength)
+        self.thread_box.activated.connect(self._on_thread_selected)
+        self.new_thread_btn = QPushButton("➕")
+        self.new_thread_btn.setToolTip("Новый диалог")
+        self.new_thread_btn.clicked.connect(self.new_thread)
+        top_layout.addWidget(QLabel("Диалог:"))
+        top_layout.addWidget(self.thread_box)
+        top_layout.addWidget(self.new_thread_btn)
 
         chat_options_layout = QHBoxLayout()
         self.include_code_checkbox = QCheckBox("Включить код из активной вкладки")
         self.include_code_checkbox.setChecked(True)
+        self.auto_route_checkbox = QCheckBox(f"Простые запросы — быстрой модели ({self.routing['fast_model']})")
+        self.auto_route_checkbox.setChecked(True)
         chat_options_layout.addWidget(self.include_code_checkbox)
+        chat_options_layout.addWidget(self.auto_route_checkbox)
         chat_options_layout.addStretch()
 
-        self.history = QTextEdit()
+        self.history = QTextBrowser()
         self.history.setReadOnly(True)
+        self.history.setOpenLinks(False)
+        self.history.anchorClicked.connect(self._on_history_link)
         self.history.setFont(QFont("Consolas", 10))
         self.history.setAcceptDrops(True)
         self.history.viewport().setAcceptDrops(True)
@@ -452,15 +5155,22 @@ class ChatWidget(QWidget):
         # Соединяем сигнал кнопки из нашего нового виджета
         self.input.send_btn.clicked.connect(self.send_message)
         
-        self.apply_code_btn = QPushButton("Применить предложенный код")
-        self.apply_code_btn.clicked.connect(self.apply_suggested_code)
-        self.apply_code_btn.hide()
+        self.escalate_btn = QPushButton("Переспросить у большой модели")
+        self.escalate_btn.clicked.connect(self.escalate)
+        self.escalate_btn.hide()
+        self.stop_btn = QPushButton("Остановить ответ")
+        self.stop_btn.clicked.connect(self.stop_answer)
+        self.stop_btn.hide()
+
+        self.pull_panel = PullPanel(self.pull_manager)
 
         layout.addLayout(top_layout)
+        layout.addWidget(self.pull_panel)
         layout.addWidget(self.history)
         layout.addLayout(chat_options_layout)
         layout.addWidget(self.input) # Добавляем только поле ввода
-        layout.addWidget(self.apply_code_btn)
+        layout.addWidget(self.escalate_btn)
+        layout.addWidget(self.stop_btn)
         self.setLayout(layout)
 
         self.current_model = ""
@@ -470,6 +5180,51 @@ class ChatWidget(QWidget):
         self.refresh_models()
         self.on_model_changed()
 
+        recent = self.chat_threads.recent()
+        self.thread = recent[0] if recent else self.chat_threads.create()
+        self._fill_threads()
+        self._show_thread()
+
+    def _fill_threads(self):
+        self.thread_box.clear()
+        for thread in self.chat_threads.recent():
+            if thread["messages"] or thread is self.thread:
+                self.thread_box.addItem(thread["title"] or "Новый диалог", thread["id"])
+        self.thread_box.setCurrentIndex(self.thread_box.findData(self.thread["id"]))
+
+    def new_thread(self):
+        # Пустой текущий диалог переиспользуется, чтобы не плодить пустые
+        if self.thread["messages"]:
+            self.thread = self.chat_threads.create()
+        self._fill_threads()
+        self._show_thread()
+        self.input.setFocus()
+
+    def _on_thread_selected(self, index):
+        thread = self.chat_threads.get(self.thread_box.itemData(index))
+        if thread is None or thread is self.thread:
+            return
+        self.thread = thread
+        self._fill_threads()
+        self._show_thread()
+
+    def _show_thread(self):
+        self.history.clear()
+        self.code_blocks.clear()
+        self.escalate_btn.hide()
+        self.last_request = None
+        if self.thread["summary"]:
+            self.append_note("🗂 Начало диалога передаётся модели в пересказе")
+        for message in self.thread["messages"]:
+            if message["role"] == "user":
+                self.append_message("Вы", message["content"])
+            else:
+                self.append_message("Ollama", "")
+                stream = MarkdownStream(self.history, self.code_blocks)
+                stream.feed(message["content"])
+                stream.finish()
+        self._scroll_to_end()
+
     def eventFilter(self, obj, event):
         if obj == self.input and event.type() == event.KeyPress:
             if event.key() == Qt.Key_Return or event.key() == Qt.Key_Enter:
@@ -510,9 +5265,13 @@ class ChatWidget(QWidget):
 
     def append_image(self, pixmap, path=None):
         from base64 import b64encode
+        from PyQt5.QtCore import QBuffer
         buffer = QImage(pixmap.toImage())
         ba = QByteArray()
-        buffer.save(ba, 'PNG')
+        device = QBuffer(ba)
+        device.open(QBuffer.WriteOnly)
+        buffer.save(device, 'PNG')
+        device.close()
         b64 = b64encode(ba.data()).decode('utf-8')
         html = f'<img src="data:image/png;base64,{b64}" width="120"/>'
         if path:
@@ -532,28 +5291,20 @@ class ChatWidget(QWidget):
         self.history.setMinimumHeight(final_height)
 
     def refresh_models(self):
-        import re
+        # Список моделей получаем в фоне, чтобы не блокировать интерфейс
+        if self.model_lister and self.model_lister.isRunning():
+            return
+        self.model_lister = ModelListWorker()
+        self.model_lister.result.connect(self._on_models_listed)
+        self.model_lister.start()
+
+    def _on_models_listed(self, models):
         available = ["llama2", "codellama", "phi3", "mistral", "gemma"]
-        try:
-            result = subprocess.run(["cmd", "/c", "ollama list"], capture_output=True, text=True, timeout=5)
-            lines = result.stdout.splitlines()
-            downloaded = []
-            self.model_info = {}
-            for line in lines[1:]:
-                if not line.strip():
-                    continue
-                parts = line.split()
-                name = parts[0]
-                version = None
-                if ":" in name:
-                    model_name, version = name.split(":", 1)
-                else:
-                    model_name = name
-                downloaded.append(model_name)
-                self.model_info[model_name] = (True, version or "latest")
-        except Exception:
-            downloaded = []
-            self.model_info = {}
+        downloaded = []
+        self.model_info = {}
+        for model_name, version in models:
+            downloaded.append(model_name)
+            self.model_info[model_name] = (True, version or "latest")
         self.model_box.clear()
         for model in sorted(set(downloaded)):
             is_downloaded, version = self.model_info.get(model, (False, None))
@@ -567,6 +5318,7 @@ class ChatWidget(QWidget):
         if self.model_box.count() > 0:
             self.model_box.setCurrentIndex(0)
         self.on_model_changed()
+        StartupProfile.instance().done("список моделей")
 
     def on_model_changed(self):
         text = self.model_box.currentText()
@@ -599,101 +5351,223 @@ class ChatWidget(QWidget):
         if not user_text:
             return
 
-        self.apply_code_btn.hide()
-        self.suggested_code = ""
-        
         self.append_message("Вы", user_text)
         self.input.clear()
         
-        prompt = user_text
+        context = None
         if self.include_code_checkbox.isChecked() and self.parent_window:
-            current_code = self.parent_window.get_current_editor_text()
-            if current_code:
-                prompt = (f"Пожалуйста, ответь на мой вопрос, учитывая следующий код из моего редактора:\n\n"
-                          f"```python\n{current_code}\n```\n\n"
-                          f"Мой вопрос: {user_text}")
+            context = self.parent_window.get_current_editor_context()
+
+        if self.auto_route_checkbox.isChecked():
+            available = {name for name, (downloaded, _) in self.model_info.items() if downloaded}
+            route = route_request(self.routing, user_text, context, self.current_model, available)
+        else:
+            route = {"route": "manual", "model": self.current_model, "rule": None,
+                     "kind": classify_request(user_text, bool(context and context.get("selection"))),
+                     "tokens": estimate_tokens(user_text)}
+        self.start_request(user_text, context, route)
 
-        self.append_message("Ollama", "...ожидание ответа...")
+    def escalate(self):
+        if not self.last_request:
+            return
+        user_text, context, history = self.last_request
+        route = dict(self.last_route, route="escalated", model=self.current_model, rule=None)
+        self.append_note(f"⬆ Переспрашиваю у {self.current_model}")
+        self.start_request(user_text, context, route, history)
+
+    def start_request(self, user_text, context, route, history=None):
+        self.escalate_btn.hide()
+        # Переспрос идёт с той же историей, что и исходный вопрос
+        if history is None:
+            history = self.chat_threads.history(self.thread)
+        self.last_request = (user_text, context, history)
+        self.last_route = route
+        self.request_thread = self.thread
+        self.last_history_info = None
+        self.thread_box.setEnabled(False)
+        self.new_thread_btn.setEnabled(False)
+
+        self.append_message("Ollama", "")
+        cursor = QTextCursor(self.history.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertBlock(QTextBlockFormat(), QTextCharFormat())
+        cursor.insertHtml('<span style="color:#6b717d">...ожидание ответа...</span>')
+        self.placeholder = cursor.block().blockNumber()
+        self.stream = None
         self.input.send_btn.setEnabled(False)
         self.input.setEnabled(False)
-        self.ollama_worker = OllamaWorker(prompt, self.current_model)
+        self.stop_btn.setEnabled(True)
+        self.stop_btn.show()
+        self.last_context_info = None
+        self.ollama_worker = make_ollama_worker(user_text, route["model"], context, history)
+        self.ollama_worker.context_info.connect(self._on_context_info)
+        self.ollama_worker.history_info.connect(self._on_history_info)
+        self.ollama_worker.chunk.connect(self._on_ollama_chunk)
+        self.ollama_worker.metrics.connect(self._on_ollama_metrics)
         self.ollama_worker.result.connect(self._on_ollama_result)
         self.ollama_worker.error.connect(self._on_ollama_error)
         self.ollama_worker.finished.connect(self._on_ollama_finished)
         self.ollama_worker.start()
 
-    def _on_ollama_result(self, response):
-        import re
-        cursor = self.history.textCursor()
-        cursor.movePosition(cursor.End)
-        cursor.select(cursor.BlockUnderCursor)
+    def _remove_placeholder(self):
+        if self.placeholder is None:
+            return
+        # Удаляется ровно блок заглушки вместе с переводом строки перед ним
+        block = self.history.document().findBlockByNumber(self.placeholder)
+        cursor = QTextCursor(self.history.document())
+        cursor.setPosition(block.position() - 1)
+        cursor.setPosition(block.position() + block.length() - 1, QTextCursor.KeepAnchor)
         cursor.removeSelectedText()
-        cursor.deletePreviousChar()
-        self.append_message("Ollama", response)
+        self.placeholder = None
 
-        code_blocks = re.findall(r"```(?:python\n)?(.*?)```", response, re.DOTALL)
-        if code_blocks:
-            self.suggested_code = code_blocks[0].strip()
-            self.apply_code_btn.show()
-        else:
-            self.suggested_code = ""
-            self.apply_code_btn.hide()
+    def _answer_stream(self):
+        if self.stream is None:
+            self._remove_placeholder()
+            self.stream = MarkdownStream(self.history, self.code_blocks)
+        return self.stream
+
+    def _scroll_to_end(self):
+        self._adjust_history_height()
+        self.history.verticalScrollBar().setValue(self.history.verticalScrollBar().maximum())
+
+    def _on_ollama_chunk(self, text):
+        self._answer_stream().feed(text)
+        self._scroll_to_end()
+
+    def _on_ollama_result(self, response):
+        if self.stream is None:
+            # Ответ пришёл без потоковых кусков (например, пустой) — выводим его целиком
+            self._answer_stream().feed(response)
+        self.stream.finish()
+        self.stream = None
+        self.chat_threads.add_turn(self.request_thread, self.last_request[0], response,
+                                   replace_last=self.last_route["route"] == "escalated")
+        self._fill_threads()
+        self.append_note(f"🧭 {format_route(self.last_route)}")
+        if self.last_route["route"] == "fast" and self.current_model:
+            self.escalate_btn.setText(f"Переспросить у {self.current_model}")
+            self.escalate_btn.show()
+        if self.last_metrics:
+            self.append_note(f"⏱ {format_metrics(self.last_metrics)}")
+            self.last_metrics = None
+        if self.last_context_info and self.last_context_info["mode"] != "full":
+            self.append_note(f"📎 {format_context_info(self.last_context_info)}")
+        info = self.last_history_info
+        if info and (info["summary"] or info["dropped"]):
+            earlier = "пересказ начала и " if info["summary"] else ""
+            dropped = f"; ещё {info['dropped']} не вошли в бюджет" if info["dropped"] else ""
+            self.append_note(f"💬 История: {earlier}последние ходы дословно ({info['turns']}){dropped}, "
+                             f"~{info['tokens']} ток.")
+
+    def _on_ollama_metrics(self, metrics):
+        metrics["route"] = self.last_route["route"]
+        self.last_metrics = metrics
+        self.llm_stats.add(metrics)
+
+    def _on_context_info(self, info):
+        self.last_context_info = info
+
+    def _on_history_info(self, info):
+        self.last_history_info = info
+
+    def append_note(self, text):
+        html = f'<div style="margin:0 0 6px 0;color:#6b717d;font-size:9pt">{text}</div>'
+        self.history.append(html)
+        self._adjust_history_height()
+        self.history.verticalScrollBar().setValue(self.history.verticalScrollBar().maximum())
 
     def _on_ollama_error(self, error_text):
-        cursor = self.history.textCursor()
-        cursor.movePosition(cursor.End)
-        cursor.select(cursor.BlockUnderCursor)
-        cursor.removeSelectedText()
-        cursor.deletePreviousChar()
+        self._remove_placeholder()
+        if self.stream is not None:
+            self.stream.finish()
+            self.stream = None
         self.append_message("Ошибка", error_text)
 
+    def stop_answer(self):
+        # Ответ обрывается на следующем токене; уже показанная часть остаётся в чате
+        if self.ollama_worker is not None and self.ollama_worker.isRunning():
+            self.stop_btn.setEnabled(False)
+            self.ollama_worker.cancel()
+
     def _on_ollama_finished(self):
+        self.stop_btn.hide()
         self.input.send_btn.setEnabled(True)
         self.input.setEnabled(True)
+        self.thread_box.setEnabled(True)
+        self.new_thread_btn.setEnabled(True)
+        self._maybe_summarize()
+
+    def _maybe_summarize(self):
+        # Ранние ходы пересказываются заранее, между вопросами, чтобы к следующему запросу пересказ был готов
+        thread = self.request_thread
+        if thread is None or self.summary_worker is not None:
+            return
+        pending = thread["messages"][thread["summarized"]:]
+        # Бюджет истории — у модели, которая отвечала на вопрос, а не у выбранной в списке
+        answered_by = self.last_route["model"] if self.last_route else self.current_model
+        fold = fold_point(pending, history_budget(answered_by))
+        if not fold:
+            return
+        fast = self.routing["fast_model"]
+        model = fast if self.model_info.get(fast, (False, None))[0] else answered_by
+        self.summary_worker = SummaryWorker(thread["id"], thread["summary"], pending[:fold], thread["summarized"], model)
+        self.summary_worker.result.connect(self._on_summary)
+        self.summary_worker.finished.connect(self._on_summary_finished)
+        self.summary_worker.start(QThread.LowestPriority)
+
+    def _on_summary(self, thread_id, summary, base, summarized):
+        thread = self.chat_threads.get(thread_id)
+        # Пока считался пересказ, пересказанная часть могла измениться
+        if thread is None or thread["summarized"] != base or len(thread["messages"]) < summarized:
+            return
+        self.chat_threads.set_summary(thread, summary, summarized)
+
+    def _on_summary_finished(self):
+        self.summary_worker.deleteLater()
+        self.summary_worker = None
 
     def download_model(self):
         model = self.current_model
         if self.console:
-            self.console.append_text(f"[Ollama] Начинаю загрузку модели '{model}'...")
-        self.download_btn.setEnabled(False)
-        self.downloader = ModelDownloader(model)
-        self.downloader.progress.connect(self._on_download_progress)
-        self.downloader.finished.connect(self._on_download_finished)
-        self.downloader.start()
+            self.console.append_text(f"[Ollama] Модель '{model}' поставлена в очередь загрузки.")
+        self.pull_manager.enqueue(model)
 
     def update_model(self):
         model = self.current_model
         version = self.current_version or "latest"
         full_name = f"{model}:{version}"
         if self.console:
-            self.console.append_text(f"[Ollama] Обновление модели '{full_name}'...")
-        self.update_btn.setEnabled(False)
-        self.download_btn.setEnabled(False)
-        self.downloader = ModelDownloader(full_name)
-        self.downloader.progress.connect(self._on_download_progress)
-        self.downloader.finished.connect(self._on_download_finished)
-        self.downloader.start()
+            self.console.append_text(f"[Ollama] Обновление модели '{full_name}' поставлено в очередь.")
+        self.pull_manager.enqueue(full_name)
 
-    def _on_download_progress(self, msg):
+    def _on_download_status(self, model, msg):
         if self.console:
-            self.console.append_text(msg)
+            self.console.append_text(f"[Ollama] {model}: {msg}")
             
-    def _on_download_finished(self, msg):
+    def _on_download_finished(self, model, ok, msg):
         if self.console:
             self.console.append_text(msg)
-        self.download_btn.setEnabled(True)
-        self.update_btn.setEnabled(True)
-        self.refresh_models()
+        if ok:
+            self.refresh_models()
 
     def set_input_text_with_code(self, code):
         prompt = f"Проанализируй этот код:\n\n```python\n{code}\n```"
         self.input.setPlainText(prompt)
         self.input.setFocus()
 
-    def apply_suggested_code(self):
-        if self.suggested_code and self.parent_window:
-            self.parent_window.set_current_editor_text(self.suggested_code)
-            self.apply_code_btn.hide()
+    def _on_history_link(self, url):
+        scheme, _, rest = url.toString().partition(":")
+        action, _, index = rest.partition(":")
+        if scheme != "code" or not index.isdigit() or int(index) >= len(self.code_blocks):
+            return
+        block = self.code_blocks[int(index)]
+        if action == "copy":
+            QApplication.clipboard().setText(block["code"])
+        elif action == "apply" and self.parent_window:
+            self.parent_window.apply_ai_code(block["code"])
+        elif action == "tab" and self.parent_window:
+            self.parent_window.open_new_tab(language=block["language"])
+            self.parent_window.set_current_editor_text(block["code"])
 
     def close_current_tab(self):
         index = self.tabs.currentIndex()
@@ -752,6 +5626,245 @@ class ChatWidget(QWidget):
         if tab:
             tab.editor.setText(text)
 
+# --- Учёт памяти ---
+# Оценки, а не точные замеры: Qt и Scintilla не сообщают размер своих структур, поэтому
+# считаются байты текста, стилей и служебные данные на строку/блок.
+SCINTILLA_LINE_BYTES = 32
+TEXT_BLOCK_BYTES = 120
+API_WORD_BYTES = 64
+TAB_IDLE_UNLOAD_S = 300
+
+def process_rss():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def editor_memory(editor):
+    length = editor.length()
+    # Scintilla хранит байт текста и байт стиля на символ; история отмены не учитывается
+    return length * 2 + editor.lines() * SCINTILLA_LINE_BYTES
+
+def text_document_memory(doc):
+    """Оценка QTextDocument: текст в UTF-16, блоки и картинки (строка data:-URL и декодированное изображение)."""
+    from PyQt5.QtCore import QUrl
+    from PyQt5.QtGui import QTextDocument
+    info = {"text": doc.characterCount() * 2, "blocks": doc.blockCount() * TEXT_BLOCK_BYTES,
+            "images": 0, "image_payload": 0, "image_decoded": 0}
+    seen = set()
+    block = doc.begin()
+    while block.isValid():
+        it = block.begin()
+        while not it.atEnd():
+            fmt = it.fragment().charFormat()
+            if fmt.isImageFormat():
+                name = fmt.toImageFormat().name()
+                info["images"] += 1
+                info["image_payload"] += len(name) * 2
+                if name not in seen:
+                    seen.add(name)
+                    image = doc.resource(QTextDocument.ImageResource, QUrl(name))
+                    if isinstance(image, QImage):
+                        info["image_decoded"] += image.sizeInBytes()
+                    elif isinstance(image, QPixmap):
+                        info["image_decoded"] += image.width() * image.height() * image.depth() // 8
+            it += 1
+        block = block.next()
+    info["total"] = info["text"] + info["blocks"] + info["image_payload"] + info["image_decoded"]
+    return info
+
+def memory_report(window):
+    """Строки (подсистема, объект, байты или None, подробности) для панели памяти."""
+    rows = []
+    now = time.monotonic()
+    current = window.current_tab()
+    for i in range(window.tabs.count()):
+        tab = window.tabs.widget(i)
+        if tab.unloaded is not None:
+            rows.append(("Вкладки", tab.filename, len(tab.unloaded[0]), "выгружена, текст сжат"))
+            continue
+        idle = "активна" if tab is current else f"простаивает {int(now - tab.last_active) // 60} мин"
+        state = "изменена" if tab.editor.isModified() else "сохранена"
+        rows.append(("Вкладки", tab.filename, editor_memory(tab.editor),
+                     f"{tab.editor.lines()} строк, {state}, {idle}"))
+
+    if window.chat is not None:
+        chat = window.chat
+        doc = text_document_memory(chat.history.document())
+        rows.append(("Чат", "История", doc["total"],
+                     f"текст {format_bytes(doc['text'])}, картинок {doc['images']}: "
+                     f"base64 {format_bytes(doc['image_payload'])}, декодировано {format_bytes(doc['image_decoded'])}"))
+        code = sum(sys.getsizeof(block["code"]) for block in chat.code_blocks)
+        rows.append(("Чат", "Блоки кода", code, f"{len(chat.code_blocks)} шт."))
+
+    store = window.console.store
+    store_bytes = (sum(map(sys.getsizeof, store.lines)) + sys.getsizeof(store.lines) + sys.getsizeof(store.severity)
+                   + (sys.getsizeof(store.text) + sys.getsizeof(store.offsets) if store.text is not None else 0))
+    rows.append(("Консоль", "Хранилище вывода", store_bytes, f"{len(store.lines)} из {CONSOLE_MAX_LINES} строк"))
+    view = text_document_memory(window.console.document())
+    rows.append(("Консоль", "Отображение", view["total"], f"{window.console.blockCount()} строк на экране"))
+
+    registry = LanguageRegistry.instance()
+    for language, api in registry.apis.items():
+        words = LANGUAGES[language]["words"]
+        size = sum(len(word) * 2 + API_WORD_BYTES for word in words)
+        rows.append(("Автодополнение", f"QsciAPIs: {language}", size, f"{len(words)} слов"))
+
+    completions = [window.tabs.widget(i).editor.completer for i in range(window.tabs.count())]
+    cached = [entry for completer in completions for entry in completer.cache]
+    rows.append(("Кэши", "AI-дополнения", sum(sys.getsizeof(p) + sys.getsizeof(c) for p, c in cached),
+                 f"{len(cached)} записей"))
+    info = LocalHistory.instance().text.cache_info()
+    rows.append(("Кэши", "Версии локальной истории", None, f"{info.currsize} из {info.maxsize} записей"))
+    if window.test_panel is not None:
+        rows.append(("Кэши", "Хэши файлов тестов", None, f"{len(window.test_panel.runner.file_hashes)} файлов"))
+    return rows
+
+def trim_caches(window):
+    """Сбрасывает кэши, которые восстанавливаются сами. Возвращает описание сделанного."""
+    import gc
+    from PyQt5.QtGui import QPixmapCache
+    done = []
+    LocalHistory.instance().text.cache_clear()
+    entries = 0
+    for i in range(window.tabs.count()):
+        completer = window.tabs.widget(i).editor.completer
+        entries += len(completer.cache)
+        completer.cache.clear()
+    done.append(f"AI-дополнения: {entries} записей")
+    if window.test_panel is not None:
+        window.test_panel.runner.file_hashes.clear()
+    # Лексеры и QsciAPIs языков без открытых вкладок создаются заново при следующем открытии
+    registry = LanguageRegistry.instance()
+    used = {window.tabs.widget(i).editor.language for i in range(window.tabs.count())}
+    unused = [language for language in registry.lexers if language not in used]
+    for language in unused:
+        registry.lexers.pop(language, None)
+        registry.apis.pop(language, None)
+    if unused:
+        done.append("лексеры: " + ", ".join(unused))
+    QPixmapCache.clear()
+    done.append(f"сборщик мусора: {gc.collect()} объектов")
+    return done
+
+def unload_idle_tabs(window, idle_s=TAB_IDLE_UNLOAD_S):
+    current = window.current_tab()
+    now = time.monotonic()
+    count, freed = 0, 0
+    for i in range(window.tabs.count()):
+        tab = window.tabs.widget(i)
+        if tab is current or now - tab.last_active < idle_s:
+            continue
+        saved = tab.unload()
+        if saved:
+            count += 1
+            freed += saved
+    return count, freed
+
+class MemoryDialog(QDialog):
+    def __init__(self, window):
+        super().__init__(window)
+        self.setWindowTitle("Память")
+        self.resize(900, 600)
+        self.main_window = window
+        self.snapshot = None
+
+        self.table = QTableWidget(0, 4)
+        self.table.setHorizontalHeaderLabels(["Подсистема", "Объект", "Оценка", "Подробности"])
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.summary = QLabel()
+        self.output = QPlainTextEdit()
+        self.output.setReadOnly(True)
+        self.output.setFont(QFont("Consolas", 9))
+        self.output.setLineWrapMode(QPlainTextEdit.NoWrap)
+
+        refresh_btn = QPushButton("Обновить")
+        refresh_btn.clicked.connect(self.refresh)
+        trim_btn = QPushButton("Очистить кэши")
+        trim_btn.clicked.connect(self.trim)
+        unload_btn = QPushButton(f"Выгрузить вкладки без дела > {TAB_IDLE_UNLOAD_S // 60} мин")
+        unload_btn.clicked.connect(self.unload)
+        self.snapshot_btn = QPushButton("Снимок tracemalloc")
+        self.snapshot_btn.clicked.connect(self.take_snapshot)
+        buttons = QHBoxLayout()
+        for btn in (refresh_btn, trim_btn, unload_btn, self.snapshot_btn):
+            buttons.addWidget(btn)
+        buttons.addStretch()
+
+        splitter = QSplitter(Qt.Vertical)
+        splitter.addWidget(self.table)
+        splitter.addWidget(self.output)
+        splitter.setSizes([380, 220])
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.summary)
+        layout.addLayout(buttons)
+        layout.addWidget(splitter)
+        self.refresh()
+
+    def refresh(self):
+        import tracemalloc
+        rows = memory_report(self.main_window)
+        self.table.setRowCount(len(rows))
+        for row, (section, name, size, details) in enumerate(rows):
+            values = [section, name, format_bytes(size) if size is not None else "—", details]
+            for col, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if col == 2:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, col, item)
+        rss = process_rss()
+        parts = [f"Процесс: {format_bytes(rss) if rss is not None else 'нет данных'}",
+                 f"учтено: {format_bytes(sum(size or 0 for _, _, size, _ in rows))}"]
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            parts.append(f"Python (tracemalloc): {format_bytes(current)}, пик {format_bytes(peak)}")
+        self.summary.setText(" · ".join(parts))
+
+    def trim(self):
+        done = trim_caches(self.main_window)
+        self.output.setPlainText("Очищено: " + "; ".join(done))
+        self.refresh()
+
+    def unload(self):
+        count, freed = unload_idle_tabs(self.main_window)
+        self.output.setPlainText(f"Выгружено вкладок: {count}, освобождено около {format_bytes(freed)}. "
+                                 f"Текст вернётся в редактор при переходе на вкладку.")
+        self.refresh()
+
+    def take_snapshot(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            # Отслеживаются только выделения Python; память Qt и Scintilla сюда не попадает
+            tracemalloc.start(10)
+            self.snapshot = tracemalloc.take_snapshot()
+            self.output.setPlainText("tracemalloc включён. Следующий снимок покажет, где выросла память.")
+            self.snapshot_btn.setText("Снимок tracemalloc (сравнить)")
+            self.refresh()
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        lines = ["Рост с прошлого снимка:"]
+        for stat in snapshot.compare_to(self.snapshot, "lineno")[:15]:
+            lines.append(f"  {stat}")
+        lines.append("")
+        lines.append("Крупнейшие места выделения:")
+        for stat in snapshot.statistics("lineno")[:15]:
+            lines.append(f"  {stat}")
+        self.snapshot = snapshot
+        self.output.setPlainText("\n".join(lines))
+        self.refresh()
+
 class CustomTitleBar(QWidget):
     def __init__(self, parent):
         super().__init__(parent)
@@ -792,14 +5905,15 @@ class CustomTitleBar(QWidget):
     def create_btn(self, name):
         btn = QPushButton(self)
         btn.setFixedSize(35, 35)
-        
-        icon_widget = IconWidget(name, "#e0e0e0")
-        
-        icon = QIcon(icon_widget.render_to_pixmap())
-        btn.setIcon(icon)
+        btn.setProperty("icon_name", name)
         btn.setIconSize(QSize(12, 12))
         return btn
 
+    def load_icons(self):
+        # Иконки рисуются после первой отрисовки окна и кэшируются
+        for btn in (self.minimize_btn, self.maximize_btn, self.restore_btn, self.close_btn):
+            btn.setIcon(QIcon(IconWidget.pixmap(btn.property("icon_name"), "#e0e0e0")))
+
     def toggle_maximize_restore(self):
         if self.parent.isMaximized():
             self.parent.showNormal()
@@ -835,12 +5949,22 @@ class IconWidget(QWidget):
         "restore": "M0 3 H7 V10 H0 Z M3 0 H10 V7 H3 Z",
         "close": "M0 0 L10 10 M10 0 L0 10"
     }
+    _cache = {}
+
     def __init__(self, icon_name, color, parent=None):
         super().__init__(parent)
         self.path = self.SVG_PATHS.get(icon_name, "")
         self.color = color
 
+    @classmethod
+    def pixmap(cls, icon_name, color):
+        key = (icon_name, color)
+        if key not in cls._cache:
+            cls._cache[key] = cls(icon_name, color).render_to_pixmap()
+        return cls._cache[key]
+
     def render_to_pixmap(self):
+        from PyQt5.QtSvg import QSvgRenderer
         svg = f"""
         <svg width="12" height="12" viewBox="0 0 12 12" xmlns="http://www.w3.org/2000/svg">
           <path d="{self.path}" stroke="{self.color}" stroke-width="1.5" fill="none" />
@@ -862,6 +5986,7 @@ class MainWindow(QMainWindow):
         self.setAttribute(Qt.WA_TranslucentBackground)
         self.resize(1200, 800)
 
+        self.active_tab = None
         self.tabs = QTabWidget()
         self.tabs.setTabsClosable(True)
         self.tabs.tabCloseRequested.connect(self.close_tab)
@@ -876,8 +6001,10 @@ class MainWindow(QMainWindow):
 
         self.console = ConsoleWidget()
         self.console.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-        self.chat = ChatWidget(console=self.console, parent_window=self)
-        self.chat.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        # Панель чата создаётся после первой отрисовки редактора
+        self.chat = None
+        self.chat_placeholder = QWidget()
+        self.chat_placeholder.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
 
         editor_console_splitter = QSplitter(Qt.Vertical)
         editor_console_splitter.addWidget(self.tabs)
@@ -894,7 +6021,8 @@ class MainWindow(QMainWindow):
 
         main_splitter = QSplitter(Qt.Horizontal)
         main_splitter.addWidget(editor_console_splitter)
-        main_splitter.addWidget(self.chat)
+        main_splitter.addWidget(self.chat_placeholder)
+        self.main_splitter = main_splitter
         main_splitter.setHandleWidth(2)
         main_splitter.setStretchFactor(0, 3)
         main_splitter.setStretchFactor(1, 1)
@@ -921,12 +6049,78 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(main_frame)
 
         self.create_menu(self.title_bar.menu_bar)
-        self.open_new_tab()
+        # Первая вкладка открывается без лексера; подсветка включится после отрисовки
+        self.open_new_tab(language=None)
         
         self.process_runner = None
         self.process_thread = None
 
         self.windowTitleChanged.connect(self.title_bar.set_title)
+        StallWatchdog.instance().stall_detected.connect(self.on_stall)
+        FileWatcher.instance().changed.connect(self.on_external_change)
+        FileWatcher.instance().deleted.connect(self.on_external_delete)
+        self.conflicts = set()
+        self.test_panel = None
+
+        self.startup_finished = False
+        main_frame.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if not self.startup_finished and event.type() == QEvent.Paint:
+            self.startup_finished = True
+            QTimer.singleShot(0, self.finish_startup)
+        return super().eventFilter(obj, event)
+
+    def finish_startup(self):
+        profile = StartupProfile.instance()
+        profile.mark("первая отрисовка")
+        self.title_bar.load_icons()
+        profile.mark("иконки заголовка")
+        for i in range(self.tabs.count()):
+            tab = self.tabs.widget(i)
+            if tab.editor.language is None and not tab.filepath:
+                tab.editor.set_language("python")
+        profile.mark("лексер первой вкладки")
+        self.ensure_chat()
+        profile.mark("панель чата")
+        BackendClient.instance().start()
+        QTimer.singleShot(0, self.offer_recovery)
+
+    def offer_recovery(self):
+        journal = AutosaveJournal.instance()
+        for directory, entries in journal.recoverable():
+            if not entries:
+                journal.discard(directory)
+                continue
+            names = "\n".join(f"  {entry['path'] or entry['title']}" for entry in entries)
+            ret = QMessageBox.question(self, "Восстановление",
+                                       f"После прошлого запуска остались несохранённые изменения:\n{names}\n\n"
+                                       f"Восстановить их? «Нет» удалит копии, «Отмена» спросит при следующем запуске.",
+                                       QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+            if ret == QMessageBox.Cancel:
+                continue
+            if ret == QMessageBox.Yes:
+                for entry in entries:
+                    self.recover_tab(entry)
+            journal.discard(directory)
+
+    def recover_tab(self, entry):
+        path = entry["path"]
+        if path and os.path.exists(path):
+            tab = self.open_new_tab(path)
+        else:
+            tab = self.open_new_tab(language=entry["language"])
+        tab.editor.setText(entry["text"])
+        tab.editor.setModified(True)
+
+    def ensure_chat(self):
+        if self.chat is None:
+            self.chat = ChatWidget(console=self.console, parent_window=self)
+            self.chat.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+            self.main_splitter.replaceWidget(1, self.chat)
+            self.chat_placeholder.deleteLater()
+            self.chat_placeholder = None
+        return self.chat
 
     def changeEvent(self, event):
         if event.type() == QEvent.WindowStateChange:
@@ -945,8 +6139,37 @@ class MainWindow(QMainWindow):
             else:
                 self.title_bar.maximize_btn.show()
                 self.title_bar.restore_btn.hide()
+        if event.type() == QEvent.ActivationChange and self.isActiveWindow():
+            # Страховка на случай пропущенных уведомлений файловой системы
+            FileWatcher.instance().check_all()
         super().changeEvent(event)
 
+    def tabs_for_path(self, path):
+        tabs = [self.tabs.widget(i) for i in range(self.tabs.count())]
+        return [tab for tab in tabs if tab.filepath and os.path.abspath(tab.filepath) == path]
+
+    def on_external_change(self, path, text):
+        for tab in self.tabs_for_path(path):
+            if not tab.editor.isModified():
+                tab.apply_external_text(text)
+                self.console.append_text(f"[Файл] {path} изменён на диске, вкладка обновлена.")
+                continue
+            if path in self.conflicts:
+                continue
+            self.conflicts.add(path)
+            dialog = ExternalChangeDialog(path, tab.editor.text(), text, self)
+            dialog.exec_()
+            self.conflicts.discard(path)
+            if dialog.reload:
+                tab.apply_external_text(text)
+
+    def on_external_delete(self, path):
+        for tab in self.tabs_for_path(path):
+            # Вкладка помечается несохранённой, чтобы при закрытии было предложено сохранить текст
+            tab.is_saved = False
+            self.update_tab_title(tab)
+            self.console.append_text(f"[Файл] {path} удалён на диске.")
+
     def create_menu(self, menu):
         file_menu = menu.addMenu("Файл")
         open_action = QAction("Открыть...", self)
@@ -963,6 +6186,11 @@ class MainWindow(QMainWindow):
         save_as_action.triggered.connect(self.save_current_file_as)
         file_menu.addAction(save_as_action)
 
+        history_action = QAction("Локальная история...", self)
+        history_action.setShortcut("Ctrl+Shift+H")
+        history_action.triggered.connect(self.show_local_history)
+        file_menu.addAction(history_action)
+
         close_action = QAction("Закрыть вкладку", self)
         close_action.setShortcut("Ctrl+W")
         close_action.triggered.connect(self.close_current_tab)
@@ -973,18 +6201,118 @@ class MainWindow(QMainWindow):
         run_action.triggered.connect(self.run_code)
         menu.addAction(run_action)
 
-    def open_new_tab(self, filepath=None):
-        tab = EditorTab(filepath)
+        tools_menu = menu.addMenu("Сервис")
+        self.watchdog_action = QAction("Сторож зависаний", self)
+        self.watchdog_action.setCheckable(True)
+        self.watchdog_action.setChecked(StallWatchdog.instance().is_running())
+        self.watchdog_action.toggled.connect(self.toggle_watchdog)
+        tools_menu.addAction(self.watchdog_action)
+
+        stall_report_action = QAction("Отчёт о зависаниях...", self)
+        stall_report_action.triggered.connect(self.show_stall_report)
+        tools_menu.addAction(stall_report_action)
+
+        completion_action = QAction(f"AI-дополнения в редакторе ({COMPLETION_MODEL})", self)
+        completion_action.setCheckable(True)
+        completion_action.setChecked(InlineCompleter.enabled)
+        completion_action.toggled.connect(self.toggle_inline_completion)
+        tools_menu.addAction(completion_action)
+
+        llm_stats_action = QAction("Статистика моделей...", self)
+        llm_stats_action.triggered.connect(self.show_llm_stats)
+        tools_menu.addAction(llm_stats_action)
+
+        memory_action = QAction("Память...", self)
+        memory_action.triggered.connect(self.show_memory)
+        tools_menu.addAction(memory_action)
+
+        endpoints_action = QAction("Серверы Ollama...", self)
+        endpoints_action.triggered.connect(self.show_endpoints)
+        tools_menu.addAction(endpoints_action)
+
+        tests_action = QAction("Тесты...", self)
+        tests_action.setShortcut("Ctrl+Shift+T")
+        tests_action.triggered.connect(self.show_tests)
+        tools_menu.addAction(tests_action)
+
+    def toggle_watchdog(self, enabled):
+        if enabled:
+            StallWatchdog.instance().start()
+        else:
+            StallWatchdog.instance().stop()
+
+    def toggle_inline_completion(self, enabled):
+        InlineCompleter.enabled = enabled
+        if not enabled:
+            for i in range(self.tabs.count()):
+                completer = self.tabs.widget(i).editor.completer
+                completer.cancel()
+                completer.dismiss()
+
+    def on_stall(self, stall):
+        self.console.append_text(f"[Зависание] {stall['duration_ms']:.0f} мс в {stall['slot']} "
+                                 f"(событие: {stall['event']})")
+
+    def show_stall_report(self):
+        StallReportDialog(StallWatchdog.instance(), self).exec_()
+
+    def show_local_history(self):
+        tab = self.current_tab()
+        if not tab:
+            return
+        dialog = LocalHistoryDialog(LocalHistory.instance(), tab.history_key, tab.editor.text(), self)
+        if dialog.exec_() and dialog.restored_text is not None:
+            LocalHistory.instance().record(tab.history_key, tab.editor.text(), "до восстановления")
+            tab.editor.selectAll()
+            tab.editor.replaceSelectedText(dialog.restored_text)
+
+    def apply_ai_code(self, code):
+        tab = self.current_tab()
+        if not tab:
+            return
+        LocalHistory.instance().record(tab.history_key, tab.editor.text(), "до применения кода ИИ")
+        tab.editor.setText(code)
+        LocalHistory.instance().record(tab.history_key, code, "код ИИ применён")
+
+    def show_llm_stats(self):
+        LlmStatsDialog(self.ensure_chat().llm_stats, self).exec_()
+
+    def show_memory(self):
+        MemoryDialog(self).exec_()
+
+    def show_endpoints(self):
+        EndpointsDialog(EndpointPool.instance(), self).exec_()
+
+    def show_tests(self):
+        # Панель немодальная: тесты идут в фоне, пока пользователь правит код
+        if self.test_panel is None:
+            tab = self.current_tab()
+            root = os.path.dirname(os.path.abspath(tab.filepath)) if tab and tab.filepath else os.getcwd()
+            self.test_panel = TestPanel(self, root)
+        self.test_panel.show()
+        self.test_panel.raise_()
+
+    def open_location(self, path, line):
+        path = os.path.abspath(path)
+        tabs = self.tabs_for_path(path)
+        tab = tabs[0] if tabs else self.open_new_tab(path)
+        self.tabs.setCurrentWidget(tab)
+        tab.editor.setCursorPosition(max(0, line - 1), 0)
+        tab.editor.ensureLineVisible(max(0, line - 1))
+        tab.editor.setFocus()
+
+    def open_new_tab(self, filepath=None, language="python"):
+        tab = EditorTab(filepath, language)
         tab.code_for_ai.connect(self.handle_code_for_ai)
         self.tabs.addTab(tab, tab.filename)
         self.tabs.setCurrentWidget(tab)
         self.update_path_display()
         self.update_tab_title(tab)
-        tab.editor.textChanged.connect(tab.editor.update_autocomplete)
+        return tab
 
     def close_tab(self, index):
         tab = self.tabs.widget(index)
-        if tab.editor.isModified():
+        if not tab.is_saved:
             ret = QMessageBox.question(self, "Сохранение", f"Файл '{tab.filename}' изменён. Сохранить перед закрытием?",
                                        QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
             if ret == QMessageBox.Yes:
@@ -993,10 +6321,23 @@ class MainWindow(QMainWindow):
             elif ret == QMessageBox.Cancel:
                 return
         self.tabs.removeTab(index)
+        AutosaveJournal.instance().forget(tab)
+        if tab.filepath and len(self.tabs_for_path(os.path.abspath(tab.filepath))) == 0:
+            FileWatcher.instance().untrack(tab.filepath)
         if self.tabs.count() == 0:
             self.open_new_tab()
 
     def tab_changed(self, index):
+        # Время простоя вкладки отсчитывается с момента, когда с неё ушли
+        if self.active_tab is not None:
+            self.active_tab.last_active = time.monotonic()
+        tab = self.tabs.widget(index)
+        if tab is not None:
+            tab.ensure_loaded()
+            tab.last_active = time.monotonic()
+            # Пока вкладка была в фоне, в репозитории мог появиться новый коммит
+            tab.editor.request_git_diff()
+        self.active_tab = tab
         self.update_path_display()
 
     def update_tab_title(self, tab):
@@ -1004,7 +6345,7 @@ class MainWindow(QMainWindow):
         if index == -1:
             return
         title = tab.filename
-        if tab.editor.isModified():
+        if not tab.is_saved:
             title = "*" + title
         self.tabs.setTabText(index, title)
         self.setWindowTitle(f"{tab.filename} - MiniCrusor")
@@ -1035,13 +6376,25 @@ class MainWindow(QMainWindow):
             return tab.editor.text()
         return ""
 
+    def get_current_editor_context(self):
+        tab = self.current_tab()
+        if not tab or not tab.editor.text().strip():
+            return None
+        editor = tab.editor
+        if editor.hasSelectedText():
+            line_from, _, line_to, _ = editor.getSelection()
+        else:
+            line_from = line_to = editor.getCursorPosition()[0]
+        return {"source": editor.text(), "focus": (line_from, line_to), "language": editor.language,
+                "selection": editor.hasSelectedText()}
+
     def set_current_editor_text(self, text):
         tab = self.current_tab()
         if tab:
             tab.editor.setText(text)
 
     def handle_code_for_ai(self, code):
-        self.chat.set_input_text_with_code(code)
+        self.ensure_chat().set_input_text_with_code(code)
 
     def open_file_dialog(self):
         path, _ = QFileDialog.getOpenFileName(self, "Открыть файл", "", "Python Files (*.py);;Все файлы (*)")
@@ -1072,7 +6425,7 @@ class MainWindow(QMainWindow):
             self.close_tab(index)
 
     def run_code(self):
-        if self.process_thread and self.process_thread.isRunning():
+        if self.process_runner is not None:
             self.console.append_text("[Ошибка] Другой процесс уже запущен.")
             return
 
@@ -1093,7 +6446,14 @@ class MainWindow(QMainWindow):
             return
 
         self.console.append_text(f"Запуск {tab.filename}...\n")
-        
+
+        if BackendClient.instance().is_ready():
+            self.process_runner = RemoteProcessRunner(path)
+            self.process_runner.output_received.connect(self.console.append_text)
+            self.process_runner.finished.connect(self.on_run_finished)
+            self.process_runner.run()
+            return
+
         self.process_thread = QThread()
         self.process_runner = ProcessRunner(path)
         self.process_runner.moveToThread(self.process_thread)
@@ -1106,9 +6466,10 @@ class MainWindow(QMainWindow):
 
     def on_run_finished(self, return_code):
         self.console.append_text(f"\n=== Выполнение завершено (код: {return_code}) ===")
-        
-        self.process_thread.quit()
-        self.process_thread.wait()
+
+        if self.process_thread is not None:
+            self.process_thread.quit()
+            self.process_thread.wait()
 
         try:
             os.remove(self.process_runner.path_to_script)
@@ -1118,8 +6479,156 @@ class MainWindow(QMainWindow):
         self.process_runner = None
         self.process_thread = None
 
+# --- Пакетный режим без GUI (--batch-ask) ---
+BATCH_DONE_MARK = "<!-- minicrusor:done "
+
+def iter_batch_files(paths, patterns):
+    import fnmatch
+    skip_dirs = {".git", "__pycache__", ".venv", "venv", "node_modules", ".tox", ".mypy_cache"}
+    for path in paths:
+        if os.path.isfile(path):
+            yield os.path.abspath(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d not in skip_dirs)
+            for name in sorted(files):
+                if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                    yield os.path.abspath(os.path.join(root, name))
+
+def batch_job_key(path, digest, prompt, model):
+    import hashlib
+    return hashlib.sha1(f"{path}\0{digest}\0{prompt}\0{model}".encode("utf-8")).hexdigest()
+
+def load_batch_done(output, fmt):
+    # Уже обработанные файлы: по ним продолжаем после прерывания
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, "r", encoding="utf-8") as f:
+        for line in f:
+            if fmt == "jsonl":
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not entry.get("error"):
+                    done.add(entry.get("key"))
+            elif line.startswith(BATCH_DONE_MARK):
+                done.add(line[len(BATCH_DONE_MARK):].split()[0])
+    return done
+
+def format_batch_entry(entry, fmt):
+    if fmt == "jsonl":
+        return json.dumps(entry, ensure_ascii=False) + "\n"
+    if entry.get("error"):
+        return f"## {entry['path']}\n\n**Ошибка:** {entry['error']}\n\n"
+    note = f"{entry['model']} · {format_metrics(entry['metrics'])}"
+    if entry["context"]["mode"] != "full":
+        note += f" · {format_context_info(entry['context'])}"
+    return (f"## {entry['path']}\n\n{entry['response'].strip()}\n\n"
+            f"_{note}_\n\n"
+            f"{BATCH_DONE_MARK}{entry['key']} -->\n\n")
+
+def run_batch(args):
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    output = args.output or ("minicrusor_review.md" if args.format == "md" else "minicrusor_review.jsonl")
+    fmt = args.format or ("md" if output.lower().endswith((".md", ".markdown")) else "jsonl")
+    done = load_batch_done(output, fmt)
+
+    jobs = []
+    for path in iter_batch_files(args.paths or ["."], args.glob):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                code = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            sys.stderr.write(f"[Пропуск] {path}: {e}\n")
+            continue
+        digest = hashlib.sha1(code.encode("utf-8")).hexdigest()
+        key = batch_job_key(path, digest, args.batch_ask, args.model)
+        if key not in done:
+            jobs.append((path, code, key))
+
+    sys.stderr.write(f"[Пакет] файлов к обработке: {len(jobs)}, уже готово: {len(done)}, "
+                     f"модель: {args.model}, параллельно: {args.concurrency}\n")
+    if not jobs:
+        return 0
+
+    errors = 0
+
+    def ask(path, code, key):
+        entry = {"path": path, "key": key, "model": args.model, "prompt": args.batch_ask}
+        try:
+            language = LanguageRegistry.language_for(path)
+            context, info = build_code_context(code, context_budget(args.model, args.batch_ask), None, language)
+            prompt = build_prompt(args.batch_ask, context, language)
+            text, metrics = ollama_generate(prompt, args.model, timeout=args.timeout)
+            entry.update(response=text, metrics=metrics, context=info)
+        except Exception as e:
+            entry["error"] = str(e)
+        return entry
+
+    executor = ThreadPoolExecutor(max_workers=max(1, args.concurrency))
+    try:
+        futures = [executor.submit(ask, *job) for job in jobs]
+        with open(output, "a", encoding="utf-8") as out:
+            for n, future in enumerate(as_completed(futures), 1):
+                entry = future.result()
+                out.write(format_batch_entry(entry, fmt))
+                out.flush()
+                status = f"ошибка: {entry['error']}" if entry.get("error") else f"{entry['metrics']['total_ms'] / 1000:.1f} с"
+                errors += bool(entry.get("error"))
+                sys.stderr.write(f"[{n}/{len(jobs)}] {entry['path']} — {status}\n")
+    except KeyboardInterrupt:
+        sys.stderr.write("[Пакет] прервано; при повторном запуске обработка продолжится с этого места\n")
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        return 130
+    executor.shutdown()
+    return 1 if errors else 0
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="MiniCrusor", description="Лёгкий редактор кода с AI-чатом")
+    parser.add_argument("--watchdog", action="store_true",
+                        help="отслеживать зависания GUI-потока и записывать стек виновника")
+    parser.add_argument("--watchdog-threshold", type=int, default=STALL_THRESHOLD_MS, metavar="MS",
+                        help=f"порог зависания в миллисекундах (по умолчанию {STALL_THRESHOLD_MS})")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="вывести в stderr время каждой фазы запуска")
+    parser.add_argument("--no-backend", action="store_true",
+                        help="выполнять запросы к Ollama и запуск скриптов в процессе GUI")
+    parser.add_argument("--backend", action="store_true", help=argparse.SUPPRESS)
+    batch = parser.add_argument_group("пакетный режим без GUI")
+    batch.add_argument("--batch-ask", metavar="PROMPT",
+                       help="задать вопрос нейросети по каждому файлу из PATHS и записать ответы")
+    batch.add_argument("paths", nargs="*", metavar="PATHS", help="файлы или каталоги для --batch-ask")
+    batch.add_argument("--model", default="phi3", help="модель Ollama (по умолчанию phi3)")
+    batch.add_argument("--concurrency", type=int, default=2, help="одновременных запросов (по умолчанию 2)")
+    batch.add_argument("--output", help="файл результатов (.jsonl или .md); дописывается при продолжении")
+    batch.add_argument("--format", choices=["jsonl", "md"], help="формат результатов (по умолчанию по расширению)")
+    batch.add_argument("--glob", action="append", default=None,
+                       help="шаблон имён файлов в каталогах (по умолчанию *.py, можно несколько раз)")
+    batch.add_argument("--timeout", type=int, default=600, help="таймаут ожидания ответа, с")
+    # Аргументы Qt (например, -style) остаются для QApplication
+    args, _ = parser.parse_known_args(argv[1:])
+    args.glob = args.glob or ["*.py"]
+    return args
+
 def main():
+    args = parse_args(sys.argv)
+    if args.backend:
+        sys.exit(run_backend())
+    if args.batch_ask:
+        sys.exit(run_batch(args))
+    profile = StartupProfile.instance()
+    profile.enabled = args.profile_startup
+    profile.expect("список моделей")
+    profile.mark("импорт модулей")
     app = QApplication(sys.argv)
+    profile.mark("QApplication")
     app.setStyleSheet("""
     QWidget {
         font-family: 'Segoe UI', 'Arial', sans-serif;
@@ -1302,8 +6811,22 @@ def main():
         color: #fff;
     }
     """)
+    profile.mark("таблица стилей")
+    app.aboutToQuit.connect(DiagnosticsEngine.instance().shutdown)
+    app.aboutToQuit.connect(GitGutterEngine.instance().shutdown)
+    app.aboutToQuit.connect(LocalHistory.instance().shutdown)
+    app.aboutToQuit.connect(AutosaveJournal.instance().shutdown)
+    BackendClient.enabled = not args.no_backend
+    app.aboutToQuit.connect(BackendClient.instance().shutdown)
+    app.aboutToQuit.connect(EndpointPool.instance().shutdown)
     window = MainWindow()
+    profile.mark("главное окно")
     window.show()
+    profile.mark("show()")
+    if args.watchdog:
+        StallWatchdog.instance().start(args.watchdog_threshold)
+        window.watchdog_action.setChecked(True)
+    app.aboutToQuit.connect(StallWatchdog.instance().stop)
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
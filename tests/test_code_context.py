@@ -0,0 +1,33 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import MiniCrusor
+
+
+def _build(source, budget, focus):
+    # Зависание цикла сужения не должно вешать весь прогон — ждём с таймаутом
+    result = []
+    worker = threading.Thread(target=lambda: result.append(
+        MiniCrusor.build_code_context(source, budget, focus)), daemon=True)
+    worker.start()
+    worker.join(30)
+    assert result, "build_code_context не завершился"
+    return result[0]
+
+
+def test_many_functions_small_budget():
+    source = "".join(f"def f{i}(a, b):\n    return a + b + {i}\n\n" for i in range(1500))
+    text, info = _build(source, 3000, (10, 10))
+    assert info["mode"] == "truncated"
+    assert MiniCrusor.estimate_tokens(text) <= 3000 * 1.1
+
+
+def test_own_source_small_budget():
+    with open(MiniCrusor.__file__, encoding="utf-8") as f:
+        source = f.read()
+    text, info = _build(source, 3000, (5000, 5010))
+    assert info["mode"] in ("skeleton", "truncated")
+    assert text
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+
+# Бенчмарки запускаются без дисплея
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+# Локальная история и журнал автосохранения бенчмарков не должны попадать в каталог пользователя
+os.environ.setdefault("MINICRUSOR_HOME", tempfile.mkdtemp(prefix="minicrusor-bench-"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import Qt, QThread, QEventLoop, QTimer
+from PyQt5.QtTest import QTest
+
+import MiniCrusor
+
+SAMPLE_CODE = '''class Sample:
+    def method(self, value):
+        # комментарий
+        result = [v * 2 for v in range(value)]
+        return "строка", result
+
+'''
+
+# Для каждой метрики: единица измерения и что считается лучше
+UNITS = {
+    "ms": "lower",
+    "s": "lower",
+    "MB/s": "higher",
+    "lines/s": "higher",
+}
+
+def make_code(lines):
+    chunk = SAMPLE_CODE.splitlines(True)
+    return "".join(chunk[i % len(chunk)] for i in range(lines))
+
+def process_events():
+    QApplication.processEvents(QEventLoop.AllEvents, 50)
+
+def wait_for(signal, timeout_ms=60000):
+    loop = QEventLoop()
+    signal.connect(loop.quit)
+    QTimer.singleShot(timeout_ms, loop.quit)
+    loop.exec_()
+
+def bench_keystroke(sizes, keys):
+    results = {}
+    for lines in sizes:
+        editor = MiniCrusor.CodeEditor()
+        editor.setText(make_code(lines))
+        editor.setCursorPosition(lines // 2, 0)
+        editor.show()
+        process_events()
+        samples = []
+        for _ in range(keys):
+            start = time.perf_counter()
+            QTest.keyClick(editor, Qt.Key_A)
+            samples.append((time.perf_counter() - start) * 1000)
+        editor.close()
+        editor.deleteLater()
+        process_events()
+        results[f"keystroke.{lines}_lines.p50"] = (statistics.median(samples), "ms")
+        results[f"keystroke.{lines}_lines.max"] = (max(samples), "ms")
+    return results
+
+def bench_file_io(window, size_mb, repeats):
+    text = make_code(1)
+    text = text * max(1, int(size_mb * 1024 * 1024 / len(text.encode("utf-8"))))
+    size = len(text.encode("utf-8")) / (1024 * 1024)
+    fd, path = tempfile.mkstemp(suffix=".py")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    load_samples, save_samples = [], []
+    try:
+        for _ in range(repeats):
+            window.open_new_tab()
+            tab = window.current_tab()
+            start = time.perf_counter()
+            tab.load_file(path)
+            load_samples.append(time.perf_counter() - start)
+            tab.editor.setModified(True)
+            start = time.perf_counter()
+            tab.save_file(path)
+            save_samples.append(time.perf_counter() - start)
+            window.tabs.removeTab(window.tabs.indexOf(tab))
+            tab.deleteLater()
+            process_events()
+    finally:
+        os.remove(path)
+    return {
+        "file.load": (size / statistics.median(load_samples), "MB/s"),
+        "file.save": (size / statistics.median(save_samples), "MB/s"),
+    }
+
+def bench_console(lines):
+    console = MiniCrusor.ConsoleWidget()
+    fd, path = tempfile.mkstemp(suffix=".py", text=True)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(f"for i in range({lines}):\n    print('строка вывода', i)\n")
+    thread = QThread()
+    runner = MiniCrusor.ProcessRunner(path)
+    runner.moveToThread(thread)
+    runner.output_received.connect(console.append_text)
+    thread.started.connect(runner.run)
+    try:
+        start = time.perf_counter()
+        thread.start()
+        wait_for(runner.finished)
+        # Досылаем оставшиеся в очереди строки
+        process_events()
+        elapsed = time.perf_counter() - start
+    finally:
+        thread.quit()
+        thread.wait()
+        os.remove(path)
+    received = console.blockCount()
+    console.deleteLater()
+    return {"console.throughput": (received / elapsed, "lines/s")}
+
+def bench_chat(messages, probes):
+    chat = MiniCrusor.ChatWidget()
+    text = "Ответ модели с кодом <code>print('hello')</code> " * 5
+    results = {}
+    step = max(1, messages // probes)
+    for i in range(messages):
+        start = time.perf_counter()
+        chat.append_message("Ollama", text)
+        elapsed = (time.perf_counter() - start) * 1000
+        if (i + 1) % step == 0:
+            results[f"chat.append.at_{i + 1}"] = (elapsed, "ms")
+    chat.deleteLater()
+
+    # Потоковый ответ: стоимость очередного куска не должна расти с длиной ответа
+    chat = MiniCrusor.ChatWidget()
+    chat.append_message("Ollama", "")
+    answer = "".join("```python\n" if i % 40 == 0 else "```\n" if i % 40 == 20 else f"строка {i}: `x` и **y**\n"
+                     for i in range(messages * 10))
+    samples = []
+    for i in range(0, len(answer), 40):
+        start = time.perf_counter()
+        chat._on_ollama_chunk(answer[i:i + 40])
+        samples.append((time.perf_counter() - start) * 1000)
+    tail = samples[-max(1, len(samples) // 10):]
+    results["chat.stream.chunk_p50"] = (statistics.median(samples), "ms")
+    results["chat.stream.chunk_last10pct"] = (statistics.mean(tail), "ms")
+    chat.deleteLater()
+    return results
+
+def bench_startup(repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        window = MiniCrusor.MainWindow()
+        window.show()
+        process_events()
+        samples.append(time.perf_counter() - start)
+        window.close()
+        window.deleteLater()
+        process_events()
+    return {"startup.main_window": (statistics.median(samples) * 1000, "ms")}
+
+def shutdown_engines():
+    # То же, что делает aboutToQuit в main(): без этого фоновый процесс остаётся жить после выхода
+    for engine in (MiniCrusor.DiagnosticsEngine, MiniCrusor.GitGutterEngine, MiniCrusor.LocalHistory,
+                   MiniCrusor.AutosaveJournal, MiniCrusor.BackendClient, MiniCrusor.EndpointPool):
+        engine.instance().shutdown()
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, entry in results.items():
+        old = baseline.get("results", {}).get(name)
+        if not old or not old["value"]:
+            continue
+        change = (entry["value"] - old["value"]) / old["value"]
+        entry["baseline"] = old["value"]
+        entry["change"] = round(change, 4)
+        worse = -change if UNITS[entry["unit"]] == "higher" else change
+        if worse > threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей MiniCrusor (без дисплея)")
+    parser.add_argument("--output", default="bench_output.json", help="куда записать результаты JSON")
+    parser.add_argument("--baseline", help="JSON с предыдущими результатами для сравнения")
+    parser.add_argument("--save-baseline", help="сохранить результаты как новую базовую линию")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="допустимое ухудшение относительно базовой линии (доля, по умолчанию 0.15)")
+    parser.add_argument("--quick", action="store_true", help="уменьшенные размеры для быстрой проверки")
+    parser.add_argument("--only", nargs="*", choices=["keystroke", "file", "console", "chat", "startup"],
+                        help="запустить только выбранные группы")
+    args = parser.parse_args()
+
+    groups = set(args.only or ["keystroke", "file", "console", "chat", "startup"])
+    sizes = [100, 1000] if args.quick else [100, 1000, 10000, 50000]
+    app = QApplication.instance() or QApplication(sys.argv)
+
+    raw = {}
+    if "startup" in groups:
+        raw.update(bench_startup(2 if args.quick else 5))
+    if "keystroke" in groups:
+        raw.update(bench_keystroke(sizes, 20 if args.quick else 100))
+    if "file" in groups:
+        window = MiniCrusor.MainWindow()
+        raw.update(bench_file_io(window, 1 if args.quick else 8, 2 if args.quick else 5))
+        window.deleteLater()
+    if "console" in groups:
+        raw.update(bench_console(5000 if args.quick else 100000))
+    if "chat" in groups:
+        raw.update(bench_chat(200 if args.quick else 2000, 5 if args.quick else 10))
+
+    shutdown_engines()
+
+    results = {name: {"value": round(value, 4), "unit": unit} for name, (value, unit) in raw.items()}
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report["regressions"] = regressions
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for name, entry in sorted(results.items()):
+        change = f" ({entry['change']:+.1%})" if "change" in entry else ""
+        print(f"{name:40} {entry['value']:>12.3f} {entry['unit']}{change}")
+    if regressions:
+        print("Регрессии: " + ", ".join(regressions))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Локальная замена демона Ollama для воспроизводимых замеров и тестов.
+# Поддерживает потоковую выдачу, задержку первого токена, скорость генерации,
+# внедрение ошибок, а также запись и воспроизведение реальных сессий.
+
+DEFAULT_MODELS = ["phi3:latest", "llama3:latest", "codellama:7b"]
+
+LOREM = ("Вот пример решения задачи . Сначала разберём код , затем предложим исправление .\n"
+         "```python\ndef solve ( data ) :\n    return sorted ( data )\n```\n"
+         "Этот вариант проще и работает за O ( n log n ) .").split(" ")
+
+class FakeOllamaConfig:
+    def __init__(self, models=None, ttft=0.2, tps=40.0, load_duration=0.0, error_rate=0.0, error_status=500,
+                 drop_rate=0.0, tokens=60, pull_size=50 * 1024 * 1024, pull_layers=3, resident=None,
+                 replay=None, record=None, upstream=None, seed=None):
+        self.models = list(models or DEFAULT_MODELS)
+        self.resident = list(resident if resident is not None else self.models[:1])
+        self.ttft = ttft
+        self.tps = tps
+        self.load_duration = load_duration
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.tokens = tokens
+        self.pull_size = pull_size
+        self.pull_layers = pull_layers
+        self.record = record
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.random = random.Random(seed)
+        self.replay = {}
+        if replay:
+            self.load_replay(replay)
+
+    def load_replay(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.replay.setdefault(request_key(entry["path"], entry["request"]), []).append(entry)
+
+def request_key(path, request):
+    # Сессии сопоставляются по эндпоинту, модели и содержимому запроса
+    body = {k: request.get(k) for k in ("model", "prompt", "messages", "name")}
+    digest = hashlib.sha1(json.dumps(body, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f"{path}:{digest}"
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOllama/1.0"
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": [self._model_entry(m) for m in self.config.models]})
+        elif self.path == "/api/ps":
+            with self.server.lock:
+                active = self.server.active
+            self._send_json({"models": [dict(self._model_entry(m), size_vram=self._model_size(m), active=active)
+                                        for m in self.config.resident]})
+        elif self.path in ("/", "/api/version"):
+            self._send_json({"version": "0.0.0-fake"})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json({"error": "invalid JSON"}, status=400)
+            return
+        handlers = {
+            "/api/generate": self._generate,
+            "/api/chat": self._chat,
+            "/api/pull": self._pull,
+            "/api/embeddings": self._embeddings,
+            "/api/embed": self._embeddings,
+        }
+        handler = handlers.get(self.path)
+        if handler is None:
+            self._send_json({"error": "not found"}, status=404)
+            return
+        if self.config.random.random() < self.config.error_rate:
+            self._send_json({"error": "injected failure"}, status=self.config.error_status)
+            return
+        with self.server.lock:
+            self.server.active += 1
+        try:
+            if self.config.upstream:
+                self._proxy(request)
+            else:
+                handler(request)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    # --- Эндпоинты ---
+    def _generate(self, request):
+        self._stream_tokens(request, lambda tok: {"response": tok}, lambda text: {"response": text})
+
+    def _chat(self, request):
+        self._stream_tokens(request,
+                            lambda tok: {"message": {"role": "assistant", "content": tok}},
+                            lambda text: {"message": {"role": "assistant", "content": text}})
+
+    def _embeddings(self, request):
+        text = request.get("prompt") or request.get("input") or ""
+        if isinstance(text, list):
+            text = " ".join(text)
+        seed = int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)
+        rnd = random.Random(seed)
+        vector = [round(rnd.uniform(-1, 1), 6) for _ in range(64)]
+        if self.path == "/api/embed":
+            self._send_json({"model": request.get("model"), "embeddings": [vector]})
+        else:
+            self._send_json({"embedding": vector})
+
+    def _pull(self, request):
+        name = request.get("name") or request.get("model") or ""
+        stream = request.get("stream", True)
+        layers = max(1, self.config.pull_layers)
+        layer_size = self.config.pull_size // layers
+        events = [{"status": "pulling manifest"}]
+        step = max(1, layer_size // 20)
+        for i in range(layers):
+            digest = "sha256:" + hashlib.sha256(f"{name}:{i}".encode("utf-8")).hexdigest()
+            for done in list(range(0, layer_size, step)) + [layer_size]:
+                events.append({"status": f"pulling {digest[7:19]}", "digest": digest,
+                               "total": layer_size, "completed": done})
+        events += [{"status": "verifying sha256 digest"}, {"status": "writing manifest"}, {"status": "success"}]
+        if not stream:
+            time.sleep(self.config.ttft)
+            self._finish_pull(name)
+            self._send_json({"status": "success"})
+            return
+        self._start_stream()
+        for event in events:
+            if self.config.random.random() < self.config.drop_rate:
+                # Обрыв соединения посреди загрузки
+                self.close_connection = True
+                return
+            self._write_chunk(event)
+            time.sleep(1.0 / max(self.config.tps, 1e-3) / 4)
+        self._finish_pull(name)
+        self._end_stream()
+
+    def _finish_pull(self, name):
+        full = name if ":" in name else f"{name}:latest"
+        with self.server.lock:
+            if full not in self.config.models:
+                self.config.models.append(full)
+
+    # --- Генерация токенов ---
+    def _stream_tokens(self, request, chunk, whole):
+        model = request.get("model", "")
+        if model and not self._known(model):
+            self._send_json({"error": f"model '{model}' not found, try pulling it first"}, status=404)
+            return
+        recorded = self._take_replay(request)
+        if recorded is not None:
+            tokens = recorded.get("tokens") or [recorded.get("response", "")]
+        else:
+            tokens = [self.config.random.choice(LOREM) + " " for _ in range(self.config.tokens)]
+        prompt = request.get("prompt") or " ".join(m.get("content", "") for m in request.get("messages", []))
+        prompt_tokens = max(1, len(prompt) // 4)
+
+        start = time.perf_counter()
+        load = self.config.load_duration if model not in self.config.resident else 0.0
+        time.sleep(load + self.config.ttft)
+        with self.server.lock:
+            if model and model not in self.config.resident:
+                self.config.resident.append(model)
+        prompt_done = time.perf_counter()
+        interval = 1.0 / max(self.config.tps, 1e-3)
+
+        stats = lambda: {
+            "total_duration": int((time.perf_counter() - start) * 1e9),
+            "load_duration": int(load * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int((prompt_done - start - load) * 1e9),
+            "eval_count": len(tokens),
+            "eval_duration": int((time.perf_counter() - prompt_done) * 1e9),
+        }
+        if not request.get("stream", True):
+            time.sleep(interval * len(tokens))
+            self._send_json(dict(self._base(model), done=True, done_reason="stop", **whole("".join(tokens)), **stats()))
+            return
+        self._start_stream()
+        for token in tokens:
+            if self.config.random.random() < self.config.drop_rate:
+                self.close_connection = True
+                return
+            self._write_chunk(dict(self._base(model), done=False, **chunk(token)))
+            time.sleep(interval)
+        self._write_chunk(dict(self._base(model), done=True, done_reason="stop", **chunk(""), **stats()))
+        self._end_stream()
+
+    def _take_replay(self, request):
+        key = request_key(self.path, request)
+        with self.server.lock:
+            entries = self.config.replay.get(key)
+            if not entries:
+                return None
+            # Повторяющиеся запросы проигрываются по кругу
+            entry = entries.pop(0)
+            entries.append(entry)
+            return entry
+
+    # --- Запись сессий через настоящий сервер ---
+    def _proxy(self, request):
+        import requests
+        url = self.config.upstream + self.path
+        with requests.post(url, json=request, stream=True, timeout=600) as resp:
+            if resp.status_code != 200:
+                self._send_json({"error": resp.text}, status=resp.status_code)
+                return
+            self._start_stream()
+            tokens = []
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+                info = json.loads(line)
+                tokens.append(info.get("response") or info.get("message", {}).get("content", ""))
+                self._write_chunk(info)
+            self._end_stream()
+        if self.config.record:
+            with self.server.lock, open(self.config.record, "a", encoding="utf-8") as f:
+                entry = {"path": self.path, "request": request, "tokens": [t for t in tokens if t]}
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    # --- Вспомогательное ---
+    def _known(self, model):
+        full = model if ":" in model else f"{model}:latest"
+        return full in self.config.models or model in self.config.models
+
+    def _model_size(self, model):
+        return 2 * 1024 ** 3 + len(model) * 1024 ** 2
+
+    def _model_entry(self, model):
+        return {
+            "name": model,
+            "model": model,
+            "size": self._model_size(model),
+            "digest": hashlib.sha256(model.encode("utf-8")).hexdigest(),
+            "modified_at": "2024-01-01T00:00:00Z",
+        }
+
+    def _base(self, model):
+        return {"model": model, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, payload):
+        data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, config=None, verbose=False):
+        super().__init__((host, port), FakeOllamaHandler)
+        self.config = config or FakeOllamaConfig()
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.active = 0
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл keep-alive соединение — это не ошибка сервера
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена сервера Ollama")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--models", nargs="*", default=DEFAULT_MODELS, help="модели, которые считаются скачанными")
+    parser.add_argument("--resident", nargs="*", help="модели, уже загруженные в память (/api/ps)")
+    parser.add_argument("--ttft", type=float, default=0.2, help="задержка до первого токена, с")
+    parser.add_argument("--tps", type=float, default=40.0, help="токенов в секунду")
+    parser.add_argument("--load-duration", type=float, default=0.0,
+                        help="время загрузки модели, которой нет в памяти, с")
+    parser.add_argument("--tokens", type=int, default=60, help="длина сгенерированного ответа в токенах")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля запросов, завершающихся ошибкой")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--drop-rate", type=float, default=0.0,
+                        help="вероятность оборвать соединение на каждом фрагменте потока")
+    parser.add_argument("--pull-size", type=int, default=50 * 1024 * 1024, help="размер «скачиваемой» модели, байт")
+    parser.add_argument("--replay", help="JSONL с записанными сессиями для воспроизведения")
+    parser.add_argument("--record", help="записывать сессии в JSONL (нужен --upstream)")
+    parser.add_argument("--upstream", help="настоящий сервер Ollama для проксирования и записи")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.record and not args.upstream:
+        parser.error("--record требует --upstream")
+
+    config = FakeOllamaConfig(models=args.models, ttft=args.ttft, tps=args.tps, load_duration=args.load_duration,
+                              error_rate=args.error_rate, error_status=args.error_status, drop_rate=args.drop_rate,
+                              tokens=args.tokens, pull_size=args.pull_size, resident=args.resident,
+                              replay=args.replay, record=args.record, upstream=args.upstream, seed=args.seed)
+    server = FakeOllamaServer(args.host, args.port, config, verbose=args.verbose)
+    print(f"Fake Ollama слушает {server.url} (OLLAMA_HOST={server.url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TOOLS_DIR))
+sys.path.insert(0, TOOLS_DIR)
+
+from PyQt5.QtCore import QCoreApplication, QTimer
+
+import MiniCrusor
+from MiniCrusor import percentile
+from fake_ollama import FakeOllamaServer, FakeOllamaConfig
+
+# Нагрузочный прогон через клиентский код приложения (OllamaWorker).
+# Запросы идут на серверы пула (OLLAMA_HOSTS / OLLAMA_HOST) или на встроенные fake-серверы (--fake).
+
+def summarize(ms):
+    return {
+        "min": round(min(ms), 1) if ms else 0.0,
+        "mean": round(statistics.mean(ms), 1) if ms else 0.0,
+        "p50": round(percentile(ms, 50), 1),
+        "p90": round(percentile(ms, 90), 1),
+        "p95": round(percentile(ms, 95), 1),
+        "p99": round(percentile(ms, 99), 1),
+        "max": round(max(ms), 1) if ms else 0.0,
+    }
+
+class LoadDriver:
+    def __init__(self, app, model, prompts, total, concurrency):
+        self.app = app
+        self.model = model
+        self.prompts = prompts
+        self.total = total
+        self.concurrency = concurrency
+        self.started = 0
+        self.done = 0
+        self.latencies = []
+        self.metrics = []
+        self.errors = []
+        self.workers = set()
+
+    def run(self):
+        self.begin = time.perf_counter()
+        for _ in range(min(self.concurrency, self.total)):
+            self._launch()
+        self.app.exec_()
+        self.elapsed = time.perf_counter() - self.begin
+
+    def _launch(self):
+        prompt = self.prompts[self.started % len(self.prompts)]
+        self.started += 1
+        worker = MiniCrusor.OllamaWorker(prompt, self.model)
+        start = time.perf_counter()
+        worker.result.connect(lambda _text, s=start: self.latencies.append(time.perf_counter() - s))
+        worker.metrics.connect(self.metrics.append)
+        worker.error.connect(self.errors.append)
+        worker.finished.connect(lambda w=worker: self._on_finished(w))
+        self.workers.add(worker)
+        worker.start()
+
+    def _on_finished(self, worker):
+        worker.wait()
+        self.workers.discard(worker)
+        self.done += 1
+        if self.started < self.total:
+            self._launch()
+        elif self.done >= self.total:
+            QTimer.singleShot(0, self.app.quit)
+
+    def report(self):
+        ms = [v * 1000 for v in self.latencies]
+        return {
+            "requests": self.total,
+            "concurrency": self.concurrency,
+            "ok": len(self.latencies),
+            "errors": len(self.errors),
+            "elapsed_s": round(self.elapsed, 3),
+            "throughput_rps": round(self.done / self.elapsed, 3) if self.elapsed else 0.0,
+            "latency_ms": summarize(ms),
+            "ttft_ms": summarize([m["ttft_ms"] for m in self.metrics if m["ttft_ms"] is not None]),
+            "eval_tps": summarize([m["eval_tps"] for m in self.metrics]),
+            "error_samples": self.errors[:5],
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон запросов к Ollama через OllamaWorker")
+    parser.add_argument("--model", default="phi3")
+    parser.add_argument("--requests", type=int, default=50, help="всего запросов")
+    parser.add_argument("--concurrency", type=int, default=4, help="одновременных запросов")
+    parser.add_argument("--prompt", action="append", help="текст запроса (можно несколько раз)")
+    parser.add_argument("--prompts-file", help="файл с запросами, по одному на строку")
+    parser.add_argument("--fake", action="store_true", help="поднять встроенный fake-сервер вместо настоящей Ollama")
+    parser.add_argument("--ttft", type=float, default=0.2, help="для --fake: задержка первого токена, с")
+    parser.add_argument("--tps", type=float, default=40.0, help="для --fake: токенов в секунду")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="для --fake: доля ошибок")
+    parser.add_argument("--replay", help="для --fake: JSONL с записанными сессиями")
+    parser.add_argument("--endpoints", type=int, default=1, help="для --fake: сколько серверов поднять на разных портах")
+    parser.add_argument("--resident-on", type=int, default=1,
+                        help="для --fake: на скольких серверах модель уже загружена в память")
+    parser.add_argument("--kill-after", type=float,
+                        help="для --fake: остановить первый сервер через столько секунд (проверка переключения)")
+    parser.add_argument("--json", help="записать отчёт в JSON")
+    args = parser.parse_args()
+
+    prompts = list(args.prompt or [])
+    if args.prompts_file:
+        with open(args.prompts_file, "r", encoding="utf-8") as f:
+            prompts += [line.strip() for line in f if line.strip()]
+    prompts = prompts or ["Объясни, что делает функция sorted в Python."]
+
+    servers = []
+    if args.fake:
+        model = f"{args.model}:latest"
+        for i in range(max(1, args.endpoints)):
+            config = FakeOllamaConfig(models=[model], ttft=args.ttft, tps=args.tps, error_rate=args.error_rate,
+                                      replay=args.replay, resident=[model] if i < args.resident_on else [])
+            servers.append(FakeOllamaServer(config=config).start())
+        os.environ["OLLAMA_HOSTS"] = ",".join(server.url for server in servers)
+
+    app = QCoreApplication(sys.argv)
+    pool = MiniCrusor.EndpointPool.instance()
+    pool.probe_all()
+    if args.kill_after and servers:
+        QTimer.singleShot(int(args.kill_after * 1000), servers[0].stop)
+    driver = LoadDriver(app, args.model, prompts, args.requests, max(1, args.concurrency))
+    try:
+        driver.run()
+    finally:
+        pool.shutdown()
+        for server in servers[1:] if args.kill_after else servers:
+            server.stop()
+
+    report = driver.report()
+    report["endpoints"] = {e["url"]: {"served": e["served"], "healthy": e["healthy"]} for e in pool.snapshot()}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+    return 0 if not driver.errors else 1
+
+if __name__ == "__main__":
+    sys.exit(main())